@@ -9,24 +9,29 @@ from signal import signal, SIGINT, getsignal
 from datetime import datetime
 import getpass
 import json
-import requests
+import time
+import threading
 
 __author__ = 'DataKitchen, Inc.'
 
 home = expanduser('~')  # does not end in a '/'
 if os.path.join(home, 'dev/DKCloudCommand') not in path:
     path.insert(0, os.path.join(home, 'dev/DKCloudCommand'))
-from DKCloudCommand.modules.DKCloudAPI import DKCloudAPI
+from DKCloudCommand.modules.DKCloudAPI import DKCloudAPI, DKLoginError
 from DKCloudCommand.modules.DKCloudCommandConfig import DKCloudCommandConfig
 from DKCloudCommand.modules.DKCloudCommandRunner import DKCloudCommandRunner
 from DKCloudCommand.modules.DKKitchenDisk import DKKitchenDisk
 from DKCloudCommand.modules.DKRecipeDisk import DKRecipeDisk
+from DKCloudCommand.modules.DKActiveServingWatcher import DK_OUTPUT_TEXT, DK_OUTPUT_JSON
 
 DEFAULT_IP = 'https://cloud.datakitchen.io'
 DEFAULT_PORT = '443'
 
 DK_VERSION = '1.0.59'
 
+VERSION_CHECK_URL = 'https://pypi.org/pypi/DKCloudCommand/json'
+VERSION_CHECK_TIMEOUT = 5
+
 alias_exceptions = {'recipe-conflicts': 'rf',
                     'kitchen-config': 'kf',
                     'recipe-create': 're',
@@ -51,9 +56,6 @@ class Backend(object):
         else:
             self.config_file_location = config_path_param
 
-        if not self.check_version():
-            exit(1)
-
         if not os.path.isfile(self.config_file_location):
             self.setup_cli(self.config_file_location)
 
@@ -62,22 +64,26 @@ class Backend(object):
         if not cfg.init_from_file(self.config_file_location):
             s = "Unable to load configuration from '%s'" % self.config_file_location
             raise click.ClickException(s)
+
+        if not self.check_version(cfg):
+            exit(1)
         self.dki = DKCloudAPI(cfg)
         if self.dki is None:
             s = 'Unable to create and/or connect to backend object.'
             raise click.ClickException(s)
-        token = self.dki.login()
-        if token is None:
-            s = 'login failed'
-            raise click.ClickException(s)
 
 
-    def check_version(self):
+    def check_version(self, cfg):
+        # Set DKCLI_SKIP_VERSION_CHECK or dk-cloud-version-check: false to skip it (offline machines).
+        if os.environ.get('DKCLI_SKIP_VERSION_CHECK') or not cfg.get_version_check():
+            return True
+
         current_version = self.version_to_int(DK_VERSION)
 
         folder,_ = os.path.split(self.config_file_location)
 
         latest_version_file = os.path.join(folder,'.latest_version')
+        last_check_file = os.path.join(folder,'.latest_version_checked')
 
         latest_version = None
 
@@ -86,17 +92,9 @@ class Backend(object):
                 latest_version = f.read().strip()
 
         if not latest_version or self.version_to_int(latest_version) <= current_version:
-            try:
-                response = requests.get('http://pypi.python.org/pypi/DKCloudCommand/json')
-
-                info_json = response.json()
-
-                latest_version = info_json['info']['version']
-
-                with open(latest_version_file,'w') as f:
-                    f.write(latest_version)
-            except:
-                pass
+            if self.is_version_check_due(last_check_file, cfg.get_version_check_ttl()):
+                # Only the following commands see the result; this one never waits for pypi.
+                self.start_version_check(latest_version_file, last_check_file)
 
         if latest_version and self.version_to_int(latest_version) > current_version:
 
@@ -112,6 +110,43 @@ class Backend(object):
 
         return True
 
+    @staticmethod
+    def is_version_check_due(last_check_file, ttl):
+        try:
+            with open(last_check_file,'r') as f:
+                last_check = float(f.read().strip())
+        except (IOError, ValueError):
+            return True
+        return not 0 <= time.time() - last_check < ttl
+
+    @staticmethod
+    def start_version_check(latest_version_file, last_check_file):
+        # the attempt is stamped before the request: a command that exits before pypi answers (slow or
+        # dropped network) kills the thread, and the ttl still has to keep the next commands from retrying
+        try:
+            with open(last_check_file,'w') as f:
+                f.write(repr(time.time()))
+        except IOError:
+            pass
+        thread = threading.Thread(target=Backend.fetch_latest_version, args=(latest_version_file,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @staticmethod
+    def fetch_latest_version(latest_version_file):
+        # runs in a daemon thread with a hard timeout, so it never delays the command
+        import urllib2
+        try:
+            response = urllib2.urlopen(VERSION_CHECK_URL, timeout=VERSION_CHECK_TIMEOUT)
+            latest_version = json.load(response)['info']['version']
+            tmp_file = '%s.tmp' % latest_version_file
+            with open(tmp_file,'w') as f:
+                f.write(latest_version)
+            os.rename(tmp_file, latest_version_file)
+        except Exception:
+            pass
+
     def version_to_int(self,version_str):
         tokens = version_str.split('.')
         tokens.reverse()
@@ -273,6 +308,13 @@ class AliasedGroup(click.Group):
     #         with formatter.section('ShortCommands'):
     #             formatter.write_dl(rows)
 
+    def invoke(self, ctx):
+        # the API logs in on the first call that needs a token, from inside whichever command runs
+        try:
+            return click.Group.invoke(self, ctx)
+        except DKLoginError as e:
+            raise click.ClickException(str(e))
+
     def get_command(self, ctx, cmd_name):
         self._check_unique(ctx)
         rv = click.Group.get_command(self, ctx, cmd_name)
@@ -435,9 +477,10 @@ def kitchen_list(backend):
 @dk.command(name='kitchen-get')
 @click.option('--recipe', '-r', type=str, multiple=True, help='Get the recipe along with the kitchen. Multiple allowed')
 @click.option('--all','-a',is_flag=True,help='Get all recipes along with the kitchen.')
+@click.option('--jobs', '-j', type=int, default=None, help='Number of recipes to get in parallel. Defaults to dk-cloud-max-workers')
 @click.argument('kitchen_name', required=True)
 @click.pass_obj
-def kitchen_get(backend, kitchen_name, recipe, all):
+def kitchen_get(backend, kitchen_name, recipe, all, jobs):
     """
     Get an existing Kitchen locally. You may also get one or multiple Recipes from the Kitchen.
     """
@@ -450,7 +493,7 @@ def kitchen_get(backend, kitchen_name, recipe, all):
     else:
         click.secho("%s - Getting kitchen '%s'" % (get_datetime(), kitchen_name), fg='green')
 
-    check_and_print(DKCloudCommandRunner.get_kitchen(backend.dki, kitchen_name, os.getcwd(), recipe, all))
+    check_and_print(DKCloudCommandRunner.get_kitchen(backend.dki, kitchen_name, os.getcwd(), recipe, all, jobs))
 
 
 @dk.command(name='kitchen-which')
@@ -1012,18 +1055,32 @@ def file_delete(backend, kitchen, recipe, message, filepath):
 # --------------------------------------------------------------------------------------------------------------------
 
 @dk.command(name='active-serving-watcher')
-@click.option('--kitchen','-k', type=str, required=False, help='Kitchen name')
+@click.option('--kitchen','-k', type=str, required=False, multiple=True,
+              help='Kitchen name or glob pattern (e.g. "team-*"), can be repeated')
 @click.option('--interval', '-i', type=int, required=False, default=5, help='watching interval, in seconds')
+@click.option('--json', 'json_lines', default=False, is_flag=True, required=False,
+              help='print one json object per change and line')
 @click.pass_obj
-def active_serving_watcher(backend, kitchen, interval):
+def active_serving_watcher(backend, kitchen, interval, json_lines):
     """
-    Watches all cooking Recipes in a Kitchen. Provide the Kitchen name as an argument or be in a Kitchen folder. Optionally provide a watching period as an integer, in seconds. Ctrl+C to terminate.
+    Watches all cooking Recipes in a Kitchen. Provide the Kitchen name as an argument or be in a Kitchen folder. Repeat --kitchen, or use a glob pattern, to watch several Kitchens. Optionally provide a watching period as an integer, in seconds. Ctrl+C to terminate.
     """
-    err_str, use_kitchen = Backend.get_kitchen_from_user(kitchen)
-    if use_kitchen is None:
+    if len(kitchen) > 0:
+        use_kitchens = [Backend.remove_slashes(k) for k in kitchen]
+    else:
+        err_str, use_kitchen = Backend.get_kitchen_from_user()
+        if use_kitchen is None:
+            raise click.ClickException(err_str)
+        use_kitchens = [use_kitchen]
+    if json_lines:
+        output_format = DK_OUTPUT_JSON
+    else:
+        output_format = DK_OUTPUT_TEXT
+        click.secho('%s - Watching Active OrderRun Changes in Kitchen %s' % (get_datetime(), ', '.join(use_kitchens)),
+                    fg='green')
+    err_str = DKCloudCommandRunner.watch_active_servings(backend.dki, use_kitchens, interval, output_format)
+    if err_str:
         raise click.ClickException(err_str)
-    click.secho('%s - Watching Active OrderRun Changes in Kitchen %s' % (get_datetime(), use_kitchen), fg='green')
-    DKCloudCommandRunner.watch_active_servings(backend.dki, use_kitchen, interval)
     while True:
         try:
             DKCloudCommandRunner.join_active_serving_watcher_thread_join()
@@ -1159,12 +1216,17 @@ def order_stop(backend, order_run_id, yes):
 @click.option('--disp_order_run_id', default=False, is_flag=True, required=False,
               help=' display the order run id (single line)')
 @click.option('--all_things', '-at', default=False, is_flag=True, required=False, help='display all information')
+@click.option('--json', 'json_lines', default=False, is_flag=True, required=False,
+              help='print the information as json objects, one per line')
 # @click.option('--recipe', '-r', type=str, help='recipe name')
 @click.pass_obj
 def orderrun_detail(backend, kitchen, summary, nodestatus, runstatus, log, timing, test, all_things,
-                    order_id, order_run_id, disp_order_id, disp_order_run_id):
+                    order_id, order_run_id, disp_order_id, disp_order_run_id, json_lines):
     """
     Display information about an Order-Run
+
+    The details of a completed Order-Run asked for with --order_run_id are kept in the local order cache,
+    so showing them again does not fetch them from the server.
     """
     err_str, use_kitchen = Backend.get_kitchen_from_user(kitchen)
     if use_kitchen is None:
@@ -1218,6 +1280,12 @@ def orderrun_detail(backend, kitchen, summary, nodestatus, runstatus, log, timin
     elif order_run_id is not None:
         pd[DKCloudCommandRunner.ORDER_RUN_ID] = order_run_id.strip()
 
+    if json_lines:
+        rc = DKCloudCommandRunner.orderrun_detail_events(backend.dki, use_kitchen, pd)
+        if not rc.ok():
+            raise click.ClickException(rc.get_message())
+        return
+
     # don't print the green thing if it is just runstatus
     if not runstatus and not disp_order_id and not disp_order_run_id:
         click.secho('%s - Display Order-Run details from kitchen %s' % (get_datetime(), use_kitchen), fg='green')
@@ -1270,8 +1338,17 @@ def order_resume(backend, orderrun_id, yes):
 @click.option('--order_count', '-oc', type=int, required=False, default=5, help='Number of orders to display')
 @click.option('--order_run_count', '-orc', type=int, required=False, default=3, help='Number of order runs to display, for each order')
 @click.option('--recipe', '-r', type=str, required=False, default=None, help='Filter results for this recipe only')
+@click.option('--all', 'all_orders', default=False, is_flag=True, required=False,
+              help='Display all the orders from the start offset, as they are fetched')
+@click.option('--page_size', '-ps', type=int, required=False, default=None,
+              help='Number of orders fetched per request with --all')
+@click.option('--cached', default=False, is_flag=True, required=False,
+              help='List the orders from the local order cache, fetching only the new ones')
+@click.option('--offline', default=False, is_flag=True, required=False,
+              help='List the orders from the local order cache as it is, without fetching anything')
 @click.pass_obj
-def order_list(backend, kitchen, order_count, order_run_count, start, recipe):
+def order_list(backend, kitchen, order_count, order_run_count, start, recipe, all_orders, page_size, cached,
+               offline):
     """
     List Orders in a Kitchen.
 
@@ -1293,6 +1370,14 @@ def order_list(backend, kitchen, order_count, order_run_count, start, recipe):
 
     dk order-list --recipe recipe_name --order_count 5 --order_run_count 2
 
+    4) Get all the orders, fetched 100 at a time and displayed as they arrive.
+
+    dk order-list --all --page_size 100
+
+    5) Get the first ten orders from the local order cache (see order-history), after fetching the new ones.
+
+    dk order-list --cached --order_count 10
+
     """
     err_str, use_kitchen = Backend.get_kitchen_from_user(kitchen)
     if use_kitchen is None:
@@ -1304,10 +1389,57 @@ def order_list(backend, kitchen, order_count, order_run_count, start, recipe):
     if order_run_count <= 0:
         raise click.ClickException('order_count must be an integer greater than 0')
 
+    if page_size is not None and page_size <= 0:
+        raise click.ClickException('page_size must be an integer greater than 0')
+
+    if all_orders and (cached or offline):
+        raise click.ClickException('--all cannot be used with --cached or --offline')
+
     click.secho('%s - Get Order information for Kitchen %s' % (get_datetime(), use_kitchen), fg='green')
 
+    if all_orders:
+        rc = DKCloudCommandRunner.stream_order_list(backend.dki, use_kitchen, order_run_count, start, recipe=recipe,
+                                                    page_size=page_size)
+        if not rc.ok():
+            raise click.ClickException(rc.get_message())
+        return
+
+    check_and_print(
+            DKCloudCommandRunner.list_order(backend.dki, use_kitchen, order_count, order_run_count, start, recipe=recipe,
+                                            cached=cached or offline, refresh=not offline))
+
+
+@dk.command(name='order-history')
+@click.option('--kitchen', '-k', type=str, required=False, help='Filter results for kitchen only')
+@click.option('--recipe', '-r', type=str, required=False, default=None, help='Filter results for this recipe only')
+@click.option('--days', '-d', type=int, required=False, default=None,
+              help='Only order runs started in the last days')
+@click.option('--offline', default=False, is_flag=True, required=False,
+              help='Use the local order cache as it is, without fetching new order runs')
+@click.pass_obj
+def order_history(backend, kitchen, recipe, days, offline):
+    """
+    Order run counts, failure rates and durations in a Kitchen, per recipe and variation.
+
+    The order runs are kept in a local cache (order_cache.db in the .dk folder of your home),
+    which is brought up to date incrementally before the report unless --offline is given.
+
+    Example:
+
+    dk order-history --recipe recipe_name --days 30
+
+    """
+    err_str, use_kitchen = Backend.get_kitchen_from_user(kitchen)
+    if use_kitchen is None:
+        raise click.ClickException(err_str)
+
+    if days is not None and days <= 0:
+        raise click.ClickException('days must be an integer greater than 0')
+
+    click.secho('%s - Get Order history for Kitchen %s' % (get_datetime(), use_kitchen), fg='green')
     check_and_print(
-            DKCloudCommandRunner.list_order(backend.dki, use_kitchen, order_count, order_run_count, start, recipe=recipe))
+            DKCloudCommandRunner.order_history(backend.dki, use_kitchen, recipe=recipe, days=days,
+                                               refresh=not offline))
 
 # --------------------------------------------------------------------------------------------------------------------
 #  Secret commands
@@ -1514,7 +1646,6 @@ def main(args=None):
 
     if args is None:
         args = sys.argv[1:]
-        Backend()   # force to check version
 
     # store the original SIGINT handler
     original_sigint = getsignal(SIGINT)
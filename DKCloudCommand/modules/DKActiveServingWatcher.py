@@ -1,14 +1,27 @@
 from threading import Thread
+from collections import OrderedDict
+import heapq
+import json
+import sys
 import time
 from sys import stdout
 from DKCloudAPI import DKCloudAPI
 from DKReturnCode import *
 DK_ACTIVE_SERVING_WATCHER_SLEEP_TIME = 5
+# When nothing is running or changing the watcher backs off up to this many seconds between polls.
+DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME = 60
+DK_RUNNING_SERVING_STATUSES = ['PLANNED_SERVING', 'ACTIVE_SERVING']
+# Servings remembered by the watcher, finished ones are evicted first.
+DK_ACTIVE_SERVING_CACHE_SIZE = 256
+DK_OUTPUT_TEXT = 'text'
+# one json object per line and per change, for scripts
+DK_OUTPUT_JSON = 'json'
 
 
 class DKActiveServingWatcherSingleton(object):
     __shared_state = {}
     watcher = None
+    watchers = None
     keep_running = True
     sleep_time = DK_ACTIVE_SERVING_WATCHER_SLEEP_TIME
 
@@ -16,6 +29,7 @@ class DKActiveServingWatcherSingleton(object):
         self.__dict__ = self.__shared_state
         if self.watcher is None:
             self.watcher = DKActiveServingWatcher()
+            self.watchers = [self.watcher]
 
     def start_watcher(self):
         self.keep_running = True
@@ -27,6 +41,9 @@ class DKActiveServingWatcherSingleton(object):
     def get_watcher(self):
         return self.watcher
 
+    def get_watchers(self):
+        return self.watchers
+
     def get_sleep_time(self):
         return self.sleep_time
 
@@ -34,13 +51,33 @@ class DKActiveServingWatcherSingleton(object):
         self.sleep_time = st
 
     def set_api(self, api):
-        self.watcher.set_api(api)
+        for watcher in self.watchers:
+            watcher.set_api(api)
 
     def set_formatter(self, formatter):
-        self.watcher.set_formatter(formatter)
+        for watcher in self.watchers:
+            watcher.set_formatter(formatter)
 
     def set_kitchen(self, kitchen_name):
-        self.watcher.set_kitchen(kitchen_name)
+        self.set_kitchens([kitchen_name])
+
+    def set_output_format(self, output_format):
+        for watcher in self.watchers:
+            watcher.set_output_format(output_format)
+
+    def set_kitchens(self, kitchen_names):
+        """
+        One watcher per kitchen. They share the api (and so its connection pool and login) and
+        are polled by a single thread; with more than one kitchen every line is prefixed with the kitchen name.
+        """
+        self.watcher.set_kitchen(kitchen_names[0])
+        self.watchers = [self.watcher]
+        for kitchen_name in kitchen_names[1:]:
+            watcher = DKActiveServingWatcher(self.watcher.get_api(), kitchen_name, self.watcher.get_formatter())
+            watcher.set_output_format(self.watcher.get_output_format())
+            self.watchers.append(watcher)
+        for watcher in self.watchers:
+            watcher.set_show_kitchen(len(self.watchers) > 1)
 
     def should_run(self):
         return self.keep_running
@@ -52,19 +89,37 @@ class DKActiveServingWatcherSingleton(object):
         self.watcher.print_serving_summary(serving)
 
 
-# Only one watcher runs  ... run and done.
+# Only one watcher thread runs  ... run and done. It polls the watchers of all the watched kitchens.
 def make_watcher_thread(watcher, *args):
     if watcher is None or isinstance(watcher, DKActiveServingWatcher) is False:
         print 'make_watcher_thread bad watcher'
         return
     #print 'Starting watcher make thread'
+    watchers = DKActiveServingWatcherSingleton().get_watchers()
+    if watcher not in watchers:
+        watchers = [watcher]
+    sleep_time = DKActiveServingWatcherSingleton().get_sleep_time()
+    # the first polls are staggered over one interval, so the kitchens are not all polled at once
+    now = time.time()
+    schedule = [(now + sleep_time * i / float(len(watchers)), i) for i in range(len(watchers))]
+    heapq.heapify(schedule)
     while DKActiveServingWatcherSingleton().should_run() is True:
+        poll_time, i = heapq.heappop(schedule)
+        _sleep_until(poll_time)
+        if DKActiveServingWatcherSingleton().should_run() is False:
+            break
         #print ' calling watcher.watch()'
-        watcher.watch()
-        time.sleep(DKActiveServingWatcherSingleton().get_sleep_time())
+        watchers[i].watch()
+        heapq.heappush(schedule, (time.time() + watchers[i].get_next_sleep_time(sleep_time), i))
     #print 'Ending watcher make thread 2'
 
 
+def _sleep_until(wake_up_time):
+    # sleep in short slices so stopping the watcher doesn't wait for a long back off
+    while DKActiveServingWatcherSingleton().should_run() is True and time.time() < wake_up_time:
+        time.sleep(min(0.5, max(wake_up_time - time.time(), 0)))
+
+
 class DKActiveServingWatcher(object):
     _time = 'last-update-time'
 
@@ -73,18 +128,46 @@ class DKActiveServingWatcher(object):
         self._api = api
         self._kitchen_name = kn
         self._formatter = fmt
+        self._idle_polls = 0
+        self._last_update_time = None
+        self._show_kitchen = False
+        self._output_format = DK_OUTPUT_TEXT
+
     def get_run_thread(self):
         return self.run_thread
 
     def set_formatter(self,formatter):
         self._formatter = formatter
 
+    def get_formatter(self):
+        return self._formatter
+
     def set_api(self, api):
         self._api = api
 
+    def get_api(self):
+        return self._api
+
     def set_kitchen(self, kitchen_name):
         self._kitchen_name = kitchen_name
 
+    def get_kitchen(self):
+        return self._kitchen_name
+
+    def set_show_kitchen(self, show_kitchen):
+        self._show_kitchen = show_kitchen
+
+    def set_output_format(self, output_format):
+        self._output_format = output_format
+
+    def get_output_format(self):
+        return self._output_format
+
+    def _get_line_prefix(self):
+        if self._show_kitchen is True:
+            return '[%s] ' % self._kitchen_name
+        return ''
+
     def start_watcher(self):
         if self._api is None or self._kitchen_name is None:
             print 'DKActiveServingWatcher: start_making_watcher failed requires api and kitchen name'
@@ -105,103 +188,155 @@ class DKActiveServingWatcher(object):
             return False
 
     def watch(self):
-        cache = DKActiveServingCache().get_cache()
-        print 'watching ...'
-        rc = self._api.orderrun_detail(self._kitchen_name, {'summary': True})
+        """
+        Polls the kitchen once and prints what changed since the previous poll.
+        Only servings with a newer last-update-time are diffed.
+        :return: True if a change was found
+        """
+        cache = DKActiveServingCache()
+        if self._output_format == DK_OUTPUT_TEXT:
+            print '%swatching ...' % self._get_line_prefix()
+        pd = {'summary': True}
+        since = self._last_update_time
+        if since is not None:
+            # lets the server leave out the servings that did not change
+            pd[self._time] = since
+        rc = self._api.orderrun_detail(self._kitchen_name, pd)
+        found_change = False
         if rc.ok() and rc.get_payload() is not None:
             payload = rc.get_payload()
             for serving in payload:
                 if isinstance(serving, dict) is True and 'summary' in serving:
-                    if 'current' not in cache:
-                        cache['current'] = serving['summary']
-                    else:
-                        cache['previous'] = cache['current']
-                        cache['current'] = serving['summary']
-                        DKActiveServingWatcher._print_changes(self, cache, False)
+                    if self._watch_serving(cache, serving) is True:
+                        found_change = True
+        if found_change is True or cache.has_running_servings(self._kitchen_name) is True:
+            self._idle_polls = 0
+        else:
+            self._idle_polls += 1
+        return found_change
 
-    @staticmethod
-    def print_serving_summary(serving):
-        temp_cache = dict()
-        temp_cache['current'] = serving
-        temp_cache['previous'] = serving
-        DKActiveServingWatcher._print_changes(temp_cache, True)
+    def _watch_serving(self, cache, serving):
+        # each serving is diffed against its own previous summary
+        serving_id = DKActiveServingWatcher._get_serving_id(serving)
+        running = serving.get('status') in DK_RUNNING_SERVING_STATUSES
+        update_time = DKActiveServingWatcher._get_update_time(serving)
+        if update_time is not None and (self._last_update_time is None or update_time > self._last_update_time):
+            self._last_update_time = update_time
+
+        entry = cache.get_serving(serving_id)
+        if entry is not None and update_time is not None and entry[self._time] is not None \
+                and update_time <= entry[self._time]:
+            entry['running'] = running
+            return False
+        index = DKActiveServingWatcher._flatten_summary(serving['summary'])
+        cache.set_serving(serving_id, index, update_time, running, self._kitchen_name)
+        if entry is None:
+            return False
+        if self._output_format == DK_OUTPUT_JSON:
+            return self._write_change_events(serving_id, index, entry['summary'])
+        return self._print_changes(serving['summary'], index, entry['summary'])
+
+    def get_next_sleep_time(self, sleep_time):
+        """
+        Adaptive back off: sleep_time while servings are running or changing,
+        doubling on every idle poll up to DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME.
+        """
+        max_sleep_time = max(sleep_time, DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME)
+        return min(sleep_time * (2 ** min(self._idle_polls, 16)), max_sleep_time)
 
     @staticmethod
-    def _print_changes(watcher, cache, trace=False):
-        found_change = False
-        # print top level changes
-        if 'current' in cache and 'previous' in cache:
-            found_change = DKActiveServingWatcher._print_serving_summary(watcher, cache, trace)
-        if found_change is False:
-            stdout.write(' . \r')
-            stdout.flush()
-        return found_change
+    def _get_serving_id(serving):
+        if 'serving_mesos_id' in serving:
+            return serving['serving_mesos_id']
+        return serving['summary'].get('hid')
 
     @staticmethod
-    def _print_serving_summary(watcher, cache, trace=False):
-        cur = cache['current']
-        pre = cache['previous']
-        nodes = list()
-        found_change = False
-        for item, val in cur.iteritems():
-            if isinstance(val, dict):
-                nodes.append(item)
-            else:
-                if cur[item] != pre[item] and item != 'hid':
-                    print '%s(%s..) %s:  %s' % (cur['name'], cur['hid'][:5], item, watcher._format_item(item,val))
-                    found_change = True
-                else:
-                    if trace is True:
-                        print 'Trace: %s(%s..) %s:  %s' % (cur['name'], cur['hid'][:5], item, watcher._format_item(item,val))
-        for node_name in nodes:
-            pre_val = pre[node_name] if node_name in pre else None
-            if DKActiveServingWatcher._print_node_changes(watcher, cur['name'], cur['hid'][:5], cur[node_name], pre_val,
-                                                          node_name, trace) is True:
-                found_change = True
-
-        return found_change
+    def _get_update_time(serving):
+        if DKActiveServingWatcher._time in serving['summary']:
+            return serving['summary'][DKActiveServingWatcher._time]
+        return serving.get(DKActiveServingWatcher._time)
 
-    # node_name,
-    #   data_source/data_sink/actions
-    #       file_name
-    #           keys
-    #               key_name
-    #                   status
-    #           tests
-    #               applies-to-keys
-    #               results
-    #               status
-    #           status
-    #           timing
-    #           type
-    #   status
-    #   timing
-    #   type
+    def print_serving_summary(self, serving):
+        index = DKActiveServingWatcher._flatten_summary(serving)
+        self._print_changes(serving, index, index, True)
+
+    # summary
+    #   node_name,
+    #     data_source/data_sink/actions
+    #         file_name
+    #             keys
+    #                 key_name
+    #                     status
+    #             tests
+    #                 applies-to-keys
+    #                 results
+    #                 status
+    #             status
+    #             timing
+    #             type
+    #     status
+    #     timing
+    #     type
     @staticmethod
-    def _print_node_changes(watcher, rname, hid, cur, pre, item_print_string, trace=False):
-        found_change = False
-        if isinstance(cur, dict) and isinstance(pre, dict):
-            for item, val in cur.iteritems():
-                new_item_print_string = '%s: %s' % (item_print_string, item)
+    def _flatten_summary(summary):
+        """
+        Indexes a serving summary by path.
+        :param summary: dict, nested as above
+        :return: dict {tuple of keys: value} with one entry per non dict value
+        """
+        index = dict()
+        stack = [((), summary)]
+        while len(stack) > 0:
+            path, node = stack.pop()
+            for item, val in node.iteritems():
                 if isinstance(val, dict):
-                    cur_item = cur[item] if item in cur else None
-                    pre_item = pre[item] if item in pre else None
-                    if DKActiveServingWatcher._print_node_changes(watcher, rname, hid, cur_item, pre_item,
-                                                                  new_item_print_string, trace) is True:
-                        found_change = True
+                    stack.append((path + (item,), val))
                 else:
-                    if item in cur and item in pre and cur[item] != pre[item]:
-                        print '%s(%s..) %s: %s:  %s' % (rname, hid, item_print_string, item, watcher._format_item(item,cur[item]))
-                        found_change = True
-                    else:
-                        if trace is True:
-                            print 'Trace: %s(%s..) %s: %s:  %s' % (rname, hid, item_print_string, item, cur[item])
-        else:
-            if pre and cur:
-                print 'cur and pre fucked up (%s) (%s)' % (cur, pre)
-            else:
-                found_change = True
-        return found_change
+                    index[path + (item,)] = val
+        return index
+
+    @staticmethod
+    def _diff_summary(cur, pre):
+        """
+        :param cur: dict, flattened summary
+        :param pre: dict, flattened summary
+        :return: sorted list of (path, previous value, current value); values missing in pre are None
+        """
+        changes = list()
+        for path, val in cur.iteritems():
+            if path == ('hid',):
+                continue
+            if path not in pre or pre[path] != val:
+                changes.append((path, pre.get(path), val))
+        changes.sort()
+        return changes
+
+    def _print_changes(self, summary, cur, pre, trace=False):
+        rname = summary.get('name')
+        hid = summary.get('hid', '')[:5]
+        prefix = self._get_line_prefix()
+        changes = DKActiveServingWatcher._diff_summary(cur, pre)
+        for path, pre_val, val in changes:
+            print '%s%s(%s..) %s:  %s' % (prefix, rname, hid, ': '.join(path), self._format_item(path[-1], val))
+        if trace is True:
+            for path in sorted(cur.keys()):
+                print '%sTrace: %s(%s..) %s:  %s' % (prefix, rname, hid, ': '.join(path),
+                                                     self._format_item(path[-1], cur[path]))
+        if len(changes) == 0:
+            stdout.write(' . \r')
+            stdout.flush()
+            return False
+        return True
+
+    def _write_change_events(self, serving_id, cur, pre):
+        # each event is written and flushed as soon as it is built
+        timestamp = int(time.time() * 1000)
+        changes = DKActiveServingWatcher._diff_summary(cur, pre)
+        for path, pre_val, val in changes:
+            print json.dumps({'kitchen': self._kitchen_name, 'serving_id': serving_id, 'path': list(path),
+                              'old': pre_val, 'new': val, 'timestamp': timestamp}, sort_keys=True)
+            sys.stdout.flush()
+        return len(changes) > 0
 
     def _format_item(self,item,value):
         if not self._formatter or not isinstance(value,int):
@@ -216,8 +351,15 @@ class DKActiveServingWatcher(object):
 
 
 class DKActiveServingCache(object):
+    """
+    Last seen summary of every watched serving, keyed by serving_mesos_id. Shared by the watchers of
+    all the watched kitchens, each entry records the kitchen of its serving.
+    Holds at most DK_ACTIVE_SERVING_CACHE_SIZE servings: when full, the least recently
+    updated finished serving is evicted (or the least recently updated one if all are running).
+    """
     __shared_state = {}
-    _cache = dict()
+    _cache = OrderedDict()
+    _max_size = DK_ACTIVE_SERVING_CACHE_SIZE
     _time = 'last-update-time'
 
     def __init__(self):
@@ -231,3 +373,44 @@ class DKActiveServingCache(object):
 
     def get_cache(self):
         return self._cache
+
+    def get_max_size(self):
+        return self._max_size
+
+    def set_max_size(self, max_size):
+        self._max_size = max_size
+        self._evict()
+
+    def get_serving(self, serving_id):
+        """
+        :return: dict {'summary': flattened summary, 'last-update-time': value, 'running': bool,
+                 'kitchen': kitchen name} or None
+        """
+        return self._cache.get(serving_id)
+
+    def set_serving(self, serving_id, summary_index, update_time, running, kitchen_name=None):
+        if serving_id in self._cache:
+            del self._cache[serving_id]
+        self._cache[serving_id] = {'summary': summary_index, self._time: update_time, 'running': running,
+                                   'kitchen': kitchen_name}
+        self._evict()
+
+    def has_running_servings(self, kitchen_name=None):
+        """
+        :param kitchen_name: only the servings of that kitchen; all of them when None
+        """
+        for entry in self._cache.itervalues():
+            if entry['running'] is True and (kitchen_name is None or entry['kitchen'] == kitchen_name):
+                return True
+        return False
+
+    def _evict(self):
+        while len(self._cache) > self._max_size:
+            victim = None
+            for serving_id, entry in self._cache.iteritems():
+                if entry['running'] is False:
+                    victim = serving_id
+                    break
+            if victim is None:
+                victim = next(iter(self._cache))
+            del self._cache[victim]
@@ -1,16 +1,42 @@
-import requests
 import urllib
 from distutils.util import strtobool
 
 import time
-import jwt
-from requests import RequestException
+import threading
 from DKCloudCommandConfig import DKCloudCommandConfig
 from DKRecipeDisk import *
 from DKReturnCode import *
+from DKUploadBody import DKUploadBody
+from DKResponseDecoder import DKResponseDecoder
+from DKJsonStream import DKJsonStream
 
 __author__ = 'DataKitchen, Inc.'
 
+# requests is imported the first time the API talks to the server, so local-only commands don't load it.
+requests = None
+
+
+def _import_requests():
+    global requests
+    if requests is None:
+        import requests as requests_module
+        requests = requests_module
+    return requests
+
+
+def _request_errors(*other_errors):
+    # For except clauses: requests' RequestException plus other_errors. The clause is only evaluated
+    # once something was raised, so the class is always the same and requests still loads lazily.
+    return (_import_requests().RequestException,) + other_errors
+
+
+class DKLoginError(Exception):
+    """
+    Raised when a call needs a token and logging in with the configured credentials fails.
+    """
+    pass
+
+
 """
 NOMENCLATURE
 
@@ -59,6 +85,10 @@ e.g.
 class DKCloudAPI(object):
     _use_https = False
     _auth_token = None
+    _session = None
+    _refresh_timer = None
+    _session_lock = threading.Lock()
+    _login_lock = threading.Lock()
     DKAPP_KITCHEN_FILE = 'kitchen.json'
     DKAPP_KITCHENS_DIR = 'kitchens'
     MESSAGE = 'message'
@@ -71,6 +101,8 @@ class DKCloudAPI(object):
     TEXT = 'text'
     SHA = 'sha'
     LAST_UPDATE_TIME = 'last_update_time'
+    ORDER_ID = 'serving_chronos_id'
+    ORDER_RUN_ID = 'serving_mesos_id'
 
     # helpers ---------------------------------
 
@@ -80,44 +112,81 @@ class DKCloudAPI(object):
             self._auth_token = None
             self._role = None
             self._customer_name = None
+            self._session = None
+            self._refresh_timer = None
 
     def get_config(self):
         return self._config
 
-    @staticmethod
-    def _get_json(response):
-        if response is None or response.text is None:
-            return None
-        rvd = response.text
-        try:
-            resp = json.loads(json.loads(rvd))
-        except (ValueError, KeyError, Exception):
-            try:
-                rvd2 = rvd.replace("\\n","\n").replace("\\", "").replace("\"{", "{").replace("}\"", "}")
-                resp = json.loads(rvd2)
-            except Exception:
-                # self.assertTrue(False, 'unable to get resp json loads: %s \n response = (%s)' % (str(v), str(rv)))
-                resp = None
-        return resp
+    # http session ---------------------------------
+
+    def _get_session(self):
+        # One pooled session per DKCloudAPI instance, so consecutive calls reuse
+        # the same connections instead of doing a new handshake each time.
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        _import_requests()
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+        session = requests.Session()
+        # Connection errors are always retried; read errors and 502/503/504 only
+        # for idempotent methods (urllib3 default whitelist, POST is excluded).
+        retries = Retry(total=self._config.get_max_retries(),
+                        backoff_factor=self._config.get_retry_backoff(),
+                        status_forcelist=[502, 503, 504])
+        pool_size = self._config.get_pool_size()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self._config.get_keep_alive() is False:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _request(self, method, url, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = (self._config.get_connect_timeout(), self._config.get_read_timeout())
+        response = self._get_session().request(method, url, **kwargs)
+        if response.status_code == 401 and self._auth_token is not None:
+            headers = kwargs.get('headers') or dict()
+            # The server rejected our token (expired or revoked): log in again and resend once.
+            # Streamed bodies (generators) can't be sent twice.
+            if headers.get('Authorization') == 'Bearer %s' % self._auth_token \
+                    and not hasattr(kwargs.get('data'), 'next'):
+                if self._renew_token(self._auth_token) is not None:
+                    response.close()
+                    kwargs['headers'] = dict(headers)
+                    kwargs['headers'].update(self._get_common_headers())
+                    response = self._get_session().request(method, url, **kwargs)
+        return response
+
+    def _get(self, url, **kwargs):
+        return self._request('GET', url, **kwargs)
+
+    def _post(self, url, **kwargs):
+        return self._request('POST', url, **kwargs)
+
+    def _put(self, url, **kwargs):
+        return self._request('PUT', url, **kwargs)
+
+    def _delete(self, url, **kwargs):
+        return self._request('DELETE', url, **kwargs)
 
     @staticmethod
-    def _get_json_new(response):
-        if response is None or response.text is None:
-            return None
-        rvd = response.text
-        rvd2 = rvd.replace("\\", "").replace("\"{", "{").replace("}\"", "}").replace('\\"', '"')
-        try:
-            resp = json.loads(json.loads(rvd2))
-        except (ValueError, KeyError, Exception), v:
-            try:
-                # rvd2 = rvd.replace("\\", "").replace("\"{", "{").replace("}\"", "}")
-                rvd2 = rvd.replace("\\", "").replace("\"{", "{").replace("}\"", "}").replace('\\"', '"')
-                # sed -e 's/\\//' -e 's/"\"{"/"{"/' -e 's/"}\""/"}"/' -e 's/\\"/"/'
-                resp = json.loads(rvd2)
-            except Exception:
-                # self.assertTrue(False, 'unable to get resp json loads: %s \n response = (%s)' % (str(v), str(rv)))
-                resp = None
-        return resp
+    def _get_json(response):
+        return DKResponseDecoder.decode_response(response)
 
     @staticmethod
     def _valid_response(response):
@@ -154,17 +223,76 @@ class DKCloudAPI(object):
             self._auth_token = self._get_token()
         return self._auth_token
 
+    def _get_auth_token(self):
+        # Login is deferred until the first call that needs the token.
+        if self._auth_token is None:
+            with self._login_lock:
+                if self._auth_token is None:
+                    self._auth_token = self._get_token()
+                    if self._auth_token is None:
+                        raise DKLoginError('login failed')
+        return self._auth_token
+
+    def _renew_token(self, stale_token):
+        # Logs in again, unless another thread already replaced stale_token.
+        with self._login_lock:
+            if self._auth_token == stale_token:
+                token = self._login()
+                if token is None:
+                    return None
+                self._auth_token = token
+                self._set_user_role()
+                self._schedule_token_refresh(token)
+            return self._auth_token
+
+    @staticmethod
+    def _get_token_expiry(token):
+        import jwt
+        try:
+            jwt_payload = jwt.decode(jwt=token, verify=False)
+        except Exception:
+            return None
+        if 'exp' in jwt_payload:
+            try:
+                return float(jwt_payload['exp'])
+            except (ValueError, TypeError):
+                return None
+        return None
+
+    def _get_token_time_left(self, token):
+        # seconds the token can still be trusted without asking the server, None if it has no expiry
+        expiry = DKCloudAPI._get_token_expiry(token)
+        if expiry is None:
+            return None
+        return expiry - self._config.get_token_safety_margin() - time.time()
+
+    def _is_token_fresh(self, token):
+        time_left = self._get_token_time_left(token)
+        return time_left is not None and time_left > 0
+
+    def _schedule_token_refresh(self, token):
+        # Long running commands (watchers, big uploads) get a new token before the current one
+        # enters its safety margin. The timer is a daemon thread, so short commands just exit.
+        time_left = self._get_token_time_left(token)
+        if time_left is None or time_left <= 0:
+            return
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        self._refresh_timer = threading.Timer(time_left, self._renew_token, [token])
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
     def _get_common_headers(self, one_time_token=None):
         if one_time_token is not None:
             return {'Authorization': 'Bearer %s' % one_time_token}
         else:
-            return {'Authorization': 'Bearer %s' % self._auth_token}
+            return {'Authorization': 'Bearer %s' % self._get_auth_token()}
 
     def _is_token_valid(self, token):
         url = '%s/v2/validatetoken' % (self.get_url_for_direct_rest_call())
         try:
-            response = requests.get(url, headers=self._get_common_headers(token))
-        except (RequestException, ValueError, TypeError), c:
+            response = self._get(url, headers=self._get_common_headers(token))
+        except _request_errors(ValueError, TypeError), c:
             print "validatetoken: exception: %s" % str(c)
             return False
         if response is None:
@@ -189,8 +317,8 @@ class DKCloudAPI(object):
         credentials['password'] = self._config.get_password()
         url = '%s/v2/login' % (self.get_url_for_direct_rest_call())
         try:
-            response = requests.post(url, data=credentials)
-        except (RequestException, ValueError, TypeError), c:
+            response = self._post(url, data=credentials)
+        except _request_errors(ValueError, TypeError), c:
             print "login: exception: %s" % str(c)
             return None
         if DKCloudAPI._valid_response(response) is False:
@@ -215,15 +343,21 @@ class DKCloudAPI(object):
     def _get_token(self):
         # Javascript Web Tokens, handle all the
         # timeouts and whatnot that are required.
-        # We can check the time out locally, but it is better
-        # to have our server do it to ensure that the jwt hasn't
-        # been tampered with.
+        # While the token is far enough from its expiry it is trusted
+        # locally; the server still checks the signature on every call
+        # and a 401 makes us log in again (see _request).
+        # Near expiry, or without an expiry, our server validates it.
         jwt = self._config.get_jwt()
         if jwt is not None:
+            if self._is_token_fresh(jwt):
+                self._set_user_role()
+                self._schedule_token_refresh(jwt)
+                return jwt
             if self._is_token_valid(jwt):
                 self._config.set_jwt(jwt)
                 self._config.save_to_stored_file_location()
                 self._set_user_role()
+                self._schedule_token_refresh(jwt)
                 return jwt
             else:
                 pass
@@ -232,11 +366,13 @@ class DKCloudAPI(object):
         if jwt is not None:
             self._config.set_jwt(jwt)
             self._config.save_to_stored_file_location()
+            self._schedule_token_refresh(jwt)
             return jwt
         else:
             return None
 
     def _set_user_role(self):
+        import jwt
         encoded_token = self._config.get_jwt()
         try:
             jwt_payload = jwt.decode(
@@ -251,11 +387,13 @@ class DKCloudAPI(object):
             self._role = None
 
     def is_user_role(self, role):
+        self._get_auth_token()
         if self._role is None or role is None: return False
         if self._role != role: return False
         return True
 
     def get_customer_name(self):
+        self._get_auth_token()
         return self._customer_name
 
     # implementation ---------------------------------
@@ -284,9 +422,9 @@ class DKCloudAPI(object):
         rc = DKReturnCode()
         url = '%s/v2/kitchen/list' % (self.get_url_for_direct_rest_call())
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, 'list_kitchen: exception: %s' % str(c))
             return rc
         if DKCloudAPI._valid_response(response) and rdict.get('status','success') != 'success':
@@ -308,7 +446,7 @@ class DKCloudAPI(object):
             url+='?fulllist=true'
         try:
             start_time = time.time()
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'secret_list - elapsed: %d' % elapsed_recipe_status
             rdict = self._get_json(response)
@@ -318,7 +456,7 @@ class DKCloudAPI(object):
                 arc = DKAPIReturnCode(rdict, response)
                 rc.set(rc.DK_FAIL, arc.get_message())
             return rc
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "secrent_list: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -329,7 +467,7 @@ class DKCloudAPI(object):
         url = '%s/v2/secret/check/%s' % (self.get_url_for_direct_rest_call(), path)
         try:
             start_time = time.time()
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             if print_to_console: print 'secret_exists - elapsed: %d' % elapsed_recipe_status
             rdict = self._get_json(response)
@@ -339,7 +477,7 @@ class DKCloudAPI(object):
                 arc = DKAPIReturnCode(rdict, response)
                 rc.set(rc.DK_FAIL, arc.get_message())
             return rc
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "secrent_list: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -351,7 +489,7 @@ class DKCloudAPI(object):
         try:
             start_time = time.time()
             pdict = {'value':value}
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'secret_write - elapsed: %d' % elapsed_recipe_status
             rdict = self._get_json(response)
@@ -361,7 +499,7 @@ class DKCloudAPI(object):
                 arc = DKAPIReturnCode(rdict, response)
                 rc.set(rc.DK_FAIL, arc.get_message())
             return rc
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "secret_write: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -372,7 +510,7 @@ class DKCloudAPI(object):
         url = '%s/v2/secret/%s' % (self.get_url_for_direct_rest_call(), path)
         try:
             start_time = time.time()
-            response = requests.delete(url, headers=self._get_common_headers())
+            response = self._delete(url, headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'secret_write - elapsed: %d' % elapsed_recipe_status
             rdict = self._get_json(response)
@@ -382,7 +520,7 @@ class DKCloudAPI(object):
                 arc = DKAPIReturnCode(rdict, response)
                 rc.set(rc.DK_FAIL, arc.get_message())
             return rc
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "secret_delete: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -401,9 +539,9 @@ class DKCloudAPI(object):
         pdict[DKCloudAPI.MESSAGE] = message
         url = '%s/v2/kitchen/update/%s' % (self.get_url_for_direct_rest_call(), update_kitchen['name'])
         try:
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             print "update_kitchens: exception: %s" % str(c)
             return None
         if DKCloudAPI._valid_response(response) is True and rdict is not None and isinstance(rdict, dict) is True:
@@ -427,9 +565,9 @@ class DKCloudAPI(object):
         url = '%s/v2/kitchen/create/%s/%s' % (self.get_url_for_direct_rest_call(),
                                               existing_kitchen_name, new_kitchen_name)
         try:
-            response = requests.put(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._put(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, 'create_kitchens: exception: %s' % str(c))
             return rc
         if DKCloudAPI._valid_response(response):
@@ -454,9 +592,9 @@ class DKCloudAPI(object):
         pdict[DKCloudAPI.MESSAGE] = message
         url = '%s/v2/kitchen/delete/%s' % (self.get_url_for_direct_rest_call(), existing_kitchen_name)
         try:
-            response = requests.delete(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._delete(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, 'delete_kitchens: exception: %s' % str(c))
             return rc
         if DKCloudAPI._valid_response(response):
@@ -543,9 +681,9 @@ class DKCloudAPI(object):
         rc = DKReturnCode()
         url = '%s/v2/kitchen/settings/%s' % (self.get_url_for_direct_rest_call(), kitchen_name)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError) as c:
+        except _request_errors(ValueError, TypeError) as c:
             rc.set(rc.DK_FAIL, 'settings_kitchen: exception: %s' % str(c))
             return rc
         if DKCloudAPI._valid_response(response):
@@ -570,9 +708,9 @@ class DKCloudAPI(object):
         d1['message'] = msg
         url = '%s/v2/kitchen/settings/%s' % (self.get_url_for_direct_rest_call(), kitchen_name)
         try:
-            response = requests.put(url, headers=self._get_common_headers(), data=json.dumps(d1))
+            response = self._put(url, headers=self._get_common_headers(), data=json.dumps(d1))
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError) as c:
+        except _request_errors(ValueError, TypeError) as c:
             rc.set(rc.DK_FAIL, 'settings_kitchen: exception: %s' % str(c))
             return rc
         if DKCloudAPI._valid_response(response):
@@ -609,10 +747,10 @@ class DKCloudAPI(object):
         pdict[self.FILE] = file_contents
         url = '%s/v2/kitchen/settings/json/%s' % (self.get_url_for_direct_rest_call(), kitchen)
         try:
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "kitchen_settings_json_update: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -631,10 +769,10 @@ class DKCloudAPI(object):
 
         url = '%s/v2/kitchen/settings/json/%s' % (self.get_url_for_direct_rest_call(), kitchen)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "kitchen_settings_json_get: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -661,13 +799,13 @@ class DKCloudAPI(object):
         url = '%s/v2/kitchen/recipenames/%s' % (self.get_url_for_direct_rest_call(), kitchen)
         try:
             start_time = time.time()
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'list_recipe - elapsed: %d' % elapsed_recipe_status
 
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "list_recipe: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -690,13 +828,13 @@ class DKCloudAPI(object):
         url = '%s/v2/recipe/create/%s/%s' % (self.get_url_for_direct_rest_call(), kitchen, name)
         try:
             start_time = time.time()
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'list_recipe - elapsed: %d' % elapsed_recipe_status
 
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "list_recipe: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -721,13 +859,13 @@ class DKCloudAPI(object):
         url = '%s/v2/recipe/%s/%s' % (self.get_url_for_direct_rest_call(), kitchen,name)
         try:
             start_time = time.time()
-            response = requests.delete(url, headers=self._get_common_headers())
+            response = self._delete(url, headers=self._get_common_headers())
             elapsed_recipe_status = time.time() - start_time
             print 'recipe_delete - elapsed: %d' % elapsed_recipe_status
 
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "recipe_delete: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -757,12 +895,12 @@ class DKCloudAPI(object):
             if list_of_files is not None:
                 params = dict()
                 params['recipe-files'] = list_of_files
-                response = requests.post(url, data=json.dumps(params), headers=self._get_common_headers())
+                response = self._post(url, data=json.dumps(params), headers=self._get_common_headers())
             else:
-                response = requests.post(url, headers=self._get_common_headers())
+                response = self._post(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "get_recipe: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -783,6 +921,68 @@ class DKCloudAPI(object):
             rc.set(rc.DK_FAIL, arc.get_message())
             return rc
 
+    def get_recipe_streamed(self, kitchen, recipe, on_file):
+        """
+        Gets a whole recipe, handing each file to on_file as soon as it has arrived
+        instead of building the recipe in memory.
+        :param on_file: function(recipe_file_key, file_dict), e.g. ('recipe1/node1', {'filename': .., 'text': ..})
+        :rtype: DKReturnCode, the payload is the response without the file contents:
+                {'ORIG_HEAD': .., 'recipes': {recipe: {recipe_file_key: [filename, ..]}}}
+        """
+        rc = DKReturnCode()
+        if kitchen is None or isinstance(kitchen, basestring) is False:
+            rc.set(rc.DK_FAIL, 'issue with kitchen parameter')
+            return rc
+        if recipe is None or isinstance(recipe, basestring) is False:
+            rc.set(rc.DK_FAIL, 'issue with recipe parameter')
+            return rc
+        url = '%s/v2/recipe/get/%s/%s' % (self.get_url_for_direct_rest_call(),
+                                          kitchen, recipe)
+        rdict = {'recipes': {recipe: dict()}}
+        recipe_tree = rdict['recipes'][recipe]
+
+        def expand(path):
+            # walk down to the file lists of the recipe; each file is decoded on its own
+            if len(path) < 3:
+                return len(path) < 2 or path[1] == recipe
+            if len(path) == 3 and path[1] == recipe:
+                recipe_tree[path[2]] = list()
+                return True
+            return False
+
+        try:
+            response = self._post(url, headers=self._get_common_headers(), stream=True)
+            if not DKCloudAPI._valid_response(response):
+                arc = DKAPIReturnCode(self._get_json(response), response)
+                rc.set(rc.DK_FAIL, arc.get_message())
+                return rc
+            try:
+                chunks = response.iter_content(DKJsonStream.CHUNK_SIZE)
+                for path, value in DKJsonStream(chunks).iter_values(expand):
+                    if len(path) == 4 and path[1] == recipe:
+                        if isinstance(value, dict) and 'filename' in value:
+                            recipe_tree[path[2]].append(value['filename'])
+                        on_file(path[2], value)
+                    elif len(path) == 1:
+                        rdict[path[0]] = value
+            finally:
+                response.close()
+        except _request_errors(ValueError, TypeError, IOError, OSError), c:
+            s = "get_recipe: exception: %s" % str(c)
+            rc.set(rc.DK_FAIL, s)
+            return rc
+
+        if 'status' in rdict and rdict['status'] != 'success':
+            message = 'Unknown error'
+            if 'error' in rdict:
+                message = rdict['error']
+            raise Exception(message)
+        if len(recipe_tree) == 0:
+            rc.set(rc.DK_FAIL, "Unable to find recipe %s or the stated files within the recipe." % recipe)
+        else:
+            rc.set(rc.DK_SUCCESS, None, rdict)
+        return rc
+
     def update_file(self, kitchen, recipe, message, api_file_key, file_contents):
         """
         returns success or failure (True or False)
@@ -816,10 +1016,10 @@ class DKCloudAPI(object):
         url = '%s/v2/recipe/update/%s/%s' % (self.get_url_for_direct_rest_call(),
                                              kitchen, recipe)
         try:
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "update_file: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -837,6 +1037,13 @@ class DKCloudAPI(object):
         return rc
 
     def update_files(self,kitchen, recipe, message, changes):
+        """
+        Updates, creates or deletes several files in one request.
+        Changesets whose contents exceed the configured upload size are sent in several requests.
+        :param changes: dict {api_file_key: {'contents' or 'file': path on disk, 'isNew': bool}}, {} to delete
+        :rtype: DKReturnCode, payload has one entry per file, plus 'issues'. If a later request fails
+            the payload has the entries of the requests the server already committed
+        """
         rc = DKReturnCode()
         if kitchen is None or isinstance(kitchen, basestring) is False:
             rc.set(rc.DK_FAIL, 'issue with kitchen parameter')
@@ -844,17 +1051,55 @@ class DKCloudAPI(object):
         if recipe is None or isinstance(recipe, basestring) is False:
             rc.set(rc.DK_FAIL, 'issue with recipe parameter')
             return rc
-        pdict = dict()
-        pdict[self.MESSAGE] = message
-        pdict[self.FILES] = changes
 
+        batches = DKUploadBody.split_changes(changes, self._config.get_max_upload_size())
+        rdict_all = dict()
+        rdict_all['issues'] = list()
+        for batch_number, batch in enumerate(batches, 1):
+            if len(batches) > 1:
+                batch_message = '%s (part %d of %d)' % (message, batch_number, len(batches))
+            else:
+                batch_message = message
+            try:
+                rc = self._update_files_request(kitchen, recipe, batch_message, batch)
+            except Exception, e:
+                # an error reported by the server, the parts before it are still committed
+                rc = DKReturnCode()
+                rc.set(rc.DK_FAIL, str(e))
+            if not rc.ok():
+                if batch_number > 1:
+                    rc.set(rc.DK_FAIL, '%s\nparts 1 to %d of %d were committed' %
+                           (rc.get_message(), batch_number - 1, len(batches)), rdict_all)
+                return rc
+            rdict = rc.get_payload()
+            for key, value in rdict.iteritems():
+                if key == 'issues':
+                    rdict_all['issues'].extend(value)
+                else:
+                    rdict_all[key] = value
+        rc.set(rc.DK_SUCCESS, None, rdict_all)
+        return rc
+
+    def _update_files_request(self, kitchen, recipe, message, changes):
+        rc = DKReturnCode()
         url = '%s/v2/recipe/update/%s/%s' % (self.get_url_for_direct_rest_call(),
                                              kitchen, recipe)
+        headers = self._get_common_headers()
+        headers['Content-Type'] = 'application/json'
         try:
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            # the files are read, decoded and escaped while the body is built or sent
+            body = DKUploadBody.iter_json(message, changes)
+            if self._config.get_stream_uploads():
+                # gzip compressed, sent with chunked transfer encoding as it is produced
+                headers['Content-Encoding'] = 'gzip'
+                data = DKUploadBody.gzip(body)
+            else:
+                # the whole body is held in memory
+                data = ''.join(body)
+            response = self._post(url, data=data, headers=headers)
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(UnicodeError, ValueError, TypeError), c:
             s = "update_file: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -903,10 +1148,10 @@ class DKCloudAPI(object):
         pdict[self.FILE] = file_contents
         url = '%s/v2/recipe/create/%s/%s' % (self.get_url_for_direct_rest_call(), kitchen, recipe)
         try:
-            response = requests.put(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._put(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "add_file: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -946,10 +1191,10 @@ class DKCloudAPI(object):
         url = '%s/v2/recipe/delete/%s/%s' % (self.get_url_for_direct_rest_call(),
                                              kitchen, recipe)
         try:
-            response = requests.delete(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._delete(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "delete_file: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -974,10 +1219,10 @@ class DKCloudAPI(object):
         url = '%s/v2/servings/compiled/get/%s/%s/%s' % (self.get_url_for_direct_rest_call(),
                                                         kitchen, recipe_name, variation_name)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, "get_compiled_serving: exception: %s" % str(c))
             return rc
         if DKCloudAPI._valid_response(response) and 'status' in rdict and rdict['status'] != 'success':
@@ -1012,10 +1257,10 @@ class DKCloudAPI(object):
             data = {
                 'file': file_data
             }
-            response = requests.post(url, data=json.dumps(data), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(data), headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, "get_compiled_file: exception: %s" % str(c))
             return rc
         if DKCloudAPI._valid_response(response) and 'status' in rdict and rdict['status'] != 'success':
@@ -1034,7 +1279,7 @@ class DKCloudAPI(object):
     def get_file(self, kitchen, recipe, file_path):
         rc = DKReturnCode()
         url = '%s/v2/recipe/file/%s/%s/%s' % (self.get_url_for_direct_rest_call(), kitchen, recipe, file_path)
-        response = requests.get(url, headers=self._get_common_headers())
+        response = self._get(url, headers=self._get_common_headers())
         rdict = self._get_json(response)
         if DKCloudAPI._valid_response(response) and 'status' in rdict and rdict['status'] != 'success':
             message = 'Unknown error'
@@ -1061,10 +1306,10 @@ class DKCloudAPI(object):
                                                         kitchen, recipe_name, file_path,change_count)
 
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, "get_compiled_file: exception: %s" % str(c))
             return rc
 
@@ -1094,10 +1339,10 @@ class DKCloudAPI(object):
                 'files': changed_files
             }
 
-            response = requests.post(url, headers=self._get_common_headers(),data=json.dumps(payload))
+            response = self._post(url, headers=self._get_common_headers(),data=json.dumps(payload))
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set(rc.DK_FAIL, "get_compiled_serving: exception: %s" % str(c))
             return rc
         if DKCloudAPI._valid_response(response) and 'status' in rdict and rdict['status'] != 'success':
@@ -1123,7 +1368,7 @@ class DKCloudAPI(object):
         :rtype: dict
         """
         url = '%s/v2/kitchen/merge/%s/%s' % (self.get_url_for_direct_rest_call(), from_kitchen, to_kitchen)
-        response = requests.get(url, headers=self._get_common_headers())
+        response = self._get(url, headers=self._get_common_headers())
         if not DKCloudAPI._valid_response(response):
             message = None
             if response is not None:
@@ -1152,7 +1397,7 @@ class DKCloudAPI(object):
         url = '%s/v2/kitchen/manualmerge/%s/%s' % (self.get_url_for_direct_rest_call(), from_kitchen, to_kitchen)
 
         pdict = {'files': resolved_conflicts}
-        response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+        response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
 
         if not DKCloudAPI._valid_response(response):
             raise Exception("kitchen_merge_manual: call to backend failed.\n%s\n" % response['error'])
@@ -1186,11 +1431,11 @@ class DKCloudAPI(object):
             if resolved_conflicts is not None and len(resolved_conflicts) > 0:
                 data = dict()
                 data['resolved_conflicts'] = resolved_conflicts
-                response = requests.post(url, data=json.dumps(data), headers=self._get_common_headers())
+                response = self._post(url, data=json.dumps(data), headers=self._get_common_headers())
             else:
-                response = requests.post(url, headers=self._get_common_headers())
+                response = self._post(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             rc.set("merge_kitchens: exception: %s" % str(c))
             return rc
         if DKCloudAPI._valid_response(response):
@@ -1231,9 +1476,9 @@ class DKCloudAPI(object):
         adjusted_file_path = file_path
         url = '%s/v2/file/merge/%s/%s/%s' % (self.get_url_for_direct_rest_call(), kitchen, recipe, adjusted_file_path)
         try:
-            response = requests.post(url, data=json.dumps(params), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(params), headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             print "merge_file: exception: %s" % str(c)
             return None
         if DKCloudAPI._valid_response(response) is True and rdict is not None and isinstance(rdict, dict) is True:
@@ -1244,13 +1489,14 @@ class DKCloudAPI(object):
             return rc
 
     # returns a recipe
-    def recipe_status(self, kitchen, recipe, local_dir=None):
+    def recipe_status(self, kitchen, recipe, local_dir=None, local_sha=None):
         """
         gets the status of a recipe
         :param self: DKCloudAPI
         :param kitchen: string
         :param recipe: string
         :param local_dir: string --
+        :param local_sha: dict -- directory sha of local_dir, if the caller already scanned it
         :rtype: dict
         """
         rc = DKReturnCode()
@@ -1260,38 +1506,57 @@ class DKCloudAPI(object):
         if recipe is None or isinstance(recipe, basestring) is False:
             rc.set(rc.DK_FAIL, 'issue with recipe parameter')
             return rc
+        if local_dir is None:
+            check_path = os.getcwd()
+        else:
+            if os.path.isdir(local_dir) is False:
+                print 'Local path %s does not exist' % local_dir
+                return None
+            else:
+                check_path = local_dir
+
+        # The remote tree from the last call is kept in the recipe meta dir. If the server says it has not
+        # changed (304) we compare against it instead of downloading it again.
+        cached_etag, cached_tree = DKRecipeDisk.load_remote_tree(check_path, kitchen, recipe)
+        headers = self._get_common_headers()
+        if cached_etag is not None:
+            headers['If-None-Match'] = cached_etag
+
         url = '%s/v2/recipe/tree/%s/%s' % (self.get_url_for_direct_rest_call(),
                                            kitchen, recipe)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
-            rdict = self._get_json(response)
-            pass
-        except (RequestException, ValueError, TypeError), c:
+            response = self._get(url, headers=headers)
+            not_modified = response.status_code == 304 and cached_tree is not None and \
+                response.headers.get('ETag', cached_etag) == cached_etag
+            if response.status_code == 304 and not not_modified:
+                # the 304 is not for the saved tree, ask for the whole tree
+                headers.pop('If-None-Match', None)
+                response = self._get(url, headers=headers)
+            if not not_modified:
+                rdict = self._get_json(response)
+        except _request_errors(ValueError, TypeError), c:
             s = "get_recipe: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
-        if DKCloudAPI._valid_response(response):
-            # Now get the local sha.
-            if local_dir is None:
-                check_path = os.getcwd()
-            else:
-                if os.path.isdir(local_dir) is False:
-                    print 'Local path %s does not exist' % local_dir
-                    return None
-                else:
-                    check_path = local_dir
-            local_sha = get_directory_sha(check_path)
-
+        if not_modified:
+            remote_sha = cached_tree
+        elif DKCloudAPI._valid_response(response):
             if recipe not in rdict['recipes']:
                 raise Exception('Recipe %s does not exist.' % recipe)
 
             remote_sha = rdict['recipes'][recipe]
-
-            rv = compare_sha(remote_sha, local_sha)
-            rc.set(rc.DK_SUCCESS, None, rv)
+            DKRecipeDisk.save_remote_tree(check_path, kitchen, recipe, response.headers.get('ETag'), remote_sha)
         else:
             arc = DKAPIReturnCode(rdict, response)
             rc.set(rc.DK_FAIL, arc.get_message())
+            return rc
+
+        # Now get the local sha.
+        if local_sha is None:
+            local_sha = get_directory_sha(check_path)
+
+        rv = compare_sha(remote_sha, local_sha)
+        rc.set(rc.DK_SUCCESS, None, rv)
         return rc
 
     # returns a recipe
@@ -1313,10 +1578,10 @@ class DKCloudAPI(object):
         url = '%s/v2/recipe/tree/%s/%s' % (self.get_url_for_direct_rest_call(),
                                            kitchen, recipe)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "recipe_tree: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1362,10 +1627,10 @@ class DKCloudAPI(object):
                                                               kitchen, recipe_name, variation_name, node_name)
 
         try:
-            response = requests.put(url, headers=self._get_common_headers())
+            response = self._put(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "create_order: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1400,9 +1665,9 @@ class DKCloudAPI(object):
 
         url = '%s/v2/order/resume/%s' % (self.get_url_for_direct_rest_call(), orderrun_id2)
         try:
-            response = requests.put(url, headers=self._get_common_headers())
+            response = self._put(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "orderrun_delete: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1424,6 +1689,10 @@ class DKCloudAPI(object):
     def orderrun_detail(self, kitchen, pdict, return_all_data=False):
         """
         api.add_resource(OrderDetailsV2, '/v2/order/details/<string:kitchenname>', methods=['POST'])
+
+        If pdict has a serving_mesos_id (order run id) or serving_chronos_id (order id), the server is asked
+        for just the matching servings. Older servers ignore it and send every serving of the kitchen,
+        so the list is filtered here as well.
         :param self: DKCloudAPI
         :param kitchen: string
         :param pdict: dict
@@ -1437,13 +1706,13 @@ class DKCloudAPI(object):
         url = '%s/v2/order/details/%s' % (self.get_url_for_direct_rest_call(),
                                           kitchen)
         try:
-            response = requests.post(url, data=json.dumps(pdict), headers=self._get_common_headers())
+            response = self._post(url, data=json.dumps(pdict), headers=self._get_common_headers())
             rdict = self._get_json(response)
             if False:
                 import pickle
                 pickle.dump(rdict, open("files/orderrun_detail.p", "wb"))
             pass
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "orderrun_detail: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1455,6 +1724,8 @@ class DKCloudAPI(object):
             rc.set(rc.DK_FAIL, message)
             return rc
         elif DKCloudAPI._valid_response(response):
+            if 'servings' in rdict:
+                rdict['servings'] = DKCloudAPI._filter_servings(rdict['servings'], pdict)
             if return_all_data is False:
                 rc.set(rc.DK_SUCCESS, None, rdict['servings'])
             else:
@@ -1465,6 +1736,15 @@ class DKCloudAPI(object):
             rc.set(rc.DK_FAIL, arc.get_message())
             return rc
 
+    @staticmethod
+    def _filter_servings(servings, pdict):
+        if not isinstance(servings, list):
+            return servings
+        for key in [DKCloudAPI.ORDER_RUN_ID, DKCloudAPI.ORDER_ID]:
+            if key in pdict:
+                return [serving for serving in servings if isinstance(serving, dict) and serving.get(key) == pdict[key]]
+        return servings
+
     def list_order(self, kitchen, order_count=5, order_run_count=3, start=0, recipe=None, save_to_file=None):
         """
         List the orders for a kitchen or recipe
@@ -1479,10 +1759,10 @@ class DKCloudAPI(object):
         else:
             url = '%s/v2/order/status/%s?start=%d&count=%d&scount=%d' % (self.get_url_for_direct_rest_call(), kitchen, start, order_count, order_run_count)
         try:
-            response = requests.get(url, headers=self._get_common_headers())
+            response = self._get(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             pass
-        except (RequestException, ValueError, TypeError), c:
+        except _request_errors(ValueError, TypeError), c:
             s = "get_recipe: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1497,6 +1777,41 @@ class DKCloudAPI(object):
             rc.set(rc.DK_SUCCESS, None, rdict)
         return rc
 
+    def iter_orders(self, kitchen, page_size=None, order_run_count=3, start=0, recipe=None):
+        """
+        Lazily pages through all the orders of a kitchen (or recipe) with list_order.
+        The next page is fetched in the background while the current one is consumed.
+        Raises an Exception if a page can't be fetched.
+        :param page_size: int, orders per request. Defaults to the configured page size
+        :return: generator of (order dict, list of its servings)
+        """
+        from multiprocessing.pool import ThreadPool
+        if page_size is None:
+            page_size = self._config.get_order_page_size()
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self.list_order, (kitchen, page_size, order_run_count, start, recipe))
+            while pending is not None:
+                rc = pending.get()
+                if not rc.ok():
+                    raise Exception(rc.get_message())
+                payload = rc.get_payload()
+                orders = payload.get('orders') or list()
+                start += len(orders)
+                if len(orders) < page_size:
+                    pending = None
+                else:
+                    pending = pool.apply_async(self.list_order, (kitchen, page_size, order_run_count, start, recipe))
+                servings = payload.get('servings') or dict()
+                for order in orders:
+                    order_id = order.get('serving_chronos_id')
+                    if order_id in servings:
+                        yield order, servings[order_id]['servings']
+                    else:
+                        yield order, list()
+        finally:
+            pool.terminate()
+
     def order_delete_all(self, kitchen):
         """
         api.add_resource(OrderDeleteAllV2, '/v2/order/deleteall/<string:kitchenname>', methods=['DELETE'])
@@ -1511,9 +1826,9 @@ class DKCloudAPI(object):
         url = '%s/v2/order/deleteall/%s' % (self.get_url_for_direct_rest_call(),
                                             kitchen)
         try:
-            response = requests.delete(url, headers=self._get_common_headers())
+            response = self._delete(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "order_delete_all: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1540,9 +1855,9 @@ class DKCloudAPI(object):
         url = '%s/v2/order/delete/%s' % (self.get_url_for_direct_rest_call(),
                                          order_id2)
         try:
-            response = requests.delete(url, headers=self._get_common_headers())
+            response = self._delete(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "order_delete_one: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1569,7 +1884,7 @@ class DKCloudAPI(object):
         orderrun_id2 = urllib.quote(orderrun_id)
         url = '%s/v2/serving/delete/%s' % (self.get_url_for_direct_rest_call(), orderrun_id2)
         try:
-            response = requests.delete(url, headers=self._get_common_headers())
+            response = self._delete(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
             if DKCloudAPI._valid_response(response):
                 rc.set(rc.DK_SUCCESS, None, None)
@@ -1578,7 +1893,7 @@ class DKCloudAPI(object):
                 arc = DKAPIReturnCode(rdict, response)
                 rc.set(rc.DK_FAIL, arc.get_message())
                 return rc
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "orderrun_delete: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1599,9 +1914,9 @@ class DKCloudAPI(object):
         url = '%s/v2/order/stop/%s' % (self.get_url_for_direct_rest_call(),
                                        order_id2)
         try:
-            response = requests.put(url, headers=self._get_common_headers())
+            response = self._put(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "order_stop: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -1629,9 +1944,9 @@ class DKCloudAPI(object):
         url = '%s/v2/serving/stop/%s' % (self.get_url_for_direct_rest_call(),
                                          orderrun_id2)
         try:
-            response = requests.put(url, headers=self._get_common_headers())
+            response = self._put(url, headers=self._get_common_headers())
             rdict = self._get_json(response)
-        except (RequestException, ValueError), c:
+        except _request_errors(ValueError), c:
             s = "order_stop: exception: %s" % str(c)
             rc.set(rc.DK_FAIL, s)
             return rc
@@ -55,3 +55,16 @@ class DKCloudAPIMock(DKCloudAPI):
 
     def delete_kitchen(self, existing_kitchen_name, message):
         return True
+
+    def orderrun_detail(self, kitchen, pdict, return_all_data=False):
+        rc = DKReturnCode()
+        serving = {'serving_chronos_id': 'DKRecipe#dk#simple#variation1#%s#1' % kitchen,
+                   'serving_mesos_id': 'ct:1500000000000:DKRecipe#dk#simple#variation1#%s#1' % kitchen,
+                   'status': 'COMPLETED_SERVING',
+                   'log': {'lines': ['first log line', 'second log line']}}
+        if 'summary' in pdict:
+            serving['summary'] = {'name': 'simple', 'start-time': 1500000000000, 'total-recipe-time': 61000,
+                                  'node1': {'status': 'DKNodeStatus_completed_production'},
+                                  'node2': {'status': 'DKNodeStatus_completed_production'}}
+        rc.set(rc.DK_SUCCESS, None, [serving])
+        return rc
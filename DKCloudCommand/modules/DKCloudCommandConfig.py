@@ -1,5 +1,6 @@
 import json
 import os
+from distutils.util import strtobool
 
 __author__ = 'DataKitchen, Inc.'
 
@@ -15,7 +16,35 @@ class DKCloudCommandConfig(object):
     DK_CLOUD_FILE_LOCATION = 'dk-cloud-file-location'
     DK_CLOUD_MERGE_TOOL = 'dk-cloud-merge-tool'
     DK_CLOUD_DIFF_TOOL = 'dk-cloud-diff-tool'
+    DK_CLOUD_POOL_SIZE = 'dk-cloud-pool-size'
+    DK_CLOUD_KEEP_ALIVE = 'dk-cloud-keep-alive'
+    DK_CLOUD_CONNECT_TIMEOUT = 'dk-cloud-connect-timeout'
+    DK_CLOUD_READ_TIMEOUT = 'dk-cloud-read-timeout'
+    DK_CLOUD_MAX_RETRIES = 'dk-cloud-max-retries'
+    DK_CLOUD_RETRY_BACKOFF = 'dk-cloud-retry-backoff'
+    DK_CLOUD_MAX_WORKERS = 'dk-cloud-max-workers'
+    DK_CLOUD_STREAM_UPLOADS = 'dk-cloud-stream-uploads'
+    DK_CLOUD_MAX_UPLOAD_SIZE = 'dk-cloud-max-upload-size'
+    DK_CLOUD_TOKEN_SAFETY_MARGIN = 'dk-cloud-token-safety-margin'
+    DK_CLOUD_VERSION_CHECK = 'dk-cloud-version-check'
+    DK_CLOUD_VERSION_CHECK_TTL = 'dk-cloud-version-check-ttl'
+    DK_CLOUD_ORDER_PAGE_SIZE = 'dk-cloud-order-page-size'
+    DK_CLOUD_ORDER_CACHE_MAX_AGE = 'dk-cloud-order-cache-max-age'
+    DK_CLOUD_ORDER_CACHE_MAX_RUNS = 'dk-cloud-order-cache-max-runs'
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_CONNECT_TIMEOUT = 10
+    DEFAULT_READ_TIMEOUT = 300
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_RETRY_BACKOFF = 0.5
+    DEFAULT_MAX_WORKERS = 8
+    DEFAULT_MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+    DEFAULT_TOKEN_SAFETY_MARGIN = 300
+    DEFAULT_VERSION_CHECK_TTL = 24 * 60 * 60
+    DEFAULT_ORDER_PAGE_SIZE = 50
+    DEFAULT_ORDER_CACHE_MAX_AGE = 180
+    DEFAULT_ORDER_CACHE_MAX_RUNS = 100000
     MERGE_DIR = 'merges'
+    ORDER_CACHE_FILE = 'order_cache.db'
     DIFF_DIR = 'diffs'
 
     def __init__(self):
@@ -107,6 +136,112 @@ class DKCloudCommandConfig(object):
                 configuration and \'dk config\' to change it.')
         return self._config_dict[DKCloudCommandConfig.DK_CLOUD_DIFF_TOOL]
 
+    def get_pool_size(self):
+        if DKCloudCommandConfig.DK_CLOUD_POOL_SIZE in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_POOL_SIZE])
+        else:
+            return DKCloudCommandConfig.DEFAULT_POOL_SIZE
+
+    def _get_bool(self, key, default):
+        # hand edited config files may hold "true"/"false", "yes"/"no", "1"/"0" instead of json booleans
+        if key not in self._config_dict or self._config_dict[key] is None:
+            return default
+        value = self._config_dict[key]
+        if isinstance(value, basestring):
+            try:
+                return bool(strtobool(value.strip()))
+            except ValueError:
+                return default
+        return bool(value)
+
+    def get_keep_alive(self):
+        return self._get_bool(DKCloudCommandConfig.DK_CLOUD_KEEP_ALIVE, True)
+
+    def get_connect_timeout(self):
+        if DKCloudCommandConfig.DK_CLOUD_CONNECT_TIMEOUT in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_CONNECT_TIMEOUT])
+        else:
+            return DKCloudCommandConfig.DEFAULT_CONNECT_TIMEOUT
+
+    def get_read_timeout(self):
+        if DKCloudCommandConfig.DK_CLOUD_READ_TIMEOUT in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_READ_TIMEOUT])
+        else:
+            return DKCloudCommandConfig.DEFAULT_READ_TIMEOUT
+
+    def get_max_retries(self):
+        if DKCloudCommandConfig.DK_CLOUD_MAX_RETRIES in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_MAX_RETRIES])
+        else:
+            return DKCloudCommandConfig.DEFAULT_MAX_RETRIES
+
+    def get_retry_backoff(self):
+        if DKCloudCommandConfig.DK_CLOUD_RETRY_BACKOFF in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_RETRY_BACKOFF])
+        else:
+            return DKCloudCommandConfig.DEFAULT_RETRY_BACKOFF
+
+    def get_max_workers(self):
+        if DKCloudCommandConfig.DK_CLOUD_MAX_WORKERS in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_MAX_WORKERS])
+        else:
+            return DKCloudCommandConfig.DEFAULT_MAX_WORKERS
+
+    def get_stream_uploads(self):
+        # needs a server that accepts gzip encoded, chunked request bodies;
+        # without it each update_files request body is built in memory (up to dk-cloud-max-upload-size)
+        return self._get_bool(DKCloudCommandConfig.DK_CLOUD_STREAM_UPLOADS, False)
+
+    def get_max_upload_size(self):
+        if DKCloudCommandConfig.DK_CLOUD_MAX_UPLOAD_SIZE in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_MAX_UPLOAD_SIZE])
+        else:
+            return DKCloudCommandConfig.DEFAULT_MAX_UPLOAD_SIZE
+
+    def get_token_safety_margin(self):
+        # seconds before the jwt expires in which it is no longer trusted without asking the server
+        if DKCloudCommandConfig.DK_CLOUD_TOKEN_SAFETY_MARGIN in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_TOKEN_SAFETY_MARGIN])
+        else:
+            return DKCloudCommandConfig.DEFAULT_TOKEN_SAFETY_MARGIN
+
+    def get_version_check(self):
+        # set to false on machines without access to pypi
+        return self._get_bool(DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK, True)
+
+    def get_version_check_ttl(self):
+        # seconds between two checks for a new version
+        if DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK_TTL in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK_TTL])
+        else:
+            return DKCloudCommandConfig.DEFAULT_VERSION_CHECK_TTL
+
+    def get_order_page_size(self):
+        # orders fetched per request when paging through the order list
+        if DKCloudCommandConfig.DK_CLOUD_ORDER_PAGE_SIZE in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_ORDER_PAGE_SIZE])
+        else:
+            return DKCloudCommandConfig.DEFAULT_ORDER_PAGE_SIZE
+
+    def get_order_cache_max_age(self):
+        # days an order run is kept in the local order cache
+        if DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_AGE in self._config_dict:
+            return float(self._config_dict[DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_AGE])
+        else:
+            return DKCloudCommandConfig.DEFAULT_ORDER_CACHE_MAX_AGE
+
+    def get_order_cache_max_runs(self):
+        # order runs kept in the local order cache, the oldest ones go first
+        if DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_RUNS in self._config_dict:
+            return int(self._config_dict[DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_RUNS])
+        else:
+            return DKCloudCommandConfig.DEFAULT_ORDER_CACHE_MAX_RUNS
+
+    def get_order_cache_file(self):
+        if self._dk_temp_folder is None:
+            return None
+        return self._dk_temp_folder + '/' + DKCloudCommandConfig.ORDER_CACHE_FILE
+
     def get_merge_dir(self):
         return self._dk_temp_folder + '/' + DKCloudCommandConfig.MERGE_DIR
 
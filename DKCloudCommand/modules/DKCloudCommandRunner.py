@@ -4,21 +4,23 @@ import json
 import base64
 import zlib
 from DKCloudAPI import DKCloudAPI
-from DKRecipeDisk import DKRecipeDisk, IGNORED_FILES
+from DKRecipeDisk import DKRecipeDisk, DKRecipeMaterializer, DKConflictsStore, IGNORED_FILES, scan_recipe_dir
 from DKKitchenDisk import DKKitchenDisk, DK_DIR
 from DKReturnCode import *
 from DKIgnore import DKIgnore
 from DKActiveServingWatcher import DKActiveServingWatcherSingleton
 from DKActiveServingWatcher import DKActiveServingWatcher
-import jwt
+from DKActiveServingWatcher import DK_OUTPUT_TEXT
 import sys
 import click
 import pprint
 from prettytable import PrettyTable, PLAIN_COLUMNS, MSWORD_FRIENDLY
 from datetime import datetime, timedelta
 import time
-from jinja2 import Template
+import fnmatch
+from multiprocessing.pool import ThreadPool
 from DKFileUtils import DKFileUtils
+from DKOrderCache import DKOrderCache
 
 __author__ = 'DataKitchen, Inc.'
 
@@ -246,8 +248,9 @@ class DKCloudCommandRunner(object):
     @staticmethod
     @check_api_param_decorator
     def user_info(dk_api):
+        import jwt
         rc = DKReturnCode()
-        encoded_token = dk_api.login()
+        encoded_token = dk_api.login(force_login=False)
         try:
             jwt_payload = jwt.decode(
                 jwt=encoded_token,
@@ -279,7 +282,7 @@ class DKCloudCommandRunner(object):
 
     @staticmethod
     @check_api_param_decorator
-    def get_kitchen(dk_api, kitchen_name, root_dir, recipes=None, get_all_recipes=False):
+    def get_kitchen(dk_api, kitchen_name, root_dir, recipes=None, get_all_recipes=False, max_workers=None):
         rc = DKReturnCode()
         msg_with_status = ''
         if kitchen_name is None or len(kitchen_name) == 0:
@@ -319,8 +322,20 @@ class DKCloudCommandRunner(object):
             recipes_to_get = None
 
         if recipes_to_get is not None:
-            for recipe in recipes_to_get:
-                rc = DKCloudCommandRunner.get_recipe(dk_api, kitchen_name, recipe, os.path.join(root_dir, kitchen_name))
+            # Each recipe goes to its own folder, so they can be fetched in parallel. The messages are
+            # put together in the order of recipes_to_get.
+            if max_workers is None:
+                max_workers = dk_api.get_config().get_max_workers()
+            # while the recipes run in parallel each one writes its files with a single thread,
+            # so there are at most max_workers threads and not max_workers squared
+            recipe_workers = 1 if max_workers > 1 and len(recipes_to_get) > 1 else None
+
+            def get_one_recipe(recipe):
+                return DKCloudCommandRunner.get_recipe(dk_api, kitchen_name, recipe, os.path.join(root_dir, kitchen_name),
+                                                       max_workers=recipe_workers)
+
+            recipe_rcs = DKCloudCommandRunner._run_in_pool(get_one_recipe, list(recipes_to_get), max_workers)
+            for rc in recipe_rcs:
                 rv = rc.get_message()
                 if not rc.ok():
                     rc.set(rc.DK_FAIL, rv)
@@ -524,7 +539,8 @@ class DKCloudCommandRunner(object):
 
     @staticmethod
     @check_api_param_decorator
-    def get_recipe(dk_api, kitchen, recipe_name_param, start_dir=None, force=False):
+    def get_recipe(dk_api, kitchen, recipe_name_param, start_dir=None, force=False, max_workers=None):
+        # max_workers: threads for this recipe's files, None for the configured number
         rc = DKReturnCode()
         try:
             if start_dir is None:
@@ -561,7 +577,7 @@ class DKCloudCommandRunner(object):
                                                                                        recipe_name_param,
                                                                                        recipe_path,
                                                                                        rl['different'],
-                                                                                       force)
+                                                                                       force, max_workers)
                     if not status:
                         diffs_no_recipe = list()
                         for diff in rl['different']:
@@ -664,39 +680,42 @@ class DKCloudCommandRunner(object):
 
                     merged_file_count = 0
                     conflicted_file_count = 0
-                    for merged_folder, folder_contents in merged_different_files.iteritems():
-                        for merged_file in folder_contents:
-                            # conflict_key = '%s|%s|%s|%s|%s' % (
-                            # conflict_info['from_kitchen'], conflict_info['to_kitchen'], recipe_name,
-                            # folder_in_recipe, conflict_info['filename'])
-                            #
-                            # conflict_for_save = conflict_info.copy()
-                            # conflict_for_save['folder_in_recipe'] = folder_in_recipe
-                            # conflict_for_save['status'] = 'unresolved'
-                            conflict_info = dict()
-                            if 'text' in merged_file:
-                                conflict_info['conflict_tags'] = merged_file['text']
-                            elif 'json' in merged_file:
-                                conflict_info['conflict_tags'] = merged_file['json']
-                            elif 'content' in merged_file:
-                                conflict_info['conflict_tags'] = merged_file['content']
-
-                            merged_file_path = os.path.join(os.sep.join(merged_folder.split(os.sep)[1:]), merged_file['filename'])
-                            if force:
-                                merged_files_msg += "Getting from remote '%s'\n" % merged_file_path
-                            else:
-                                    merged_files_msg += "Auto-merging '%s'\n" % merged_file_path
-                            merged_file_count += 1
-                            if '<<<<<<<' in conflict_info['conflict_tags'] and '=======' in conflict_info['conflict_tags'] \
-                                    and '>>>>>>>' in conflict_info['conflict_tags']:
-                                conflicted_file_count += 1
-                                conflict_info['filename'] = os.path.basename(merged_file['filename'])
-                                conflict_info['from_kitchen'] = kitchen
-                                conflict_info['sha'] = 'none'
-                                conflict_info['to_kitchen'] = kitchen
-                                DKRecipeDisk.add_conflict_to_conflicts_meta(conflict_info, merged_folder, recipe_name_param,
-                                                                            rp)
-                                merged_files_msg += "CONFLICT (content): Merge conflict in %s\n" % merged_file_path
+                    conflicts_store = DKConflictsStore(DKKitchenDisk.get_recipe_meta_dir(recipe_name_param, rp))
+                    try:
+                        for merged_folder, folder_contents in merged_different_files.iteritems():
+                            for merged_file in folder_contents:
+                                # conflict_key = '%s|%s|%s|%s|%s' % (
+                                # conflict_info['from_kitchen'], conflict_info['to_kitchen'], recipe_name,
+                                # folder_in_recipe, conflict_info['filename'])
+                                #
+                                # conflict_for_save = conflict_info.copy()
+                                # conflict_for_save['folder_in_recipe'] = folder_in_recipe
+                                # conflict_for_save['status'] = 'unresolved'
+                                conflict_info = dict()
+                                if 'text' in merged_file:
+                                    conflict_info['conflict_tags'] = merged_file['text']
+                                elif 'json' in merged_file:
+                                    conflict_info['conflict_tags'] = merged_file['json']
+                                elif 'content' in merged_file:
+                                    conflict_info['conflict_tags'] = merged_file['content']
+
+                                merged_file_path = os.path.join(os.sep.join(merged_folder.split(os.sep)[1:]), merged_file['filename'])
+                                if force:
+                                    merged_files_msg += "Getting from remote '%s'\n" % merged_file_path
+                                else:
+                                        merged_files_msg += "Auto-merging '%s'\n" % merged_file_path
+                                merged_file_count += 1
+                                if '<<<<<<<' in conflict_info['conflict_tags'] and '=======' in conflict_info['conflict_tags'] \
+                                        and '>>>>>>>' in conflict_info['conflict_tags']:
+                                    conflicted_file_count += 1
+                                    conflict_info['filename'] = os.path.basename(merged_file['filename'])
+                                    conflict_info['from_kitchen'] = kitchen
+                                    conflict_info['sha'] = 'none'
+                                    conflict_info['to_kitchen'] = kitchen
+                                    conflicts_store.add(conflict_info, merged_folder, recipe_name_param)
+                                    merged_files_msg += "CONFLICT (content): Merge conflict in %s\n" % merged_file_path
+                    finally:
+                        conflicts_store.flush()
 
                 if len(delete_msg) > 0:
                     msg += delete_msg + '\n'
@@ -710,7 +729,7 @@ class DKCloudCommandRunner(object):
                 rc.set(DKReturnCode.DK_SUCCESS, msg)
                 return rc
             else:
-                rc = DKCloudCommandRunner._get_recipe_new(dk_api, kitchen, recipe_name_param, rp)
+                rc = DKCloudCommandRunner._get_recipe_new(dk_api, kitchen, recipe_name_param, rp, max_workers)
             return rc
         except Exception as e:
             rc.set(rc.DK_FAIL, e.message)
@@ -782,32 +801,54 @@ class DKCloudCommandRunner(object):
         return all(part1 == part2 for part1, part2 in zip(sub_parts, parent_parts))
 
     @staticmethod
-    def _merge_files(dk_api, kitchen_name, recipe_name, recipe_path, differences, force_remote_file=False):
-        merged_files = dict()
-        status = True
+    def _run_in_pool(func, items, max_workers):
+        # Runs func over items on a bounded thread pool. Results are returned in the order of items,
+        # regardless of the order in which the workers finish.
+        if max_workers is None or max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(max_workers, len(items)))
+        try:
+            # map_async().get() with a timeout keeps Ctrl-C working on python 2
+            return pool.map_async(func, items).get(sys.maxint)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def _merge_files(dk_api, kitchen_name, recipe_name, recipe_path, differences, force_remote_file=False,
+                     max_workers=None):
+        file_list = list()
         for folder_name, folder_contents in differences.iteritems():
             for this_file in folder_contents:
-                if force_remote_file:
-                    file_path = os.path.join(os.sep.join(folder_name.split(os.sep)[1:]), this_file['filename'])
-                    file_contents = dk_api.get_file(kitchen_name, recipe_name, file_path)
-                    if folder_name not in merged_files:
-                        merged_files[folder_name] = list()
-                    this_file['text'] = file_contents
-                    merged_files[folder_name].append(this_file)
-                else:
-                    rc = DKCloudCommandRunner._merge_file(dk_api, kitchen_name, recipe_name, recipe_path, folder_name,
-                                                          this_file)
-                    if rc.ok():
-                        payload = rc.get_payload()
-                        if payload['status'] == 'success':
-                            if folder_name not in merged_files:
-                                merged_files[folder_name] = list()
-                            this_file['text'] = base64.b64decode(payload['merged_content'])
-                            merged_files[folder_name].append(this_file)
-                        else:
-                            status = False
-                    else:
-                        status = False
+                file_list.append((folder_name, this_file))
+
+        def fetch_file(item):
+            folder_name, this_file = item
+            if force_remote_file:
+                file_path = os.path.join(os.sep.join(folder_name.split(os.sep)[1:]), this_file['filename'])
+                return True, dk_api.get_file(kitchen_name, recipe_name, file_path)
+            rc = DKCloudCommandRunner._merge_file(dk_api, kitchen_name, recipe_name, recipe_path, folder_name,
+                                                  this_file)
+            if rc is not None and rc.ok():
+                payload = rc.get_payload()
+                if payload['status'] == 'success':
+                    return True, base64.b64decode(payload['merged_content'])
+            return False, None
+
+        if max_workers is None:
+            max_workers = dk_api.get_config().get_max_workers()
+        results = DKCloudCommandRunner._run_in_pool(fetch_file, file_list, max_workers)
+
+        merged_files = dict()
+        status = True
+        for (folder_name, this_file), (file_ok, file_contents) in zip(file_list, results):
+            if file_ok:
+                if folder_name not in merged_files:
+                    merged_files[folder_name] = list()
+                this_file['text'] = file_contents
+                merged_files[folder_name].append(this_file)
+            else:
+                status = False
         return status, merged_files
 
     @staticmethod
@@ -831,33 +872,38 @@ class DKCloudCommandRunner(object):
         return rc
 
     @staticmethod
-    def _get_recipe_new(dk_api, kitchen, recipe_name_param, recipe_path):
+    def _get_recipe_new(dk_api, kitchen, recipe_name_param, recipe_path, max_workers=None):
+        if max_workers is None:
+            max_workers = dk_api.get_config().get_max_workers()
+        try:
+            materializer = DKRecipeMaterializer(recipe_path, recipe_name_param, max_workers)
+        except (ValueError, IOError, OSError) as e:
+            rc = DKReturnCode()
+            rc.set(rc.DK_FAIL, 'ERROR: could not save recipe to disk\n%s' % str(e))
+            return rc
         try:
-            rc = dk_api.get_recipe(kitchen, recipe_name_param)
+            # files are staged as they arrive and the recipe is swapped in once complete
+            rc = dk_api.get_recipe_streamed(kitchen, recipe_name_param, materializer.add_file)
             recipe_info = rc.get_payload()
-            if isinstance(recipe_info, dict) and 'recipes' in recipe_info:
+            if rc.ok():
                 recipes = recipe_info['recipes']
-                if not rc.ok():
-                    s = 'ERROR:  DKCloudCommand.get_recipe failed'
-                    rc.set_message('%s\nmessage: %s' % (s, rc.get_message()))
-                else:
-                    rs = 'DKCloudCommand.get_recipe has %d sections\n' % len(recipes[recipe_name_param])
-                    for r in recipes[recipe_name_param]:
-                        rs += '  %s\n' % r
-                    rc.set_message(rs)
-                    d = DKRecipeDisk(recipe_info['ORIG_HEAD'], recipes[recipe_name_param], recipe_path)
-                    rv = d.save_recipe_to_disk()
-                    if rv is None:
-                        s = 'ERROR: could not save recipe to disk'
-                        rc.set(rc.DK_FAIL, s)
+                rs = 'DKCloudCommand.get_recipe has %d sections\n' % len(recipes[recipe_name_param])
+                for r in recipes[recipe_name_param]:
+                    rs += '  %s\n' % r
+                    materializer.add_folder(r)
+                materializer.commit(recipe_info['ORIG_HEAD'])
+                rc.set_message(rs)
             else:
+                materializer.abort()
                 if len(rc.get_message()) > 0:
                     rc.set(rc.DK_FAIL, rc.get_message())
                 else:
                     rc.set(rc.DK_FAIL, rc.get_payload())
             return rc
         except Exception as e:
-            rc.set(rc.DK_FAIL, e.message)
+            materializer.abort()
+            rc = DKReturnCode()
+            rc.set(rc.DK_FAIL, 'ERROR: could not save recipe to disk\n%s' % str(e))
             return rc
 
     @staticmethod
@@ -871,9 +917,8 @@ class DKCloudCommandRunner(object):
         if DKKitchenDisk.is_kitchen_root_dir(kitchen_path):
             for subdir in os.listdir(kitchen_path):
                 if subdir != DK_DIR:
-                    recipe_path_param = os.path.join(kitchen_path, subdir)
-                    shutil.rmtree(recipe_path_param)
-                    rc = DKCloudCommandRunner.get_recipe(dk_api, kitchen_name, subdir, start_dir=kitchen_path,force=True)
+                    # replaces the local recipe in one go, files that did not change are kept
+                    rc = DKCloudCommandRunner._get_recipe_new(dk_api, kitchen_name, subdir, kitchen_path)
                     if not rc.ok():
                         click.secho('Could not properly update recipe %s.\n Error is: %s' % (subdir, rc.get_message()))
             click.secho('%s kitchen has been updated' % kitchen_path)
@@ -918,13 +963,15 @@ class DKCloudCommandRunner(object):
             if os.path.isdir(recipe_path_param) is False:
                 return 'ERROR: DKCloudCommandRunner path (%s) does not exist' % recipe_path_param
             recipe_path_to_use = recipe_path_param
-        rc = dk_api.recipe_status(kitchen, recipe, recipe_path_to_use)
+        # one pass over the local files serves both the remote comparison and the local change detection
+        local_sha, current_shas = scan_recipe_dir(recipe_path_to_use)
+        rc = dk_api.recipe_status(kitchen, recipe, recipe_path_to_use, local_sha)
         if not rc.ok():
             rc.set_message('DKCloudCommand.recipe_status failed\nmessage: %s' % rc.get_message())
             return rc
         else:
 
-            local_status_ok, new_paths, local_changes, removed_paths = DKRecipeDisk.get_changed_files(recipe_path_to_use, recipe)
+            local_status_ok, new_paths, local_changes, removed_paths = DKRecipeDisk.get_changed_files(recipe_path_to_use, recipe, current_shas)
 
             #if not local_status_ok:
             #    rc.set_message('DKCloudCommand.recipe_status failed\nmessage: Unable to get local state for recipe')
@@ -1020,15 +1067,14 @@ class DKCloudCommandRunner(object):
 
     @staticmethod
     def _get_all_files(path):
-        result = {}
+        result = []
         for item in os.listdir(path):
             item_path = os.path.join(path,item)
 
             if os.path.isfile(item_path):
-                with open(item_path,'r') as f:
-                    result[item_path] = f.read()
+                result.append(item_path)
             elif os.path.isdir(item_path):
-                result.update(DKCloudCommandRunner._get_all_files(item_path))
+                result.extend(DKCloudCommandRunner._get_all_files(item_path))
         return result
 
     @staticmethod
@@ -1062,6 +1108,7 @@ class DKCloudCommandRunner(object):
                 rc.set_message(rs)
                 return rc
 
+            # Contents are not read here; the upload streams each file from disk.
             changes = {}
 
             for folder,files in rl['different'].items():
@@ -1070,19 +1117,18 @@ class DKCloudCommandRunner(object):
                     path = file[len(recipe_name)+1:]
                     full_path = os.path.join(recipe_dir, path)
                     if os.path.isfile(full_path):
-                        with open(full_path,'r') as f:
-                            changes[path] = {
-                                'contents': f.read(),
-                                'isNew': False
-                            }
+                        changes[path] = {
+                            'file': full_path,
+                            'isNew': False
+                        }
 
             for folder,files in rl['only_local'].items():
                 if len(files) == 0:
                     all_files = DKCloudCommandRunner._get_all_files(folder[len(recipe_name)+1:])
 
-                    for path,contents in all_files.items():
+                    for path in all_files:
                         changes[path] = {
-                            'contents' : contents,
+                            'file' : os.path.abspath(path),
                             'isNew' : True
                         }
                 else:
@@ -1091,17 +1137,15 @@ class DKCloudCommandRunner(object):
                         path = file[len(recipe_name)+1:]
                         full_path = os.path.join(recipe_dir, path)
                         if os.path.isfile(full_path):
-                            with open(full_path,'r') as f:
-                                file_contents = f.read()
-                                if DKFileUtils.is_file_contents_binary(file_contents):
-                                    rs = 'File %s seems to be a binary file. Please remove and try again.' % file
-                                    rc.set_message(rs)
-                                    return rc
-
-                                changes[path] = {
-                                    'contents': file_contents,
-                                    'isNew': True
-                                }
+                            if DKFileUtils.is_file_binary(full_path):
+                                rs = 'File %s seems to be a binary file. Please remove and try again.' % file
+                                rc.set_message(rs)
+                                return rc
+
+                            changes[path] = {
+                                'file': full_path,
+                                'isNew': True
+                            }
             for folder,files in rl['only_remote'].items():
                 for f in files:
                     file = os.path.join(folder,f['filename'])
@@ -1206,27 +1250,18 @@ class DKCloudCommandRunner(object):
 
             rl = rc.get_payload()
 
+            recipe_path = DKRecipeDisk.find_recipe_root_dir()
+
+            if len(files_to_update) > 1:
+                # Several files go up together in one request and one commit.
+                return DKCloudCommandRunner._update_files_batch(dk_api, kitchen, recipe_name, recipe_dir, recipe_path,
+                                                                message, files_to_update, rl)
+
             # Add new files
             if len(rl['only_local']) > 0:
                 for file_to_update in files_to_update:
-                    file_to_update_is_new = False
-
                     full_path = os.path.join(current_path, file_to_update)
-                    relative_path = os.path.relpath(full_path, recipe_dir)
-                    relative_path_with_recipe = os.path.join(recipe_name,relative_path)
-                    the_path, the_name = os.path.split(relative_path_with_recipe)
-
-                    if the_path in rl['only_local']:
-                        file_list_in_path = rl['only_local'][the_path]
-                        if file_list_in_path is not None:
-                            if len(file_list_in_path) is 0:
-                                file_to_update_is_new = True
-                            else:
-                                for item in file_list_in_path:
-                                    if item['filename'] == the_name:
-                                        file_to_update_is_new = True
-                                        break
-                    if file_to_update_is_new:
+                    if DKCloudCommandRunner._is_new_local_file(rl, recipe_name, recipe_dir, full_path):
                         print 'Adding: %s' % (file_to_update,)
                         DKCloudCommandRunner.add_file(dk_api, kitchen, recipe_name, message, file_to_update)
                         if not rc.ok():
@@ -1253,7 +1288,6 @@ class DKCloudCommandRunner(object):
                     return rc
 
                 full_path = os.path.join(current_path, file_to_update)
-                recipe_path = DKRecipeDisk.find_recipe_root_dir()
                 recipe_file_path = full_path[len(recipe_path) + 1:]
 
                 rc = dk_api.update_file(kitchen, recipe_name, message, recipe_file_path, file_contents)
@@ -1276,6 +1310,117 @@ class DKCloudCommandRunner(object):
             rc.set(rc.DK_FAIL, e.message)
             return rc
 
+    @staticmethod
+    def _is_new_local_file(rl, recipe_name, recipe_dir, full_path):
+        # rl is the recipe_status payload; a file is new if it only exists locally
+        relative_path = os.path.relpath(full_path, recipe_dir)
+        relative_path_with_recipe = os.path.join(recipe_name, relative_path)
+        the_path, the_name = os.path.split(relative_path_with_recipe)
+
+        if the_path in rl['only_local']:
+            file_list_in_path = rl['only_local'][the_path]
+            if file_list_in_path is not None:
+                if len(file_list_in_path) is 0:
+                    return True
+                for item in file_list_in_path:
+                    if item['filename'] == the_name:
+                        return True
+        return False
+
+    @staticmethod
+    def _update_files_batch(dk_api, kitchen, recipe_name, recipe_dir, recipe_path, message, files_to_update, rl):
+        rc = DKReturnCode()
+        current_path = os.getcwd()
+        ignore = DKIgnore()
+        changes = dict()
+        updated_files = list()
+        msg = ''
+        for file_to_update in files_to_update:
+            full_path = os.path.abspath(os.path.join(current_path, file_to_update))
+            # same checks as add_file, done for every file before anything is sent
+            if full_path[0:len(recipe_path) + 1] != os.path.join(recipe_path, ''):
+                if len(msg) != 0:
+                    msg += '\n'
+                msg += "ERROR: '%s' is not inside recipe directory" % file_to_update
+                rc.set(rc.DK_FAIL, msg)
+                return rc
+
+            recipe_file_path = full_path[len(recipe_path) + 1:]
+            file_to_update_is_new = DKCloudCommandRunner._is_new_local_file(rl, recipe_name, recipe_dir, full_path)
+
+            if file_to_update_is_new and ignore.ignore(recipe_file_path):
+                if len(msg) != 0:
+                    msg += '\n'
+                msg += 'DKCloudCommand.update_file ignoring %s' % file_to_update
+                continue
+
+            if not os.path.isfile(full_path):
+                if len(msg) != 0:
+                    msg += '\n'
+                msg += "ERROR: '%s' does not exist" % file_to_update
+                rc.set(rc.DK_FAIL, msg)
+                return rc
+
+            if DKFileUtils.is_file_binary(full_path):
+                if len(msg) != 0:
+                    msg += '\n'
+                msg += 'ERROR: File %s seems to be a binary file. Please remove and try again.' % file_to_update
+                rc.set(rc.DK_FAIL, msg)
+                return rc
+
+            if file_to_update_is_new:
+                print 'Adding: %s' % (file_to_update,)
+            changes[recipe_file_path] = {
+                'file': full_path,
+                'isNew': file_to_update_is_new
+            }
+            updated_files.append((file_to_update, recipe_file_path))
+
+        if len(changes) == 0:
+            rc.set_message(msg)
+            return rc
+
+        rc = dk_api.update_files(kitchen, recipe_name, message, changes)
+        if not rc.ok():
+            # an upload sent in several parts may have failed after some of them were committed
+            data = rc.get_payload()
+            if isinstance(data, dict):
+                saved_paths = [recipe_file_path for file_to_update, recipe_file_path in updated_files
+                               if recipe_file_path in data and data[recipe_file_path]]
+                if len(saved_paths) > 0:
+                    DKRecipeDisk.update_recipe_state(recipe_dir, updated_paths=saved_paths)
+            rs = 'DKCloudCommand.update_file failed\nmessage: %s' % rc.get_message()
+            rc.set_message(rs)
+            return rc
+
+        data = rc.get_payload()
+        issues = data['issues'] if 'issues' in data else list()
+        if len([i for i in issues if i['severity'] == 'error']) > 0:
+            rs = '\nUnable to update files due to errors in recipe:\n\n%s\n' % DKCloudCommandRunner.format_issues(issues)
+            rc.set(rc.DK_FAIL, rs)
+            return rc
+
+        failed = False
+        saved_paths = list()
+        for file_to_update, recipe_file_path in updated_files:
+            if len(msg) != 0:
+                msg += '\n'
+            if recipe_file_path in data and data[recipe_file_path]:
+                saved_paths.append(recipe_file_path)
+                msg += 'DKCloudCommand.update_file for %s succeeded' % file_to_update
+            else:
+                failed = True
+                msg += 'DKCloudCommand.update_file for %s failed' % file_to_update
+        # update recipe meta, one write for all the files
+        if len(saved_paths) > 0:
+            DKRecipeDisk.update_recipe_state(recipe_dir, updated_paths=saved_paths)
+
+        if failed:
+            rc.set(rc.DK_FAIL, msg)
+        else:
+            rc.set_message(msg)
+        return rc
+
     @staticmethod
     @check_api_param_decorator
     def add_file(dk_api, kitchen, recipe_name, message, api_file_key):
@@ -1430,12 +1575,13 @@ class DKCloudCommandRunner(object):
 
     @staticmethod
     @check_api_param_decorator
-    def watch_active_servings(dk_api, kitchen, period):
+    def watch_active_servings(dk_api, kitchen, period, output_format=DK_OUTPUT_TEXT):
         """
         returns a string.
         :param dk_api: -- api object
-        :param kitchen: string
+        :param kitchen: string, or list of kitchen names and glob patterns (like 'team-*')
         :param period: integer
+        :param output_format: DK_OUTPUT_TEXT or DK_OUTPUT_JSON (one json object per change and line)
         :rtype: string
         """
 
@@ -1446,13 +1592,40 @@ class DKCloudCommandRunner(object):
         if period <= 0:
             return 'DKCloudCommand.watch_active_servings requires a positive period'
 
+        kitchens = DKCloudCommandRunner._expand_kitchen_names(dk_api, kitchen)
+        if kitchens is None or len(kitchens) == 0:
+            return 'DKCloudCommand.watch_active_servings found no kitchen matching %s' % str(kitchen)
+
         DKActiveServingWatcherSingleton().set_sleep_time(period)
         DKActiveServingWatcherSingleton().set_api(dk_api)
         DKActiveServingWatcherSingleton().set_formatter(DKCloudCommandRunner)
-        DKActiveServingWatcherSingleton().set_kitchen(kitchen)
+        DKActiveServingWatcherSingleton().set_kitchens(kitchens)
+        DKActiveServingWatcherSingleton().set_output_format(output_format)
         DKActiveServingWatcherSingleton().start_watcher()
         return ""
 
+    @staticmethod
+    def _expand_kitchen_names(dk_api, kitchens):
+        # kitchen names are used as they are, glob patterns are matched against the kitchen list
+        if isinstance(kitchens, basestring):
+            kitchens = [kitchens]
+        all_kitchen_names = None
+        expanded = list()
+        for kitchen in kitchens:
+            if not any(c in kitchen for c in '*?['):
+                names = [kitchen]
+            else:
+                if all_kitchen_names is None:
+                    rc = dk_api.list_kitchen()
+                    if not rc.ok():
+                        return None
+                    all_kitchen_names = sorted([k['name'] for k in rc.get_payload()])
+                names = fnmatch.filter(all_kitchen_names, kitchen)
+            for name in names:
+                if name not in expanded:
+                    expanded.append(name)
+        return expanded
+
     # http://stackoverflow.com/questions/19652446/python-program-with-thread-cant-catch-ctrlc
     @staticmethod
     def join_active_serving_watcher_thread_join():
@@ -1882,6 +2055,7 @@ class DKCloudCommandRunner(object):
             template_dict['remote'] = aux_full_path
             template_dict['local'] = '%s/%s' % (recipe_dir, recipe_file_path)
 
+            from jinja2 import Template
             command_template_string = dk_api.get_config().get_diff_tool()
             command_template = Template(command_template_string)
             command = command_template.render(template_dict)
@@ -1923,6 +2097,7 @@ class DKCloudCommandRunner(object):
             template_dict['right'] = '%s/%s%s' % (working_dir, file_path, '.right')
             template_dict['merge'] = '%s/%s%s' % (working_dir, file_path, '.merge')
 
+            from jinja2 import Template
             command_template_string = dk_api.get_config().get_merge_tool()
             command_template = Template(command_template_string)
             command = command_template.render(template_dict)
@@ -2087,22 +2262,27 @@ class DKCloudCommandRunner(object):
                    "DKCloudCommandRunner.write_recipe_merge_conflicts: Can't find conflicts for recipe %s." % recipe_name_param)
             return rc
         recipe_conflicts = merge_info['conflicts'][recipe_name_param]
-        for folder_name, folder_contents in recipe_conflicts.iteritems():
-            folder_fullpath = os.path.join(kitchen_dir, folder_name)
-            for conflict in folder_contents:
-                file_fullpath = os.path.join(folder_fullpath, conflict['filename'])
-                if 'conflict_tags' in conflict:
-                    with open(file_fullpath, 'w') as conflict_file:
-                        conflict_file.write(base64.b64decode(conflict['conflict_tags']))
-                    if not DKRecipeDisk.add_conflict_to_conflicts_meta(conflict, folder_name, recipe_name_param,
-                                                                       kitchen_dir):
+        conflicts_store = DKConflictsStore(DKKitchenDisk.get_recipe_meta_dir(recipe_name_param, kitchen_dir))
+        try:
+            for folder_name, folder_contents in recipe_conflicts.iteritems():
+                folder_fullpath = os.path.join(kitchen_dir, folder_name)
+                for conflict in folder_contents:
+                    file_fullpath = os.path.join(folder_fullpath, conflict['filename'])
+                    if 'conflict_tags' in conflict:
+                        with open(file_fullpath, 'w') as conflict_file:
+                            conflict_file.write(base64.b64decode(conflict['conflict_tags']))
+                        conflicts_store.add(conflict, folder_name, recipe_name_param)
+                    else:
                         rc.set(rc.DK_FAIL,
-                               "DKCloudCommandRunner.write_recipe_merge_conflicts: Unable to write out conflict meta for %s" % file_fullpath)
+                               "DKCloudCommandRunner.write_recipe_merge_conflicts: Can't find conflict tags for %s" % file_fullpath)
                         return rc
-                else:
-                    rc.set(rc.DK_FAIL,
-                           "DKCloudCommandRunner.write_recipe_merge_conflicts: Can't find conflict tags for %s" % file_fullpath)
-                    return rc
+        finally:
+            # the conflicts of the files already written are kept even if a later one fails
+            conflicts_meta_saved = conflicts_store.flush()
+        if not conflicts_meta_saved:
+            rc.set(rc.DK_FAIL,
+                   "DKCloudCommandRunner.write_recipe_merge_conflicts: Unable to write out conflict meta for recipe %s" % recipe_name_param)
+            return rc
 
         rc.set(rc.DK_SUCCESS, "Conflicts for recipe %s written to %s\n" % (
             recipe_name_param, os.path.join(kitchen_dir, recipe_name_param)))
@@ -2249,6 +2429,8 @@ class DKCloudCommandRunner(object):
         rc = DKReturnCode()
         try:
             rc = dk_api.order_resume(orderrun_id)
+            # the order run changes again, its saved details are stale
+            DKCloudCommandRunner._forget_orderrun_detail(dk_api, orderrun_id)
             payload = rc.get_payload()
             rc.set_message('DKCloudCommand.order_resume %s succeeded\n' % orderrun_id)
         except Exception as e:
@@ -2311,9 +2493,10 @@ class DKCloudCommandRunner(object):
             display_summary = True
         else:
             display_summary = False
-        # always get summary information
-        pd[DKCloudCommandRunner.SUMMARY] = True
-        rc = dk_api.orderrun_detail(kitchen, pd)
+        # the step status is part of the summary, --runstatus and the ids are not
+        if 'status' in pd:
+            pd[DKCloudCommandRunner.SUMMARY] = True
+        rc = DKCloudCommandRunner._get_orderrun_detail(dk_api, kitchen, pd)
         s = ''
         if not rc.ok() or not isinstance(rc.get_payload(), list):
             s = 'Issue with getting order run details\nmessage: %s' % rc.get_message()
@@ -2321,24 +2504,7 @@ class DKCloudCommandRunner(object):
             return rc
 
         # we have a list of servings, find the right dict
-        serving_list = rc.get_payload()
-        serving = None
-        if DKCloudCommandRunner.ORDER_RUN_ID in pd:
-            order_run_id = pd[DKCloudCommandRunner.ORDER_RUN_ID]
-            for serv in serving_list:
-                if serv[DKCloudCommandRunner.ORDER_RUN_ID] == order_run_id:
-                    serving = serv
-                    break
-        elif DKCloudCommandRunner.ORDER_ID in pd:
-            order_id = pd[DKCloudCommandRunner.ORDER_ID]
-            for serv in serving_list:
-                if serv[DKCloudCommandRunner.ORDER_ID] == order_id:
-                    serving = serv
-                    break
-        else:
-            # find the newest serving
-            if len(serving_list) > 0:
-                serving = serving_list[0]
+        serving = DKCloudCommandRunner._find_serving(rc.get_payload(), pd)
 
         if serving is None:
             rc.set(rc.DK_FAIL,
@@ -2423,6 +2589,137 @@ class DKCloudCommandRunner(object):
         rc.set_message(s)
         return rc
 
+    @staticmethod
+    def _get_orderrun_detail(dk_api, kitchen, pd):
+        """
+        dk_api.orderrun_detail, but a completed order run asked for by id is fetched only once:
+        later calls get it from the local order cache.
+        :rtype: DKReturnCode, the payload is a list of servings
+        """
+        order_run_id = pd.get(DKCloudCommandRunner.ORDER_RUN_ID)
+        order_cache = None
+        if order_run_id is not None:
+            order_cache = DKCloudCommandRunner._open_order_cache(dk_api)
+        if order_cache is None:
+            return dk_api.orderrun_detail(kitchen, pd)
+        try:
+            # the cache only saves a request, the command works without it
+            try:
+                serving = order_cache.get_order_run_detail(kitchen, order_run_id, pd)
+            except Exception:
+                serving = None
+            if serving is not None:
+                rc = DKReturnCode()
+                rc.set(rc.DK_SUCCESS, None, [serving])
+                return rc
+            rc = dk_api.orderrun_detail(kitchen, pd)
+            if rc.ok() and isinstance(rc.get_payload(), list):
+                serving = DKCloudCommandRunner._find_serving(rc.get_payload(), pd)
+                if serving is not None:
+                    try:
+                        order_cache.save_order_run_detail(kitchen, order_run_id, pd, serving)
+                    except Exception:
+                        pass
+            return rc
+        finally:
+            order_cache.close()
+
+    @staticmethod
+    def _forget_orderrun_detail(dk_api, order_run_id):
+        order_cache = DKCloudCommandRunner._open_order_cache(dk_api)
+        if order_cache is None:
+            return
+        try:
+            order_cache.forget_order_run_detail(order_run_id)
+        except Exception:
+            pass
+        finally:
+            order_cache.close()
+
+    @staticmethod
+    def _find_serving(serving_list, pd):
+        if DKCloudCommandRunner.ORDER_RUN_ID in pd:
+            order_run_id = pd[DKCloudCommandRunner.ORDER_RUN_ID]
+            for serv in serving_list:
+                if serv[DKCloudCommandRunner.ORDER_RUN_ID] == order_run_id:
+                    return serv
+        elif DKCloudCommandRunner.ORDER_ID in pd:
+            order_id = pd[DKCloudCommandRunner.ORDER_ID]
+            for serv in serving_list:
+                if serv[DKCloudCommandRunner.ORDER_ID] == order_id:
+                    return serv
+        else:
+            # find the newest serving
+            if len(serving_list) > 0:
+                return serving_list[0]
+        return None
+
+    @staticmethod
+    @check_api_param_decorator
+    def orderrun_detail_events(dk_api, kitchen, pd, out=None):
+        """
+        Same as orderrun_detail, but writes the details to out as json lines while they are read,
+        instead of building a message: an 'orderrun' event, then 'node', 'testresults', 'timingresults'
+        and 'log' events for what pd asks for. The orderrun event has the recipe, start_time and
+        run_duration only if the summary was asked for (--summary or --nodestatus).
+        :param dk_api: -- api object
+        :param kitchen: string
+        :param pd: dict
+        :param out: file like object, stdout by default
+        :rtype: DKReturnCode
+        """
+        if out is None:
+            out = sys.stdout
+        # as in orderrun_detail, the summary is fetched only for --summary and --nodestatus
+        if 'status' in pd:
+            pd[DKCloudCommandRunner.SUMMARY] = True
+        rc = DKCloudCommandRunner._get_orderrun_detail(dk_api, kitchen, pd)
+        if not rc.ok() or not isinstance(rc.get_payload(), list):
+            rc.set(rc.DK_FAIL, 'Issue with getting order run details\nmessage: %s' % rc.get_message())
+            return rc
+
+        serving = DKCloudCommandRunner._find_serving(rc.get_payload(), pd)
+        if serving is None:
+            rc.set(rc.DK_FAIL,
+                   "No OrderRun information.  Try using 'dk order-list -k %s' to see what is available." % kitchen)
+            return rc
+
+        summary = serving.get(DKCloudCommandRunner.SUMMARY)
+        if not isinstance(summary, dict):
+            summary = dict()
+        order_run_id = serving[DKCloudCommandRunner.ORDER_RUN_ID]
+        timestamp = int(time.time() * 1000)
+
+        def write_event(event_type, **fields):
+            fields.update({'event': event_type, 'kitchen': kitchen, 'serving_id': order_run_id,
+                           'timestamp': timestamp})
+            out.write(json.dumps(fields, sort_keys=True))
+            out.write('\n')
+            out.flush()
+
+        orderrun_fields = {'order_id': serving.get(DKCloudCommandRunner.ORDER_ID), 'status': serving.get('status'),
+                           'variation': order_run_id.split('#')[3]}
+        # these come from the summary, left out when it was not fetched
+        for field, summary_key in [('recipe', 'name'), ('start_time', 'start-time'),
+                                   ('run_duration', 'total-recipe-time')]:
+            if summary.get(summary_key) is not None:
+                orderrun_fields[field] = summary[summary_key]
+        write_event('orderrun', **orderrun_fields)
+        if 'status' in pd:
+            for key in sorted(summary):
+                if isinstance(summary[key], dict):
+                    write_event('node', node=key, status=summary[key].get('status', 'unknown'))
+        if isinstance(serving.get(DKCloudCommandRunner.TESTRESULTS), basestring):
+            write_event('testresults', text=serving[DKCloudCommandRunner.TESTRESULTS])
+        if isinstance(serving.get(DKCloudCommandRunner.TIMINGRESULTS), basestring):
+            write_event('timingresults', text=serving[DKCloudCommandRunner.TIMINGRESULTS])
+        if DKCloudCommandRunner.LOGS in serving:
+            for line in serving[DKCloudCommandRunner.LOGS]['lines']:
+                write_event('log', line=line)
+
+        rc.set_message('')
+        return rc
+
     @staticmethod
     def parse_serving_id(serving_id):
         serving_mesos_id_parts = serving_id.split('#')
@@ -2446,44 +2743,173 @@ class DKCloudCommandRunner(object):
 
     @staticmethod
     @check_api_param_decorator
-    def list_order(dk_api, kitchen, order_count=5, order_run_count=3, start=0, recipe=None):
+    def list_order(dk_api, kitchen, order_count=5, order_run_count=3, start=0, recipe=None, cached=False,
+                   refresh=True):
+        """
+        :param cached: list the orders from the local order cache
+        :param refresh: with cached, bring the cache up to date first, fetching only what is new
+        :rtype: DKReturnCode
+        """
+        if cached:
+            return DKCloudCommandRunner._list_cached_order(dk_api, kitchen, order_count, order_run_count, start,
+                                                           recipe, refresh)
         rc = dk_api.list_order(kitchen, order_count, order_run_count, start, recipe=recipe)
         if not rc.ok():
             s = 'DKCloudCommand.list_order failed\nmessage: %s' % rc.get_message()
             rc.set_message(s)
             return rc
 
-        rows = []
         payload = rc.get_payload()
+        s = ''
         for order in payload['orders']:
-            # Found an order without any servings. Add it to the list.
-            if order['serving_chronos_id'] is not None:
-                order_info = DKCloudCommandRunner.parse_order_id(order['serving_chronos_id'])
+            if order['serving_chronos_id'] in payload['servings']:
+                serving_list = payload['servings'][order['serving_chronos_id']]['servings']
+            else:
+                serving_list = []
+            s += DKCloudCommandRunner._display_order(order, serving_list, kitchen)
+        rc.set_message(s)
+        return rc
 
-                if order['serving_chronos_id'] in payload['servings']:
-                    serving_list = payload['servings'][order['serving_chronos_id']]['servings']
-                else:
-                    serving_list = []
-                order = [
-                    order['serving_chronos_id'],
-                    order_info['recipe'],
-                    order_info['variation'],
-                    order['chronos-status'],
-                    order['schedule'] if 'schedule' in order else '',
-                    serving_list]
-                rows.append(order)
+    @staticmethod
+    def _list_cached_order(dk_api, kitchen, order_count, order_run_count, start, recipe, refresh):
+        rc = DKReturnCode()
+        config = dk_api.get_config()
+        order_cache = DKCloudCommandRunner._open_order_cache(dk_api)
+        if order_cache is None:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.list_order failed\nmessage: unable to open the order cache')
+            return rc
+        try:
+            if refresh:
+                order_cache.refresh(dk_api, kitchen, recipe)
+                order_cache.evict(config.get_order_cache_max_age(), config.get_order_cache_max_runs())
+            orders = order_cache.get_orders(kitchen, recipe, order_count, start)
+        except Exception, e:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.list_order failed\nmessage: %s' % str(e))
+            return rc
+        finally:
+            order_cache.close()
 
         s = ''
-        for order in rows:
-            s += DKCloudCommandRunner._display_order_summary(order, kitchen)
-            count = 1
-            for serving in order[5]:
-                s += DKCloudCommandRunner._display_serving_summary(serving, count)
+        for order, serving_list in orders:
+            s += DKCloudCommandRunner._display_order(order, serving_list[:order_run_count], kitchen)
+        rc.set(rc.DK_SUCCESS, s, orders)
+        return rc
+
+    @staticmethod
+    def _open_order_cache(dk_api):
+        """
+        :return: DKOrderCache, None if there is no folder for it or it can't be opened
+        """
+        cache_file = dk_api.get_config().get_order_cache_file()
+        if cache_file is None:
+            return None
+        try:
+            return DKOrderCache(cache_file)
+        except Exception:
+            return None
+
+    @staticmethod
+    @check_api_param_decorator
+    def stream_order_list(dk_api, kitchen, order_run_count=3, start=0, recipe=None, page_size=None, out=None):
+        """
+        Writes all the orders of a kitchen (or recipe) to out page by page, as they arrive,
+        instead of building one message.
+        :param out: file like object, stdout by default
+        :rtype: DKReturnCode, the payload is the number of orders listed
+        """
+        rc = DKReturnCode()
+        if out is None:
+            out = sys.stdout
+        count = 0
+        try:
+            for order, serving_list in dk_api.iter_orders(kitchen, page_size, order_run_count, start, recipe):
+                out.write(DKCloudCommandRunner._display_order(order, serving_list, kitchen))
+                out.flush()
                 count += 1
-            rc.set_message(s)
+        except Exception, e:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.list_order failed\nmessage: %s' % str(e))
+            return rc
+        rc.set(rc.DK_SUCCESS, '', count)
+        return rc
+
+    @staticmethod
+    @check_api_param_decorator
+    def order_history(dk_api, kitchen, recipe=None, days=None, refresh=True):
+        """
+        Run counts, failure rates and durations of the order runs of a kitchen, per recipe and variation,
+        computed on the local order cache.
+        :param days: only order runs started in the last days
+        :param refresh: bring the local order cache up to date first
+        :rtype: DKReturnCode, the payload is the list of stats
+        """
+        rc = DKReturnCode()
+        config = dk_api.get_config()
+        cache_file = config.get_order_cache_file()
+        if cache_file is None:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.order_history failed\nmessage: no folder for the order cache')
+            return rc
+        try:
+            order_cache = DKOrderCache(cache_file)
+        except Exception, e:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.order_history failed\nmessage: %s' % str(e))
+            return rc
+        try:
+            if refresh:
+                order_cache.refresh(dk_api, kitchen, recipe)
+                order_cache.evict(config.get_order_cache_max_age(), config.get_order_cache_max_runs())
+            since = None
+            if days is not None:
+                since = int((time.time() - days * 24 * 60 * 60) * 1000)
+            stats = order_cache.get_run_stats(kitchen, recipe, since)
+        except Exception, e:
+            rc.set(rc.DK_FAIL, 'DKCloudCommand.order_history failed\nmessage: %s' % str(e))
+            return rc
+        finally:
+            order_cache.close()
 
+        if len(stats) == 0:
+            rc.set(rc.DK_SUCCESS, 'No order runs found for kitchen %s\n' % kitchen, stats)
+            return rc
+        field_names = ['Recipe', 'Variation', 'Runs', 'Failed', 'Failure rate', 'Avg duration', 'Max duration']
+        x = PrettyTable()
+        x.field_names = field_names
+        x.set_style(PLAIN_COLUMNS)
+        x.header = True
+        x.border = False
+        x.align['Recipe'] = 'l'
+        x.align['Variation'] = 'l'
+        for field_name in field_names[2:]:
+            x.align[field_name] = 'r'
+        x.left_padding_width = 1
+        for stat in stats:
+            x.add_row([stat['recipe'], stat['variation'], stat['runs'], stat['failed'],
+                       '%.1f%%' % (100.0 * stat['failed'] / stat['runs']),
+                       DKCloudCommandRunner._format_timing(stat['avg_duration'])
+                       if stat['avg_duration'] is not None else '',
+                       DKCloudCommandRunner._format_timing(stat['max_duration'])
+                       if stat['max_duration'] is not None else ''])
+        rc.set(rc.DK_SUCCESS, 'Order history for kitchen %s\n\n%s\n' % (kitchen, x.get_string()), stats)
         return rc
 
+    @staticmethod
+    def _display_order(order, serving_list, kitchen):
+        if order['serving_chronos_id'] is None:
+            return ''
+        order_info = DKCloudCommandRunner.parse_order_id(order['serving_chronos_id'])
+        row = [
+            order['serving_chronos_id'],
+            order_info['recipe'],
+            order_info['variation'],
+            order['chronos-status'],
+            order['schedule'] if 'schedule' in order else '',
+            serving_list]
+        s = DKCloudCommandRunner._display_order_summary(row, kitchen)
+        count = 1
+        for serving in serving_list:
+            s += DKCloudCommandRunner._display_serving_summary(serving, count)
+            count += 1
+        return s
+
     @staticmethod
     @check_api_param_decorator
     def delete_orderrun(dk_api, orderrun_id):
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+
+__author__ = 'DataKitchen, Inc.'
+
+# 'path:sha' lines, the format used before the store; migrated on first use
+FILE_SHA = 'FILE_SHA'
+FILE_SHA_DB = 'FILE_SHA.db'
+
+
+class DKFileShaStore(object):
+    """
+    sha1 of every file of a recipe as of the last sync with the server (.dk/recipes/<recipe>/FILE_SHA.db),
+    the baseline recipe-status compares the local files against.
+
+    The shas live in an indexed SQLite table, so a handful of files are updated without rewriting
+    the others, and replace()/update() change any number of them in one transaction.
+    """
+
+    def __init__(self, recipe_meta_dir):
+        self._db_file = os.path.join(recipe_meta_dir, FILE_SHA_DB)
+        self._legacy_file = os.path.join(recipe_meta_dir, FILE_SHA)
+        self._connection = None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def exists(self):
+        return os.path.isfile(self._db_file) or os.path.isfile(self._legacy_file)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._db_file, timeout=30)
+            # paths are byte strings, as os.walk gives them
+            self._connection.text_factory = str
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS file_sha '
+                                         '(path TEXT PRIMARY KEY, sha TEXT NOT NULL)')
+            if os.path.isfile(self._legacy_file):
+                self._replace(DKFileShaStore.read_legacy_file(self._legacy_file))
+                os.remove(self._legacy_file)
+        return self._connection
+
+    @staticmethod
+    def read_legacy_file(legacy_file):
+        shas = dict()
+        with open(legacy_file, 'r') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if len(line) == 0:
+                    continue
+                # the sha never has a ':', the path may
+                path, _, sha = line.rpartition(':')
+                shas[path] = sha
+        return shas
+
+    def _replace(self, shas):
+        with self._connection:
+            self._connection.execute('DELETE FROM file_sha')
+            self._connection.executemany('INSERT INTO file_sha (path, sha) VALUES (?, ?)', shas.iteritems())
+
+    def load(self):
+        """
+        :return: dict {recipe file path: sha1}, None if the recipe has no baseline yet
+        """
+        if not self.exists():
+            return None
+        return dict(self._connect().execute('SELECT path, sha FROM file_sha'))
+
+    def get(self, path):
+        if not self.exists():
+            return None
+        row = self._connect().execute('SELECT sha FROM file_sha WHERE path = ?', (path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def replace(self, shas):
+        """
+        Makes shas the whole baseline, in one transaction.
+        """
+        self._connect()
+        self._replace(shas)
+
+    def update(self, upserts=None, deletes=None):
+        """
+        Adds or changes the paths in upserts and removes the ones in deletes, in one transaction.
+        :param upserts: dict {recipe file path: sha1}
+        :param deletes: list of recipe file paths
+        """
+        connection = self._connect()
+        with connection:
+            if upserts:
+                connection.executemany('INSERT OR REPLACE INTO file_sha (path, sha) VALUES (?, ?)',
+                                       upserts.iteritems())
+            if deletes:
+                connection.executemany('DELETE FROM file_sha WHERE path = ?', [(path,) for path in deletes])
@@ -15,6 +15,17 @@ class DKFileUtils:
         except:
             return True
 
+    @staticmethod
+    def is_file_binary(full_path, chunk_size=64 * 1024):
+        # same check as is_file_contents_binary, a chunk at a time
+        with open(full_path, 'r') as the_file:
+            while True:
+                chunk = the_file.read(chunk_size)
+                if not chunk:
+                    return False
+                if DKFileUtils.is_file_contents_binary(chunk):
+                    return True
+
     @staticmethod
     def create_dir_if_not_exists(directory):
         if not os.path.exists(directory):
@@ -1,3 +1,5 @@
+import re
+
 
 class DKIgnore(object):
 
@@ -20,13 +22,19 @@ class DKIgnore(object):
                 self._defaults.append(ignore_me)
 
         self._ignore_these = list(self._defaults)
+        self._matcher = None
+
+    def _get_matcher(self):
+        # all the ignore items folded into one regex, so a check is a single scan of the string
+        if self._matcher is None:
+            self._matcher = re.compile('|'.join(re.escape(item) for item in self._ignore_these))
+        return self._matcher
 
     def ignore(self, check_item):
-        matches = next((item for item in self._ignore_these if item in check_item), None)
-        if matches is None:
+        if len(self._ignore_these) == 0:
             return False
-        else:
-            return True
+        return self._get_matcher().search(check_item) is not None
 
     def add_ignore(self, ignore_this_item):
-        self._ignore_these.append(ignore_this_item)
\ No newline at end of file
+        self._ignore_these.append(ignore_this_item)
+        self._matcher = None
@@ -0,0 +1,199 @@
+import re
+import json
+import codecs
+
+__author__ = 'DataKitchen, Inc.'
+
+_WHITESPACE = u' \t\r\n'
+_UTF8_BOM = u'\ufeff'
+# a complete \uXXXX escape for the first half of a surrogate pair, at the end of a piece
+_HIGH_SURROGATE_ESCAPE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+
+class DKJsonStream:
+    """
+    Reads a JSON document from an iterable of chunks without holding the whole document in memory.
+
+    The containers that expand(path) accepts are walked here; every other value is handed to the
+    standard decoder as a whole, once all of its text has arrived. So memory follows the largest
+    value that is not expanded, e.g. one recipe file.
+
+    A body that is a JSON string holding the document (the way the server sends most responses)
+    is unescaped on the fly first.
+
+        for path, value in DKJsonStream(response.iter_content(65536)).iter_values(expand):
+            ...
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    # Reading
+
+    def _next_chunk(self):
+        try:
+            return self._chunks.next()
+        except StopIteration:
+            return None
+
+    def _fill(self, min_size=1):
+        # appends at least min_size characters to the buffer, False at the end of the document
+        if self._eof:
+            return False
+        if self._pos > 0:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        pieces = [self._buf]
+        added = 0
+        while added < min_size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                self._eof = True
+                break
+            pieces.append(chunk)
+            added += len(chunk)
+        self._buf = u''.join(pieces)
+        return added > 0
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c is None or c not in chars:
+            raise ValueError('Expecting one of %s at %s' % (chars, repr(self._buf[self._pos:self._pos + 20])))
+        self._pos += 1
+        return c
+
+    def _read_value(self):
+        if self._peek() is None:
+            raise ValueError('Unexpected end of the document')
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number or a literal at the end of the buffer may go on in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # read as much again as is pending, so a big value is decoded a logarithmic number of times
+            self._fill(max(len(self._buf) - self._pos, DKJsonStream.CHUNK_SIZE))
+
+    def _walk(self, path, expand):
+        c = self._peek()
+        if c == '{' and expand(path):
+            self._pos += 1
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            while True:
+                key = self._read_value()
+                if not isinstance(key, basestring):
+                    raise ValueError('Expecting a property name in %s' % '/'.join(map(unicode, path)))
+                self._expect(':')
+                for item in self._walk(path + (key,), expand):
+                    yield item
+                if self._expect(',}') == '}':
+                    return
+        elif c == '[' and expand(path):
+            self._pos += 1
+            if self._peek() == ']':
+                self._pos += 1
+                return
+            i = 0
+            while True:
+                for item in self._walk(path + (i,), expand):
+                    yield item
+                i += 1
+                if self._expect(',]') == ']':
+                    return
+        else:
+            yield path, self._read_value()
+
+    def iter_values(self, expand):
+        """
+        :param expand: function(path) -> bool, True to walk into the object or array at path
+                       (a tuple of keys and indexes, () for the document)
+        :return: generator of (path, value) for the values not expanded, in document order
+        """
+        self._chunks = DKJsonStream._decode_chunks(self._chunks)
+        self._fill()
+        if self._buf.startswith(_UTF8_BOM):
+            self._pos = len(_UTF8_BOM)
+        if self._peek() == '"':
+            self._pos += 1
+            self._chunks = DKJsonStream._unescape_chunks(self._buf[self._pos:], self._chunks)
+            self._buf = u''
+            self._pos = 0
+            self._eof = False
+        for item in self._walk((), expand):
+            yield item
+        if self._peek() is not None:
+            raise ValueError('Extra data after the document')
+
+    # Chunk filters
+
+    @staticmethod
+    def _decode_chunks(chunks):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                yield chunk
+            elif len(chunk) > 0:
+                yield decoder.decode(chunk)
+        tail = decoder.decode('', final=True)
+        if len(tail) > 0:
+            yield tail
+
+    @staticmethod
+    def _is_escape(s, i):
+        # True if the backslash at i starts an escape, i.e. it is not escaped itself
+        run_start = i
+        while run_start > 0 and s[run_start - 1] == '\\':
+            run_start -= 1
+        return (i - run_start) % 2 == 0
+
+    @staticmethod
+    def _safe_end(s):
+        # how much of s can be unescaped now: not the closing quote and nothing that ends in a partial escape
+        end = len(s.rstrip(_WHITESPACE))
+        if end > 0 and s[end - 1] == '"':
+            end -= 1
+        backslash = s.rfind('\\', max(0, end - 6), end)
+        if backslash >= 0:
+            while backslash > 0 and s[backslash - 1] == '\\':
+                backslash -= 1
+            end = backslash
+        match = _HIGH_SURROGATE_ESCAPE.search(s, max(0, end - 6), end)
+        if match is not None and DKJsonStream._is_escape(s, match.start()):
+            end = match.start()
+        return end
+
+    @staticmethod
+    def _unescape_chunks(pending, chunks):
+        # the characters of the JSON string that starts just before pending
+        for chunk in chunks:
+            pending += chunk
+            end = DKJsonStream._safe_end(pending)
+            if end > 0:
+                yield json.loads(u'"%s"' % pending[:end])
+                pending = pending[end:]
+        pending = pending.rstrip(_WHITESPACE)
+        if not pending.endswith('"') or (len(pending) > 1 and pending[-2] == '\\'
+                                         and DKJsonStream._is_escape(pending, len(pending) - 2)):
+            raise ValueError('Unterminated string')
+        if len(pending) > 1:
+            yield json.loads(u'"%s"' % pending[:-1])
@@ -0,0 +1,273 @@
+import json
+import sqlite3
+import time
+
+__author__ = 'DataKitchen, Inc.'
+
+# order runs fetched for each order on a refresh; older ones stay in the cache from previous refreshes
+ORDER_CACHE_RUNS_PER_ORDER = 50
+FAILED_ORDER_RUN_STATUSES = ['SERVING_ERROR']
+# order runs in these states never change again, only their details are kept in the cache;
+# a failed order run can still be resumed (orderrun-resume) and an unknown state may be anything
+FINISHED_ORDER_RUN_STATUSES = ['COMPLETED_SERVING']
+# the parts of the order run details the server sends on request (orderrun-info)
+ORDER_RUN_DETAIL_OPTIONS = ['summary', 'logs', 'timingresults', 'testresults']
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS orders (
+        kitchen TEXT NOT NULL,
+        order_id TEXT NOT NULL,
+        recipe TEXT,
+        variation TEXT,
+        status TEXT,
+        order_json TEXT,
+        updated INTEGER,
+        PRIMARY KEY (kitchen, order_id))""",
+    """CREATE TABLE IF NOT EXISTS order_runs (
+        kitchen TEXT NOT NULL,
+        order_run_id TEXT NOT NULL,
+        order_id TEXT NOT NULL,
+        status TEXT,
+        start_time INTEGER,
+        end_time INTEGER,
+        duration INTEGER,
+        serving_json TEXT,
+        PRIMARY KEY (kitchen, order_run_id))""",
+    """CREATE INDEX IF NOT EXISTS order_runs_by_order ON order_runs (kitchen, order_id)""",
+    """CREATE INDEX IF NOT EXISTS order_runs_by_start_time ON order_runs (kitchen, start_time)""",
+    """CREATE TABLE IF NOT EXISTS order_run_details (
+        kitchen TEXT NOT NULL,
+        order_run_id TEXT NOT NULL,
+        options TEXT,
+        serving_json TEXT,
+        saved INTEGER,
+        PRIMARY KEY (kitchen, order_run_id))""",
+    """CREATE TABLE IF NOT EXISTS kitchens (
+        kitchen TEXT PRIMARY KEY,
+        newest_start_time INTEGER,
+        refreshed INTEGER)"""
+]
+
+
+class DKOrderCache(object):
+    """
+    Local SQLite copy of the orders and order runs of each kitchen (~/.dk/order_cache.db).
+
+    refresh() pages through the order list newest first and stops once a whole page brings
+    nothing new, so after the first run a refresh only downloads what changed.
+    Reports (get_orders, get_run_stats) then run on the local data.
+
+    The details of completed order runs (logs, test and timing results) never change, so the ones
+    already fetched are kept as well (get_order_run_detail, save_order_run_detail).
+    """
+
+    def __init__(self, db_file):
+        self._db_file = db_file
+        self._connection = sqlite3.connect(db_file, timeout=30)
+        with self._connection:
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _now():
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _parse_order_id(order_id):
+        # DKRecipe#dk#<recipe>#<variation>#<kitchen>#<chronos job number>
+        parts = order_id.split('#')
+        if len(parts) < 4:
+            return None, None
+        return parts[2], parts[3]
+
+    @staticmethod
+    def _get_timing(serving, name):
+        if 'timings' in serving and isinstance(serving['timings'], dict):
+            value = serving['timings'].get(name)
+            if isinstance(value, (int, long)):
+                return value
+        return None
+
+    def get_newest_start_time(self, kitchen):
+        row = self._connection.execute('SELECT newest_start_time FROM kitchens WHERE kitchen = ?',
+                                       (kitchen,)).fetchone()
+        return row[0] if row is not None else None
+
+    def refresh(self, dk_api, kitchen, recipe=None, page_size=None):
+        """
+        Brings the cache of a kitchen up to date.
+        :param dk_api: DKCloudAPI
+        :param page_size: orders per request, also the number of unchanged orders in a row that ends the refresh
+        :return: number of new or changed orders
+        """
+        if page_size is None:
+            page_size = dk_api.get_config().get_order_page_size()
+        newest_start_time = self.get_newest_start_time(kitchen)
+        changed_orders = 0
+        unchanged_in_a_row = 0
+        orders = dk_api.iter_orders(kitchen, page_size, ORDER_CACHE_RUNS_PER_ORDER, 0, recipe)
+        try:
+            with self._connection:
+                for order, servings in orders:
+                    if self._store_order(kitchen, order, servings, newest_start_time) is True:
+                        changed_orders += 1
+                        unchanged_in_a_row = 0
+                    else:
+                        unchanged_in_a_row += 1
+                        if newest_start_time is not None and unchanged_in_a_row >= page_size:
+                            break
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO kitchens (kitchen, newest_start_time, refreshed) '
+                    'VALUES (?, (SELECT MAX(start_time) FROM order_runs WHERE kitchen = ?), ?)',
+                    (kitchen, kitchen, DKOrderCache._now()))
+        finally:
+            orders.close()
+        return changed_orders
+
+    def _store_order(self, kitchen, order, servings, newest_start_time):
+        # returns True if the order or one of its runs is new or changed
+        order_id = order.get('serving_chronos_id')
+        if order_id is None:
+            return False
+        changed = False
+        status = order.get('chronos-status')
+        row = self._connection.execute('SELECT status FROM orders WHERE kitchen = ? AND order_id = ?',
+                                       (kitchen, order_id)).fetchone()
+        if row is None or row[0] != status:
+            recipe, variation = DKOrderCache._parse_order_id(order_id)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO orders (kitchen, order_id, recipe, variation, status, order_json, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kitchen, order_id, recipe, variation, status, json.dumps(order), DKOrderCache._now()))
+            changed = True
+
+        known_runs = dict(self._connection.execute(
+            'SELECT order_run_id, status FROM order_runs WHERE kitchen = ? AND order_id = ?', (kitchen, order_id)))
+        for serving in servings:
+            order_run_id = serving.get('serving_mesos_id')
+            if order_run_id is None:
+                continue
+            run_status = serving.get('orderrun_status', serving.get('status'))
+            start_time = DKOrderCache._get_timing(serving, 'start-time')
+            if order_run_id in known_runs and known_runs[order_run_id] == run_status and \
+                    (newest_start_time is None or start_time is None or start_time <= newest_start_time):
+                continue
+            self._connection.execute(
+                'INSERT OR REPLACE INTO order_runs (kitchen, order_run_id, order_id, status, start_time, end_time, '
+                'duration, serving_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kitchen, order_run_id, order_id, run_status, start_time,
+                 DKOrderCache._get_timing(serving, 'end-time'), DKOrderCache._get_timing(serving, 'duration'),
+                 json.dumps(serving)))
+            changed = True
+        return changed
+
+    @staticmethod
+    def _get_detail_options(pd):
+        return set(option for option in ORDER_RUN_DETAIL_OPTIONS if option in pd)
+
+    def get_order_run_detail(self, kitchen, order_run_id, pd):
+        """
+        :param pd: dict, the orderrun-info request; only the ORDER_RUN_DETAIL_OPTIONS keys matter
+        :return: serving dict as returned by the server, None unless a completed order run was fetched
+                 before with at least the options asked for now
+        """
+        row = self._connection.execute('SELECT options, serving_json FROM order_run_details '
+                                       'WHERE kitchen = ? AND order_run_id = ?', (kitchen, order_run_id)).fetchone()
+        if row is None or not DKOrderCache._get_detail_options(pd).issubset(json.loads(row[0])):
+            return None
+        return json.loads(row[1])
+
+    def save_order_run_detail(self, kitchen, order_run_id, pd, serving):
+        """
+        Keeps the serving fetched with the options in pd, if the order run has completed.
+        :return: True if it was kept
+        """
+        if serving.get('status') not in FINISHED_ORDER_RUN_STATUSES:
+            return False
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO order_run_details (kitchen, order_run_id, options, serving_json, saved) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (kitchen, order_run_id, json.dumps(sorted(DKOrderCache._get_detail_options(pd))),
+                 json.dumps(serving), DKOrderCache._now()))
+        return True
+
+    def forget_order_run_detail(self, order_run_id):
+        """
+        Drops the saved details of an order run, in whatever kitchen, e.g. once it is resumed.
+        """
+        with self._connection:
+            self._connection.execute('DELETE FROM order_run_details WHERE order_run_id = ?', (order_run_id,))
+
+    def evict(self, max_age_days=None, max_order_runs=None):
+        """
+        Drops order runs that started more than max_age_days ago, then the oldest ones above
+        max_order_runs, then the orders left without runs that were not updated within max_age_days.
+        Order run details saved more than max_age_days ago, or above max_order_runs, go too.
+        """
+        with self._connection:
+            if max_age_days is not None:
+                cutoff = DKOrderCache._now() - int(max_age_days * MILLISECONDS_PER_DAY)
+                self._connection.execute('DELETE FROM order_runs WHERE start_time < ?', (cutoff,))
+                self._connection.execute('DELETE FROM order_run_details WHERE saved < ?', (cutoff,))
+                self._connection.execute(
+                    'DELETE FROM orders WHERE updated < ? AND NOT EXISTS (SELECT 1 FROM order_runs r '
+                    'WHERE r.kitchen = orders.kitchen AND r.order_id = orders.order_id)', (cutoff,))
+            if max_order_runs is not None:
+                self._connection.execute(
+                    'DELETE FROM order_runs WHERE rowid IN (SELECT rowid FROM order_runs '
+                    'ORDER BY start_time DESC LIMIT -1 OFFSET ?)', (max_order_runs,))
+                self._connection.execute(
+                    'DELETE FROM order_run_details WHERE rowid IN (SELECT rowid FROM order_run_details '
+                    'ORDER BY saved DESC LIMIT -1 OFFSET ?)', (max_order_runs,))
+
+    def get_orders(self, kitchen, recipe=None, count=None, start=0):
+        """
+        :return: list of (order dict, list of serving dicts), the most recently run orders first
+        """
+        query = 'SELECT o.order_id, o.order_json, MAX(r.start_time) AS last_run FROM orders o ' \
+                'LEFT JOIN order_runs r ON r.kitchen = o.kitchen AND r.order_id = o.order_id WHERE o.kitchen = ?'
+        params = [kitchen]
+        if recipe is not None:
+            query += ' AND o.recipe = ?'
+            params.append(recipe)
+        query += ' GROUP BY o.order_id ORDER BY last_run IS NULL, last_run DESC, o.updated DESC LIMIT ? OFFSET ?'
+        params.extend([count if count is not None else -1, start])
+        orders = list()
+        for order_id, order_json, last_run in self._connection.execute(query, params).fetchall():
+            servings = [json.loads(serving_json) for (serving_json,) in self._connection.execute(
+                'SELECT serving_json FROM order_runs WHERE kitchen = ? AND order_id = ? ORDER BY start_time DESC',
+                (kitchen, order_id))]
+            orders.append((json.loads(order_json), servings))
+        return orders
+
+    def get_run_stats(self, kitchen, recipe=None, since=None):
+        """
+        Run count, failures and durations per recipe and variation.
+        :param since: only order runs started at or after this time, in milliseconds
+        :return: list of dicts with recipe, variation, runs, failed, avg_duration, max_duration
+        """
+        query = 'SELECT o.recipe, o.variation, COUNT(*), SUM(CASE WHEN r.status IN (%s) THEN 1 ELSE 0 END), ' \
+                'AVG(r.duration), MAX(r.duration) FROM order_runs r JOIN orders o ' \
+                'ON o.kitchen = r.kitchen AND o.order_id = r.order_id WHERE r.kitchen = ?' % \
+                ', '.join(['?'] * len(FAILED_ORDER_RUN_STATUSES))
+        params = list(FAILED_ORDER_RUN_STATUSES) + [kitchen]
+        if recipe is not None:
+            query += ' AND o.recipe = ?'
+            params.append(recipe)
+        if since is not None:
+            query += ' AND r.start_time >= ?'
+            params.append(since)
+        query += ' GROUP BY o.recipe, o.variation ORDER BY o.recipe, o.variation'
+        stats = list()
+        for recipe_name, variation, runs, failed, avg_duration, max_duration in \
+                self._connection.execute(query, params).fetchall():
+            stats.append({'recipe': recipe_name, 'variation': variation, 'runs': runs, 'failed': failed,
+                          'avg_duration': avg_duration, 'max_duration': max_duration})
+        return stats
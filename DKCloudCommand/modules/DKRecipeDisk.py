@@ -1,15 +1,29 @@
 import os
 import json
 import filecmp
+import shutil
+import tempfile
+import threading
+import time
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 import glob
 from githash import *
 import re
 import glob
 from DKKitchenDisk import DKKitchenDisk
 from DKIgnore import DKIgnore
-import sha
+from DKShaCache import DKShaCache
+from DKFileShaStore import DKFileShaStore, FILE_SHA
 
-from DKFileUtils import DKFileUtils
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # import os.path
 
@@ -25,7 +39,7 @@ __author__ = 'DataKitchen, Inc.'
 RECIPE_META = 'RECIPE_META'
 DK_CONFLICTS_META = 'conflicts.json'
 ORIG_HEAD = 'ORIG_HEAD'
-FILE_SHA = 'FILE_SHA'
+REMOTE_TREE = 'REMOTE_TREE'
 
 IGNORED_FILES = ['.DS_Store', '.dk', 'compiled-recipe']
 
@@ -46,7 +60,7 @@ class DKRecipeDisk:
     #     create the file
     #     write the contents
     #   write our metadata to the kitchen folder (.dk)
-    def save_recipe_to_disk(self, update_meta=True):
+    def save_recipe_to_disk(self, update_meta=True, max_workers=None):
         recipe_dict = self.recipe
         root_dir = self._recipe_path
 
@@ -56,8 +70,25 @@ class DKRecipeDisk:
             return None
 
         if update_meta:
-            if not self.write_recipe_meta(root_dir):
+            # the whole recipe: staged and swapped in along with its metadata
+            try:
+                materializer = DKRecipeMaterializer(root_dir, self._recipe_name, max_workers)
+            except ValueError as e:
+                print e.message
                 return None
+            try:
+                for recipe_file_key, files_list in recipe_dict.iteritems():
+                    if isinstance(files_list, list) is False:
+                        raise ValueError('unexpected entry in recipe folder %s' % recipe_file_key)
+                    materializer.add_folder(recipe_file_key)
+                    for file_dict in files_list:
+                        materializer.add_file(recipe_file_key, file_dict)
+                materializer.commit(self._recipe_sha)
+            except (ValueError, IOError, OSError) as e:
+                materializer.abort()
+                print 'Unable to save recipe %s: %s' % (self._recipe_name, str(e))
+                return None
+            return True
 
         for recipe_file_key, files_list in recipe_dict.iteritems():
             if len(recipe_file_key) > 0:
@@ -77,8 +108,6 @@ class DKRecipeDisk:
                     return None
                 self.write_files(full_dir, file_dict)
 
-        self.write_recipe_state_from_kitchen(root_dir)
-
         return True
 
     def write_recipe_meta(self, start_dir):
@@ -143,13 +172,24 @@ class DKRecipeDisk:
 
         shas = DKRecipeDisk.fetch_shas(recipe_dir)
 
-        recipe_sha_file = os.path.join(recipe_meta_dir, FILE_SHA)
+        DKRecipeDisk.save_file_shas(recipe_meta_dir, shas)
 
-        with open(recipe_sha_file,'w') as f:
-            f.write('\n'.join(['%s:%s' % item for item in shas.items()]))
+    @staticmethod
+    def save_file_shas(recipe_meta_dir, shas):
+        store = DKFileShaStore(recipe_meta_dir)
+        try:
+            store.replace(shas)
+        finally:
+            store.close()
 
     @staticmethod
-    def write_recipe_state_file_add(recipe_dir, file_recipe_path):
+    def update_recipe_state(recipe_dir, updated_paths=None, deleted_paths=None):
+        """
+        Refreshes the saved sha of the files that were added or updated on the server and forgets
+        the deleted ones, all in one write.
+        :param updated_paths: paths inside the recipe, e.g. 'node1/description.json'
+        :param deleted_paths: paths inside the recipe
+        """
         kitchen_meta_dir = DKKitchenDisk.find_kitchen_meta_dir(recipe_dir)
         if kitchen_meta_dir is None:
             print "Unable to find kitchen meta directory in '%s'" % recipe_dir
@@ -159,74 +199,36 @@ class DKRecipeDisk:
             print "Unable to find recipes meta directory in '%s'" % recipe_dir
             return False
 
-        _,recipe_name = os.path.split(recipe_dir)
+        _, recipe_name = os.path.split(recipe_dir)
         recipe_meta_dir = os.path.join(recipes_meta_dir, recipe_name)
-        recipe_sha_file = os.path.join(recipe_meta_dir, FILE_SHA)
 
-        contents = DKFileUtils.read_file(recipe_sha_file)
-        the_path = os.path.join(recipe_name, file_recipe_path)
-        full_file_path = os.path.join(recipe_dir, file_recipe_path)
-        the_sha = DKRecipeDisk.get_sha(full_file_path)
-        new_line = '\n%s:%s' % (the_path, the_sha)
-        contents += new_line
-        new_contents = contents.strip('\n')
-        DKFileUtils.write_file(recipe_sha_file, new_contents)
+        upserts = dict()
+        for file_recipe_path in updated_paths or []:
+            the_sha = DKRecipeDisk.get_sha(os.path.join(recipe_dir, file_recipe_path))
+            upserts[os.path.join(recipe_name, file_recipe_path)] = the_sha
+        deletes = [os.path.join(recipe_name, file_recipe_path) for file_recipe_path in deleted_paths or []]
 
-    @staticmethod
-    def write_recipe_state_file_delete(recipe_dir, file_recipe_path):
-        kitchen_meta_dir = DKKitchenDisk.find_kitchen_meta_dir(recipe_dir)
-        if kitchen_meta_dir is None:
-            print "Unable to find kitchen meta directory in '%s'" % recipe_dir
-            return False
-        recipes_meta_dir = DKKitchenDisk.get_recipes_meta_dir(kitchen_meta_dir)
-        if recipes_meta_dir is None:
-            print "Unable to find recipes meta directory in '%s'" % recipe_dir
-            return False
+        store = DKFileShaStore(recipe_meta_dir)
+        try:
+            store.update(upserts, deletes)
+        finally:
+            store.close()
+        return True
 
-        _, recipe_name = os.path.split(recipe_dir)
-        recipe_meta_dir = os.path.join(recipes_meta_dir, recipe_name)
-        recipe_sha_file = os.path.join(recipe_meta_dir, FILE_SHA)
+    @staticmethod
+    def write_recipe_state_file_add(recipe_dir, file_recipe_path):
+        return DKRecipeDisk.update_recipe_state(recipe_dir, updated_paths=[file_recipe_path])
 
-        contents = DKFileUtils.read_file(recipe_sha_file)
-        new_contents = ''
-        for line in contents.split('\n'):
-            if line.startswith(os.path.join(recipe_name, file_recipe_path)+':'):
-                pass  # removes the line
-            else:
-                new_contents += '%s\n' % line
-                new_contents = new_contents.strip('\n')
-        DKFileUtils.write_file(recipe_sha_file, new_contents)
+    @staticmethod
+    def write_recipe_state_file_delete(recipe_dir, file_recipe_path):
+        return DKRecipeDisk.update_recipe_state(recipe_dir, deleted_paths=[file_recipe_path])
 
     @staticmethod
     def write_recipe_state_file_update(recipe_dir, file_recipe_path):
-        kitchen_meta_dir = DKKitchenDisk.find_kitchen_meta_dir(recipe_dir)
-        if kitchen_meta_dir is None:
-            print "Unable to find kitchen meta directory in '%s'" % recipe_dir
-            return False
-        recipes_meta_dir = DKKitchenDisk.get_recipes_meta_dir(kitchen_meta_dir)
-        if recipes_meta_dir is None:
-            print "Unable to find recipes meta directory in '%s'" % recipe_dir
-            return False
-
-        _, recipe_name = os.path.split(recipe_dir)
-        recipe_meta_dir = os.path.join(recipes_meta_dir, recipe_name)
-        recipe_sha_file = os.path.join(recipe_meta_dir, FILE_SHA)
-
-        contents = DKFileUtils.read_file(recipe_sha_file)
-        new_contents = ''
-        for line in contents.split('\n'):
-            if line.startswith(os.path.join(recipe_name, file_recipe_path)+':'):
-                full_file_path = os.path.join(recipe_dir, file_recipe_path)
-                the_sha = DKRecipeDisk.get_sha(full_file_path)
-                the_path = os.path.join(recipe_name, file_recipe_path)
-                new_contents += '%s:%s\n' % (the_path, the_sha)
-            else:
-                new_contents += '%s\n' % line
-        new_contents = new_contents.strip('\n')
-        DKFileUtils.write_file(recipe_sha_file, new_contents)
+        return DKRecipeDisk.update_recipe_state(recipe_dir, updated_paths=[file_recipe_path])
 
     @staticmethod
-    def get_changed_files(start_dir, recipe_name):
+    def get_changed_files(start_dir, recipe_name, current_shas=None):
 
         kitchen_meta_dir = DKKitchenDisk.find_kitchen_meta_dir(start_dir)
         if kitchen_meta_dir is None:
@@ -239,7 +241,8 @@ class DKRecipeDisk:
 
         recipe_meta_dir = os.path.join(recipes_meta_dir, recipe_name)
 
-        current_shas = DKRecipeDisk.fetch_shas(start_dir)
+        if current_shas is None:
+            current_shas = DKRecipeDisk.fetch_shas(start_dir)
 
         saved_shas = DKRecipeDisk.load_saved_shas(recipe_meta_dir)
 
@@ -260,50 +263,21 @@ class DKRecipeDisk:
 
     @staticmethod
     def load_saved_shas(recipe_meta_dir):
-        saved_shas = {}
-
-        sha_file = os.path.join(recipe_meta_dir, FILE_SHA)
-
-        if not os.path.isfile(sha_file):
-            return None
-
-        with open(sha_file,'r') as f:
-            for line in f.readlines():
-                path,sha = line.strip().split(':')
-                saved_shas[path] = sha
-
-        return saved_shas
+        store = DKFileShaStore(recipe_meta_dir)
+        try:
+            return store.load()
+        finally:
+            store.close()
 
     @staticmethod
     def fetch_shas(base_dir):
-        shas = DKRecipeDisk.do_fetch_shas(base_dir)
-
-        parent_path,recipe_dir = os.path.split(base_dir) 
-
-        return {p[len(parent_path)+1:]:v for p,v in shas.items()}
-
-    @staticmethod
-    def do_fetch_shas(base_dir):
-
-        result = {}
-
-        for item in os.listdir(base_dir):
-
-            if item not in IGNORED_FILES:
-                item_path = os.path.join(base_dir,item)
-
-                if os.path.isfile(item_path):
-                    result[item_path] = DKRecipeDisk.get_sha(item_path)
-                elif os.path.isdir(item_path):
-                    result.update(DKRecipeDisk.do_fetch_shas(item_path))
-
-        return result
+        _, file_shas = scan_recipe_dir(base_dir)
+        return file_shas
 
     @staticmethod
     def get_sha(path):
-        with open(path,'r') as f:
-            data = f.read()
-        return sha.new(data).hexdigest()
+        _, the_sha = hash_file(path)
+        return the_sha
 
     @staticmethod
     def get_orig_head(start_dir):
@@ -323,6 +297,60 @@ class DKRecipeDisk:
             return None
         return orig_head
 
+    @staticmethod
+    def load_remote_tree(start_dir, kitchen, recipe):
+        """
+        Returns the remote recipe tree saved by the last recipe-status, if it is still usable:
+        same kitchen, recipe and ORIG_HEAD as the local recipe, and saved with an etag.
+        :return: tuple (etag, tree), or (None, None)
+        """
+        recipe_meta_dir = DKRecipeDisk.find_recipe_meta_dir(start_dir)
+        if not recipe_meta_dir:
+            return None, None
+        remote_tree_file = os.path.join(recipe_meta_dir, REMOTE_TREE)
+        if not os.path.isfile(remote_tree_file):
+            return None, None
+        try:
+            with open(remote_tree_file, 'r') as f:
+                remote_tree = json.load(f)
+        except (IOError, ValueError):
+            return None, None
+        if not isinstance(remote_tree, dict) or remote_tree.get('kitchen') != kitchen or \
+                remote_tree.get('recipe') != recipe:
+            return None, None
+        # a recipe-get, merge or swap since the tree was saved gives the recipe another base
+        orig_head = DKRecipeDisk.get_orig_head(start_dir)
+        if orig_head is None or remote_tree.get('orig_head') != orig_head:
+            return None, None
+        if remote_tree.get('etag') is None or remote_tree.get('tree') is None:
+            return None, None
+        return remote_tree['etag'], remote_tree['tree']
+
+    @staticmethod
+    def save_remote_tree(start_dir, kitchen, recipe, etag, tree):
+        recipe_meta_dir = DKRecipeDisk.find_recipe_meta_dir(start_dir)
+        if not recipe_meta_dir:
+            return False
+        remote_tree_file = os.path.join(recipe_meta_dir, REMOTE_TREE)
+        if etag is None:
+            # Without an etag the server can not tell us the tree is unchanged, so there is nothing to cache.
+            if os.path.isfile(remote_tree_file):
+                os.remove(remote_tree_file)
+            return False
+        remote_tree = dict()
+        remote_tree['kitchen'] = kitchen
+        remote_tree['recipe'] = recipe
+        remote_tree['orig_head'] = DKRecipeDisk.get_orig_head(start_dir)
+        remote_tree['etag'] = etag
+        remote_tree['tree'] = tree
+        try:
+            with open(remote_tree_file, 'w') as f:
+                json.dump(remote_tree, f)
+        except IOError as e:
+            print "%s - %s - %s" % (e.filename, e.errno, e.message)
+            return False
+        return True
+
     @staticmethod
     def create_conflicts_meta(recipe_meta_dir):
         conflicts_file_path = os.path.join(recipe_meta_dir, DK_CONFLICTS_META)
@@ -335,18 +363,9 @@ class DKRecipeDisk:
 
     @staticmethod
     def add_conflict_to_conflicts_meta(conflict_info, folder_in_recipe, recipe_name, kitchen_dir):
-        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir(recipe_name, kitchen_dir)
-        conflicts_meta = DKRecipeDisk.get_conflicts_meta(recipe_meta_dir)
-        conflict_key = '%s|%s|%s|%s|%s' % (conflict_info['from_kitchen'], conflict_info['to_kitchen'], recipe_name,
-                                           folder_in_recipe, conflict_info['filename'])
-
-        conflict_for_save = conflict_info.copy()
-        conflict_for_save['folder_in_recipe'] = folder_in_recipe
-        conflict_for_save['status'] = 'unresolved'
-        if folder_in_recipe not in conflicts_meta:
-            conflicts_meta[folder_in_recipe] = {}
-        conflicts_meta[folder_in_recipe][conflict_key] = conflict_for_save
-        return DKRecipeDisk.save_conflicts_meta(recipe_meta_dir, conflicts_meta)
+        conflicts_store = DKConflictsStore(DKKitchenDisk.get_recipe_meta_dir(recipe_name, kitchen_dir))
+        conflicts_store.add(conflict_info, folder_in_recipe, recipe_name)
+        return conflicts_store.flush()
 
     @staticmethod
     def get_conflicts_meta(recipe_meta_dir):
@@ -360,59 +379,31 @@ class DKRecipeDisk:
 
     @staticmethod
     def get_unresolved_conflicts_meta(recipe_meta_dir, from_kitchen=None, to_kitchen=None):
-        conflicts = DKRecipeDisk.get_conflicts_meta(recipe_meta_dir)
-        unresolved_conflicts = {}
-        for recipe_folder, folder_conflicts in conflicts.iteritems():
-            for conflict_key, conflict_info in folder_conflicts.iteritems():
-                if conflict_info['status'] == 'unresolved':
-                    add_it = True
-                    if from_kitchen is not None and to_kitchen is not None:
-                        if from_kitchen != conflict_info['from_kitchen'] or conflict_info['to_kitchen'] != to_kitchen:
-                            add_it = False
-                    if add_it:
-                        if recipe_folder not in unresolved_conflicts:
-                            unresolved_conflicts[recipe_folder] = {}
-                        unresolved_conflicts[recipe_folder][conflict_key] = conflict_info
-        return unresolved_conflicts
+        return DKConflictsStore(recipe_meta_dir).get_conflicts('unresolved', from_kitchen, to_kitchen)
 
     @staticmethod
     def get_resolved_conflicts_meta(recipe_meta_dir, from_kitchen=None, to_kitchen=None):
-        conflicts = DKRecipeDisk.get_conflicts_meta(recipe_meta_dir)
-        resolved_conflicts = {}
-        for recipe_folder, folder_conflicts in conflicts.iteritems():
-            for conflict_key, conflict_info in folder_conflicts.iteritems():
-                if conflict_info['status'] == 'resolved':
-                    add_it = True
-                    if from_kitchen is not None and to_kitchen is not None:
-                        if from_kitchen != conflict_info['from_kitchen'] or conflict_info['to_kitchen'] != to_kitchen:
-                            add_it = False
-                    if add_it:
-                        if recipe_folder not in resolved_conflicts:
-                            resolved_conflicts[recipe_folder] = {}
-                        resolved_conflicts[recipe_folder][conflict_key] = conflict_info
-                    else:
+        conflicts_store = DKConflictsStore(recipe_meta_dir)
+        if from_kitchen is not None and to_kitchen is not None:
+            for other_from_kitchen, other_to_kitchen in conflicts_store.get_kitchen_pairs():
+                if (other_from_kitchen, other_to_kitchen) == (from_kitchen, to_kitchen):
+                    continue
+                for folder_conflicts in conflicts_store.get_conflicts('resolved', other_from_kitchen,
+                                                                      other_to_kitchen).itervalues():
+                    for conflict_info in folder_conflicts.itervalues():
                         print "Found a resolved conflict for from '%s' to '%s', but we are looking for from '%s' to '%s'" % (
                             conflict_info['from_kitchen'], conflict_info['to_kitchen'], from_kitchen, to_kitchen)
-        return resolved_conflicts
+        return conflicts_store.get_conflicts('resolved', from_kitchen, to_kitchen)
 
     @staticmethod
     def resolve_conflict(recipe_meta_dir, recipe_root_dir, file_path):
-        all_conflicts = DKRecipeDisk.get_conflicts_meta(recipe_meta_dir)
         norm_file_path = os.path.normpath(file_path)
         local_path_in_recipe = norm_file_path.replace(recipe_root_dir, '')
         local_path_in_recipe = re.sub("^" + os.sep + "|/$", "", local_path_in_recipe)
-        recipe_name = DKRecipeDisk.find_recipe_name(recipe_root_dir)
-        for recipe_folder, folder_contents in all_conflicts.iteritems():
-            for conflict_key, conflict_info in folder_contents.iteritems():
-                if conflict_info['status'] == 'unresolved':
-                    path_in_recipe = os.path.join(conflict_info['folder_in_recipe'], conflict_info['filename'])
-                    path_in_recipe = re.sub(r'%s/' % recipe_name, r'', path_in_recipe)
-                    if local_path_in_recipe == path_in_recipe:
-                        conflict_info['status'] = 'resolved'
-                        folder_contents[conflict_key] = conflict_info
-                        DKRecipeDisk.save_conflicts_meta(recipe_meta_dir, all_conflicts)
-                        return True
-        return False
+        conflicts_store = DKConflictsStore(recipe_meta_dir)
+        if not conflicts_store.resolve(local_path_in_recipe):
+            return False
+        return conflicts_store.flush()
 
     @staticmethod
     def save_conflicts_meta(recipe_meta_dir, conflicts_meta):
@@ -519,22 +510,314 @@ class DKRecipeDisk:
         #    file_name = this_file
         return list_of_files
 
+    @staticmethod
+    def get_file_contents(file_dict):
+        # the bytes of a {'filename', 'json'|'text'} entry as received from the server
+        if 'json' in file_dict:
+            if isinstance(file_dict['json'], dict) is True:
+                return json.dumps(file_dict['json'], indent=4)
+            else:
+                return file_dict['json'].encode('utf8')
+        elif 'text' in file_dict:
+            return file_dict['text'].encode('utf8')
+        return ''
+
     @staticmethod
     def write_files(full_dir, file_dict):
         if 'filename' in file_dict:
             abspath = os.path.join(full_dir, file_dict['filename'])
             with open(abspath, 'wb') as the_file:
-                the_file.seek(0)
-                the_file.truncate()
-                if 'json' in file_dict:
-                    if isinstance(file_dict['json'], dict) is True:
-                        json.dump(file_dict['json'], the_file, indent=4)
-                    else:
-                        the_file.write(file_dict['json'].encode('utf8'))
-                elif 'text' in file_dict:
-                    the_file.seek(0)
-                    the_file.truncate()
-                    the_file.write(file_dict['text'].encode('utf8'))
+                the_file.write(DKRecipeDisk.get_file_contents(file_dict))
+
+
+class DKRecipeMaterializer(object):
+    """
+    Writes a whole recipe received from the server into <kitchen>/<recipe> so that either all of it
+    lands or nothing changes.
+
+    Files are written by a thread pool into a staging folder under the kitchen's .dk folder (same
+    file system as the recipe). A file whose content matches the one already on disk is hard linked
+    instead of written. commit() then swaps the staged recipe and its metadata (RECIPE_META,
+    ORIG_HEAD, FILE_SHA) in with renames, undoing them if one fails; abort() drops the staging folder.
+    If the renames could not be undone the staging folder holds the old recipe and is kept.
+    """
+    STAGE_PREFIX = 'stage-'
+    # staging folders left by interrupted runs are removed once they are this old (seconds)
+    STAGE_MAX_AGE = 24 * 3600
+
+    def __init__(self, kitchen_dir, recipe_name, max_workers=None):
+        if not DKKitchenDisk.is_kitchen_root_dir(kitchen_dir):
+            raise ValueError("'%s' is not a Kitchen directory" % kitchen_dir)
+        kitchen_meta_dir = DKKitchenDisk.find_kitchen_meta_dir(kitchen_dir)
+        DKRecipeMaterializer._prune_stage_dirs(kitchen_meta_dir)
+        self._recipe_name = recipe_name
+        self._recipe_dir = os.path.join(kitchen_dir, recipe_name)
+        self._recipe_meta_dir = os.path.join(DKKitchenDisk.get_recipes_meta_dir(kitchen_meta_dir), recipe_name)
+        self._stage_dir = tempfile.mkdtemp(prefix=DKRecipeMaterializer.STAGE_PREFIX, dir=kitchen_meta_dir)
+        self._staged_recipe_dir = os.path.join(self._stage_dir, 'recipe')
+        self._staged_meta_dir = os.path.join(self._stage_dir, 'meta')
+        os.mkdir(self._staged_recipe_dir)
+        os.mkdir(self._staged_meta_dir)
+
+        if max_workers is None or max_workers < 1:
+            max_workers = 1
+        self._pool = ThreadPool(max_workers)
+        # files handed to the pool and not written yet, so memory stays bounded on a slow disk
+        self._in_flight = threading.BoundedSemaphore(max_workers * 2)
+        self._results = list()
+        self._lock = threading.Lock()
+        self._folders = set()
+        self._file_shas = dict()
+        self._linked_files = 0
+        self._sha_cache = DKShaCache(self._recipe_dir) if os.path.isdir(self._recipe_dir) else None
+        # set once the renames start, the staging folder may then hold the only copy of the old recipe
+        self._swap_started = False
+
+    @staticmethod
+    def _prune_stage_dirs(kitchen_meta_dir):
+        now = time.time()
+        for name in os.listdir(kitchen_meta_dir):
+            stage_dir = os.path.join(kitchen_meta_dir, name)
+            if not name.startswith(DKRecipeMaterializer.STAGE_PREFIX) or not os.path.isdir(stage_dir):
+                continue
+            # a swap that could not be undone, keep it for the user
+            if os.path.exists(os.path.join(stage_dir, 'old-recipe')) or \
+                    os.path.exists(os.path.join(stage_dir, 'old-meta')):
+                continue
+            try:
+                if now - os.path.getmtime(stage_dir) > DKRecipeMaterializer.STAGE_MAX_AGE:
+                    shutil.rmtree(stage_dir, ignore_errors=True)
+            except OSError:
+                pass
+
+    def _staged_path(self, recipe_file_key):
+        # recipe_file_key is 'recipe/folder/...'
+        parts = recipe_file_key.split('/')
+        if parts[0] != self._recipe_name or '..' in parts:
+            raise ValueError('unexpected recipe folder %s' % recipe_file_key)
+        return os.path.join(self._staged_recipe_dir, *parts[1:])
+
+    def add_folder(self, recipe_file_key):
+        if recipe_file_key not in self._folders:
+            full_dir = self._staged_path(recipe_file_key)
+            if not os.path.isdir(full_dir):
+                os.makedirs(full_dir)
+            self._folders.add(recipe_file_key)
+
+    def add_file(self, recipe_file_key, file_dict):
+        if isinstance(file_dict, dict) is False or 'filename' not in file_dict:
+            raise ValueError('unexpected entry in recipe folder %s' % recipe_file_key)
+        self.add_folder(recipe_file_key)
+        self._raise_failures(wait=False)
+        self._in_flight.acquire()
+        self._results.append(self._pool.apply_async(self._write_file, (recipe_file_key, file_dict)))
+
+    def _write_file(self, recipe_file_key, file_dict):
+        try:
+            contents = DKRecipeDisk.get_file_contents(file_dict)
+            the_sha = sha1(contents).hexdigest()
+            staged_file = os.path.join(self._staged_path(recipe_file_key), file_dict['filename'])
+            current_file = os.path.join(self._recipe_dir, *(recipe_file_key.split('/')[1:] + [file_dict['filename']]))
+            if not self._link_if_same(current_file, staged_file, len(contents), the_sha):
+                with open(staged_file, 'wb') as the_file:
+                    the_file.write(contents)
+            with self._lock:
+                self._file_shas[os.path.join(recipe_file_key, file_dict['filename'])] = the_sha
+        finally:
+            self._in_flight.release()
+
+    def _link_if_same(self, current_file, staged_file, size, the_sha):
+        if self._sha_cache is None or not hasattr(os, 'link') or not os.path.isfile(current_file):
+            return False
+        try:
+            if os.path.getsize(current_file) != size:
+                return False
+            with self._lock:
+                _, current_sha = self._sha_cache.get_shas(current_file)
+            if current_sha != the_sha:
+                return False
+            os.link(current_file, staged_file)
+        except OSError:
+            # e.g. a file system without hard links
+            return False
+        with self._lock:
+            self._linked_files += 1
+        return True
+
+    def _raise_failures(self, wait=True):
+        pending = list()
+        for result in self._results:
+            if wait or result.ready():
+                result.get()
+            else:
+                pending.append(result)
+        self._results = pending
+
+    def get_linked_files(self):
+        # files that were already on disk and not written again
+        return self._linked_files
+
+    def commit(self, recipe_sha):
+        try:
+            self._raise_failures()
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+        with open(os.path.join(self._staged_meta_dir, RECIPE_META), 'w') as f:
+            f.write(self._recipe_name)
+        with open(os.path.join(self._staged_meta_dir, ORIG_HEAD), 'w') as f:
+            f.write(recipe_sha)
+        DKRecipeDisk.save_file_shas(self._staged_meta_dir, self._file_shas)
+        if self._sha_cache is not None:
+            self._sha_cache.save()
+        if os.path.isdir(self._recipe_meta_dir):
+            # keep the rest of the metadata, e.g. conflicts and caches, but not the remote tree of the old base
+            for name in os.listdir(self._recipe_meta_dir):
+                if name not in [RECIPE_META, ORIG_HEAD, REMOTE_TREE] and not name.startswith(FILE_SHA):
+                    source = os.path.join(self._recipe_meta_dir, name)
+                    if os.path.isfile(source):
+                        shutil.copy2(source, os.path.join(self._staged_meta_dir, name))
+
+        renames = list()
+        if os.path.exists(self._recipe_dir):
+            renames.append((self._recipe_dir, os.path.join(self._stage_dir, 'old-recipe')))
+        renames.append((self._staged_recipe_dir, self._recipe_dir))
+        if os.path.exists(self._recipe_meta_dir):
+            renames.append((self._recipe_meta_dir, os.path.join(self._stage_dir, 'old-meta')))
+        renames.append((self._staged_meta_dir, self._recipe_meta_dir))
+        done = list()
+        self._swap_started = True
+        try:
+            for source, target in renames:
+                os.rename(source, target)
+                done.append((source, target))
+        except OSError as e:
+            try:
+                for source, target in reversed(done):
+                    os.rename(target, source)
+            except OSError as undo_error:
+                # the old recipe stays in the staging folder, abort() will not remove it
+                raise OSError(undo_error.errno, 'could not put the old recipe back (%s), it was left in %s' %
+                              (str(e), self._stage_dir))
+            self._swap_started = False
+            shutil.rmtree(self._stage_dir, ignore_errors=True)
+            raise
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
+        return True
+
+    def abort(self):
+        self._pool.terminate()
+        self._pool.join()
+        if not self._swap_started:
+            shutil.rmtree(self._stage_dir, ignore_errors=True)
+
+
+class DKConflictsStore(object):
+    """
+    The merge conflicts of a recipe (.dk/recipes/<recipe>/conflicts.json), read once and kept in memory.
+
+    add() and resolve() only change the copy in memory; flush() writes the file once for all of them,
+    so recording hundreds of conflicts in a command does not rewrite the file for each one. Conflicts
+    are indexed by (from_kitchen, to_kitchen) and then by their path in the recipe.
+    """
+
+    def __init__(self, recipe_meta_dir):
+        self._recipe_meta_dir = recipe_meta_dir
+        self._recipe_name = os.path.basename(os.path.normpath(recipe_meta_dir))
+        # {folder_in_recipe: {conflict_key: conflict_info}}, as in conflicts.json
+        self._conflicts = None
+        # {(from_kitchen, to_kitchen): {path in recipe: (folder_in_recipe, conflict_key)}}
+        self._index = None
+        self._dirty = False
+
+    def _load(self):
+        if self._conflicts is None:
+            self._conflicts = DKRecipeDisk.get_conflicts_meta(self._recipe_meta_dir)
+            self._index = dict()
+            for folder_in_recipe, folder_conflicts in self._conflicts.iteritems():
+                for conflict_key, conflict_info in folder_conflicts.iteritems():
+                    self._add_to_index(folder_in_recipe, conflict_key, conflict_info)
+        return self._conflicts
+
+    def _path_in_recipe(self, folder_in_recipe, filename):
+        # folders are 'recipe/folder/...', the path is relative to the recipe root
+        parts = os.path.normpath(os.path.join(folder_in_recipe, filename)).split(os.sep, 1)
+        if len(parts) == 2 and parts[0] == self._recipe_name:
+            return parts[1]
+        return os.sep.join(parts)
+
+    def _add_to_index(self, folder_in_recipe, conflict_key, conflict_info):
+        kitchen_pair = (conflict_info['from_kitchen'], conflict_info['to_kitchen'])
+        path_in_recipe = self._path_in_recipe(conflict_info['folder_in_recipe'], conflict_info['filename'])
+        self._index.setdefault(kitchen_pair, dict())[path_in_recipe] = (folder_in_recipe, conflict_key)
+
+    def add(self, conflict_info, folder_in_recipe, recipe_name):
+        conflicts = self._load()
+        conflict_key = '%s|%s|%s|%s|%s' % (conflict_info['from_kitchen'], conflict_info['to_kitchen'], recipe_name,
+                                           folder_in_recipe, conflict_info['filename'])
+
+        conflict_for_save = conflict_info.copy()
+        conflict_for_save['folder_in_recipe'] = folder_in_recipe
+        conflict_for_save['status'] = 'unresolved'
+        conflicts.setdefault(folder_in_recipe, dict())[conflict_key] = conflict_for_save
+        self._add_to_index(folder_in_recipe, conflict_key, conflict_for_save)
+        self._dirty = True
+
+    def get_kitchen_pairs(self):
+        self._load()
+        return self._index.keys()
+
+    def get_conflicts(self, status, from_kitchen=None, to_kitchen=None):
+        """
+        :param status: 'unresolved' or 'resolved'
+        :param from_kitchen: with to_kitchen, only the conflicts of that merge; all of them when None
+        :return: {folder_in_recipe: {conflict_key: conflict_info}}
+        """
+        conflicts = self._load()
+        if from_kitchen is not None and to_kitchen is not None:
+            kitchen_pairs = [(from_kitchen, to_kitchen)]
+        else:
+            kitchen_pairs = self._index.keys()
+        found = dict()
+        for kitchen_pair in kitchen_pairs:
+            for folder_in_recipe, conflict_key in self._index.get(kitchen_pair, dict()).itervalues():
+                conflict_info = conflicts[folder_in_recipe][conflict_key]
+                if conflict_info['status'] == status:
+                    found.setdefault(folder_in_recipe, dict())[conflict_key] = conflict_info
+        return found
+
+    def resolve(self, path_in_recipe, from_kitchen=None, to_kitchen=None):
+        """
+        Marks the unresolved conflict of the file at path_in_recipe (relative to the recipe root) resolved.
+        :return: False if that file has no unresolved conflict
+        """
+        conflicts = self._load()
+        if from_kitchen is not None and to_kitchen is not None:
+            kitchen_pairs = [(from_kitchen, to_kitchen)]
+        else:
+            kitchen_pairs = self._index.keys()
+        for kitchen_pair in kitchen_pairs:
+            location = self._index.get(kitchen_pair, dict()).get(path_in_recipe)
+            if location is None:
+                continue
+            conflict_info = conflicts[location[0]][location[1]]
+            if conflict_info['status'] == 'unresolved':
+                conflict_info['status'] = 'resolved'
+                self._dirty = True
+                return True
+        return False
+
+    def flush(self):
+        """
+        Writes conflicts.json if anything changed since it was read or last flushed.
+        """
+        if not self._dirty:
+            return True
+        if not DKRecipeDisk.save_conflicts_meta(self._recipe_meta_dir, self._conflicts):
+            return False
+        self._dirty = False
+        return True
 
 
 # http://stackoverflow.com/questions/4187564/recursive-dircmp-compare-two-directories-to-ensure-they-have-the-same-files-and
@@ -583,56 +866,53 @@ def compare_sha(remote_sha, local_sha):
     only_local_dir = dict()
     only_remote = dict()
     only_remote_dir = dict()
+
+    # Index the local files by folder and file name, so each lookup is a dict access.
+    local_index = dict()
+    for local_path, local_files in local_sha.iteritems():
+        files_by_name = dict()
+        for local_file in local_files:
+            if local_file['filename'] not in files_by_name:
+                files_by_name[local_file['filename']] = local_file
+        local_index[local_path] = files_by_name
+
     # Look for differences from remote
-    for remote_path in remote_sha:
-        for remote_file in remote_sha[remote_path]:
-            if remote_path in local_sha:
-                local_files_found = filter(lambda local_file: local_file['filename'] == remote_file['filename'],
-                                           local_sha[remote_path])
-            else:
-                if remote_path not in only_remote_dir:
-                    only_remote_dir[remote_path] = list()
-                local_files_found = list()
-            if len(local_files_found) != 0:
-                if local_files_found[0]['sha'] == remote_file['sha']:
-                    # print '%s matches' % remote_file['filename']
-                    if remote_path not in same:
-                        same[remote_path] = list()
-                    same[remote_path].append(remote_file)
-                else:
-                    if remote_path not in different:
-                        different[remote_path] = list()
-                    # print '%s different' % remote_file['filename']
-                    different[remote_path].append(remote_file)
-            elif len(local_files_found) > 1:
-                # print 'compare_sha: Unexpected return in remote_path'
-                raise
-            else:
+    for remote_path, remote_files in remote_sha.iteritems():
+        local_files_by_name = local_index.get(remote_path)
+        if local_files_by_name is None:
+            if len(remote_files) > 0:
+                only_remote_dir[remote_path] = list()
+            local_files_by_name = dict()
+        for remote_file in remote_files:
+            local_file = local_files_by_name.get(remote_file['filename'])
+            if local_file is None:
                 # print '%s not found for local' % remote_file['filename']
                 if remote_path not in only_remote:
                     only_remote[remote_path] = list()
                 only_remote[remote_path].append(remote_file)
+            elif local_file['sha'] == remote_file['sha']:
+                # print '%s matches' % remote_file['filename']
+                if remote_path not in same:
+                    same[remote_path] = list()
+                same[remote_path].append(remote_file)
+            else:
+                # print '%s different' % remote_file['filename']
+                if remote_path not in different:
+                    different[remote_path] = list()
+                different[remote_path].append(remote_file)
 
     ignore = DKIgnore()
     for local_path, local_files in local_sha.iteritems():
         if ignore.ignore(local_path):
             # Ignore some stuff.
-            # print '%s ignoring' % local_path
             continue
         elif local_path in remote_sha:
+            remote_file_names = set(remote_file['filename'] for remote_file in remote_sha[local_path])
             for local_file in local_files:
-                if ignore.ignore(local_file['filename']):
-                    # print '%s ignoring' % local_file['filename']
+                if ignore.ignore(local_file['filename']) or \
+                        ignore.ignore(os.path.join(local_path, local_file['filename'])):
                     continue
-                elif ignore.ignore(os.path.join(local_path, local_file['filename'])):
-                    # print '%s ignoring' % os.path.join(local_path, local_file['filename'])
-                    continue
-                remote_files_found = filter(lambda remote_file: remote_file['filename'] == local_file['filename'],
-                                            remote_sha[local_path])
-                if len(remote_files_found) > 1:
-                    # print 'compare_sha: Unexpected return in remote_path'
-                    raise
-                elif len(remote_files_found) == 0:
+                if local_file['filename'] not in remote_file_names:
                     if local_path not in only_local:
                         only_local[local_path] = list()
                     # print '%s missing from remote' % local_file['filename']
@@ -641,9 +921,7 @@ def compare_sha(remote_sha, local_sha):
             if local_path not in only_local:
                 # print '%s missing from remote' % local_path
                 only_local_dir[local_path] = list()
-                only_local[local_path] = list()
-                for local_file in local_files:
-                    only_local[local_path].append(local_file)
+                only_local[local_path] = list(local_files)
 
     rv = dict()
     rv['same'] = same
@@ -655,24 +933,49 @@ def compare_sha(remote_sha, local_sha):
     return rv
 
 
-def get_directory_sha(walk_dir):
-    recipe_name = os.path.basename(walk_dir)
-    rootdir = os.path.dirname(walk_dir)
-    r = dict()
-    r[recipe_name] = []
-    for root, subdirs, files in os.walk(walk_dir):
-        for filename in files:
-            if not filename in IGNORED_FILES:
-                file_path = os.path.join(root, filename)
-                part = file_path.split(rootdir, 1)[1]
-                part2 = part.split(filename, 1)[0]
-                part3 = part2[1:-1]
-                with open(file_path) as file_obj:
-                    r[part3].append({'filename': filename, 'sha': githash_fileobj(file_obj)})
-        for subdir in subdirs:
-            subdir_fullpath = os.path.join(root, subdir)
-            part = subdir_fullpath.split(rootdir, 1)[1]
-            part2 = part[1:]
-            r[part2] = []
-    return r
+def _list_dir(dir_path):
+    # yields (name, path, is_dir, is_file, is_link), using scandir when available to save a stat per entry
+    if scandir is not None:
+        for entry in scandir(dir_path):
+            yield entry.name, entry.path, entry.is_dir(), entry.is_file(), entry.is_symlink()
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            yield name, path, os.path.isdir(path), os.path.isfile(path), os.path.islink(path)
 
+
+def scan_recipe_dir(recipe_dir):
+    """
+    Walks a local recipe once and hashes every file once, skipping anything named in IGNORED_FILES.
+    :param recipe_dir: recipe root directory
+    :return: tuple (directory_sha, file_shas)
+        directory_sha: {recipe_folder: [{'filename', 'sha'}]} with git blob shas, as used by compare_sha
+        file_shas: {recipe_file: sha1}, as stored in FILE_SHA
+    """
+    recipe_name = os.path.basename(recipe_dir)
+    sha_cache = DKShaCache(recipe_dir)
+    directory_sha = dict()
+    file_shas = dict()
+    pending = [(recipe_dir, recipe_name)]
+    while len(pending) > 0:
+        dir_path, folder = pending.pop()
+        folder_files = directory_sha[folder] = list()
+        for name, path, is_dir, is_file, is_link in sorted(_list_dir(dir_path)):
+            if name in IGNORED_FILES:
+                continue
+            if is_dir and is_link:
+                # listed but not followed, as os.walk does: it may point back up the tree
+                directory_sha[os.path.join(folder, name)] = list()
+            elif is_dir:
+                pending.append((path, os.path.join(folder, name)))
+            elif is_file:
+                the_githash, the_sha = sha_cache.get_shas(path)
+                folder_files.append({'filename': name, 'sha': the_githash})
+                file_shas[os.path.join(folder, name)] = the_sha
+    sha_cache.save(prune=True)
+    return directory_sha, file_shas
+
+
+def get_directory_sha(walk_dir):
+    directory_sha, _ = scan_recipe_dir(walk_dir)
+    return directory_sha
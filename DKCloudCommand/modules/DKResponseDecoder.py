@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+
+__author__ = 'DataKitchen, Inc.'
+
+# Set DKCLI_DEBUG to print how long each response took to decode.
+DEBUG_ENV = 'DKCLI_DEBUG'
+# Set DKCLI_JSON_BACKEND to 'json' to skip the optional fast parsers.
+JSON_BACKEND_ENV = 'DKCLI_JSON_BACKEND'
+FAST_JSON_BACKENDS = ['ujson', 'simplejson']
+
+SHAPE_EMPTY = 'empty'
+SHAPE_JSON = 'json'
+SHAPE_ENCODED = 'json-encoded-string'
+
+# leading characters skipped when looking at the shape of a body
+_WHITESPACE = ' \t\r\n'
+_UTF8_BOM = '\xef\xbb\xbf'
+# fields the server sends as a JSON document inside a string, e.g. the summary of an order run
+EMBEDDED_JSON_FIELDS = frozenset(['summary'])
+
+
+class DKResponseDecoder(object):
+    """
+    Turns the body of a server response into python objects with a single parse.
+
+    The server answers either with plain JSON, or with a JSON string that holds the JSON document
+    ("{\\"kitchens\\": ...}"). The shape is told from the first character of the body, so the body is
+    parsed once (twice for the encoded shape, the second time on the decoded string) and never copied
+    or rewritten. Only the EMBEDDED_JSON_FIELDS of a plain JSON document are decoded again, other
+    strings (e.g. the contents of a recipe file) are left as they are.
+    """
+    _backend = None
+
+    @staticmethod
+    def get_backend():
+        # the fast parsers are optional, the first one installed is used
+        if DKResponseDecoder._backend is None:
+            backend = json
+            if os.environ.get(JSON_BACKEND_ENV, '') != 'json':
+                for name in FAST_JSON_BACKENDS:
+                    try:
+                        backend = __import__(name)
+                        break
+                    except ImportError:
+                        pass
+            DKResponseDecoder._backend = backend
+        return DKResponseDecoder._backend
+
+    @staticmethod
+    def set_backend(backend):
+        # None goes back to picking the backend on the next decode
+        DKResponseDecoder._backend = backend
+
+    @staticmethod
+    def get_shape(body):
+        i = 0
+        if isinstance(body, str) and body.startswith(_UTF8_BOM):
+            i = len(_UTF8_BOM)
+        length = len(body)
+        while i < length and body[i] in _WHITESPACE:
+            i += 1
+        if i == length:
+            return SHAPE_EMPTY
+        elif body[i] == '"':
+            return SHAPE_ENCODED
+        else:
+            return SHAPE_JSON
+
+    @staticmethod
+    def loads(body):
+        backend = DKResponseDecoder.get_backend()
+        try:
+            return backend.loads(body)
+        except ValueError:
+            if backend is json:
+                raise
+            # the fast parsers refuse a few documents the standard one takes (e.g. huge integers)
+            return json.loads(body)
+
+    @staticmethod
+    def decode(body):
+        """
+        :param body: str or unicode, the response body
+        :return: the decoded document, None if the body is empty or not JSON
+        """
+        if body is None:
+            return None
+        shape = DKResponseDecoder.get_shape(body)
+        if shape == SHAPE_EMPTY:
+            return None
+        try:
+            doc = DKResponseDecoder.loads(body)
+        except (ValueError, TypeError):
+            return None
+        if shape == SHAPE_ENCODED:
+            try:
+                return DKResponseDecoder.loads(doc)
+            except (ValueError, TypeError):
+                # a plain string, e.g. a token
+                return doc
+        return DKResponseDecoder._decode_embedded(doc)
+
+    @staticmethod
+    def _decode_embedded(doc):
+        if isinstance(doc, dict):
+            for key, value in doc.iteritems():
+                if key in EMBEDDED_JSON_FIELDS and isinstance(value, basestring) and \
+                        value[:1] == '{' and value[-1:] == '}':
+                    try:
+                        doc[key] = DKResponseDecoder.loads(value)
+                    except ValueError:
+                        pass
+                elif isinstance(value, (dict, list)):
+                    DKResponseDecoder._decode_embedded(value)
+        elif isinstance(doc, list):
+            for value in doc:
+                if isinstance(value, (dict, list)):
+                    DKResponseDecoder._decode_embedded(value)
+        return doc
+
+    @staticmethod
+    def decode_response(response):
+        """
+        Decodes a requests response, from its raw bytes when it has them.
+        """
+        if response is None:
+            return None
+        body = getattr(response, 'content', None)
+        if not isinstance(body, str):
+            body = response.text
+        if body is None:
+            return None
+        if not os.environ.get(DEBUG_ENV):
+            return DKResponseDecoder.decode(body)
+        start = time.time()
+        doc = DKResponseDecoder.decode(body)
+        sys.stderr.write('DKResponseDecoder: %s %d bytes (%s, %s) decoded in %.1f ms\n' %
+                         (getattr(response, 'url', ''), len(body), DKResponseDecoder.get_shape(body),
+                          DKResponseDecoder.get_backend().__name__, (time.time() - start) * 1000))
+        return doc
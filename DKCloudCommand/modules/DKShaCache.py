@@ -0,0 +1,105 @@
+import os
+import json
+import time
+from githash import hash_file
+from DKKitchenDisk import DKKitchenDisk
+
+__author__ = 'DataKitchen, Inc.'
+
+SHA_CACHE = 'SHA_CACHE'
+
+# Files modified this recently are hashed but not cached. On file systems with a coarse mtime a file can
+# be rewritten within the same tick without changing its stat signature (git calls this "racily clean").
+RACY_WINDOW_SECONDS = 2
+
+
+class DKShaCache(object):
+    """
+    Cache of file hashes for one recipe, kept in the recipe meta dir (.dk/recipes/<recipe>/SHA_CACHE).
+
+    Entries are keyed by the path relative to the recipe root and validated against
+    (size, mtime_ns, inode). Both the git blob sha (used to compare against the remote tree)
+    and the plain sha1 (used by FILE_SHA) are stored, so an unchanged file is never re-read.
+    If the recipe is not inside a kitchen the cache works in memory only.
+    """
+
+    def __init__(self, recipe_dir):
+        self._recipe_dir = os.path.abspath(recipe_dir)
+        self._cache_file = None
+        self._entries = dict()
+        self._seen = set()
+        self._dirty = False
+
+        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir(os.path.basename(self._recipe_dir), self._recipe_dir)
+        if recipe_meta_dir is not None and os.path.isdir(recipe_meta_dir):
+            self._cache_file = os.path.join(recipe_meta_dir, SHA_CACHE)
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            # A damaged cache is simply rebuilt.
+            self._entries = dict()
+            self._dirty = True
+
+    @staticmethod
+    def _stat_key(st):
+        return [st.st_size, long(st.st_mtime * 1000000000), st.st_ino]
+
+    def _key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self._recipe_dir)
+
+    def get_shas(self, file_path):
+        """
+        :param file_path: path of a file inside the recipe
+        :return: tuple (git blob sha, plain sha1)
+        """
+        st = os.stat(file_path)
+        key = self._key(file_path)
+        stat_key = DKShaCache._stat_key(st)
+        self._seen.add(key)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0:3] == stat_key:
+            return entry[3], entry[4]
+
+        the_githash, the_sha = hash_file(file_path)
+        if time.time() - st.st_mtime > RACY_WINDOW_SECONDS:
+            self._entries[key] = stat_key + [the_githash, the_sha]
+            self._dirty = True
+        elif key in self._entries:
+            del self._entries[key]
+            self._dirty = True
+        return the_githash, the_sha
+
+    def get_githash(self, file_path):
+        return self.get_shas(file_path)[0]
+
+    def get_sha(self, file_path):
+        return self.get_shas(file_path)[1]
+
+    def save(self, prune=False):
+        """
+        Writes the cache back to disk if anything changed.
+        :param prune: drop entries for files that were not looked up; use after a full scan of the recipe
+        """
+        if prune:
+            for key in [key for key in self._entries if key not in self._seen]:
+                del self._entries[key]
+                self._dirty = True
+        if self._cache_file is None or not self._dirty:
+            return True
+        tmp_file = '%s.tmp' % self._cache_file
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._entries, f, separators=(',', ':'))
+            os.rename(tmp_file, self._cache_file)
+        except (IOError, OSError) as e:
+            print "%s - %s - %s" % (e.filename, e.errno, e.message)
+            return False
+        self._dirty = False
+        return True
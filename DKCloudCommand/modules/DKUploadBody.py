@@ -0,0 +1,111 @@
+import os
+import json
+import zlib
+import codecs
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class DKUploadBody:
+    """
+    Builds the body of /v2/recipe/update requests as a stream of chunks.
+
+    A change is {'contents': <string>, 'isNew': bool}, {'file': <path on disk>, 'isNew': bool} or {} (delete).
+    Changes that point to a 'file' are read from disk in chunks while the body is being sent, so the
+    file contents are never held in memory as a whole.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_change_size(change):
+        if 'file' in change:
+            return os.path.getsize(change['file'])
+        elif 'contents' in change and change['contents'] is not None:
+            return len(change['contents'])
+        else:
+            return 0
+
+    @staticmethod
+    def split_changes(changes, max_size):
+        """
+        Splits a changeset into several whose contents add up to at most max_size bytes.
+        A single change bigger than max_size goes alone.
+        :param changes: dict {path: change}
+        :param max_size: int, bytes. None or 0 means no limit
+        :return: list of dicts
+        """
+        if not max_size or len(changes) <= 1:
+            return [changes]
+        batches = list()
+        batch = dict()
+        batch_size = 0
+        for path in sorted(changes.keys()):
+            change_size = DKUploadBody.get_change_size(changes[path])
+            if len(batch) > 0 and change_size > 0 and batch_size + change_size > max_size:
+                batches.append(batch)
+                batch = dict()
+                batch_size = 0
+            batch[path] = changes[path]
+            batch_size += change_size
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _iter_file_text(file_path, chunk_size):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with open(file_path, 'r') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+        text = decoder.decode('', final=True)
+        if text:
+            yield text
+
+    @staticmethod
+    def _iter_contents(change, chunk_size):
+        # yields the json escaped contents, without the surrounding quotes
+        if 'file' in change:
+            for text in DKUploadBody._iter_file_text(change['file'], chunk_size):
+                yield json.dumps(text)[1:-1]
+        else:
+            yield json.dumps(change['contents'])[1:-1]
+
+    @staticmethod
+    def iter_json(message, changes, chunk_size=CHUNK_SIZE):
+        """
+        Yields the json for {'message': message, 'files': changes}, with 'file' changes sent as 'contents'.
+        """
+        yield '{"message": %s, "files": {' % json.dumps(message)
+        separator = ''
+        for path in sorted(changes.keys()):
+            change = changes[path]
+            yield '%s%s: {' % (separator, json.dumps(path))
+            separator = ', '
+            other_keys = [key for key in sorted(change.keys()) if key not in ['file', 'contents']]
+            if 'file' in change or 'contents' in change:
+                yield '"contents": "'
+                for piece in DKUploadBody._iter_contents(change, chunk_size):
+                    yield piece
+                yield '"'
+                if len(other_keys) > 0:
+                    yield ', '
+            yield ', '.join(['%s: %s' % (json.dumps(key), json.dumps(change[key])) for key in other_keys])
+            yield '}'
+        yield '}}'
+
+    @staticmethod
+    def gzip(chunks, level=6):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
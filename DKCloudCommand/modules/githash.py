@@ -1,33 +1,76 @@
 #!/usr/bin/env python
 
+import os
 from sys import argv
 from hashlib import sha1
-from cStringIO import StringIO
+
+# Files are hashed in chunks of this size so they never have to be held in memory.
+CHUNK_SIZE = 64 * 1024
+
 
 class githash(object):
-    def __init__(self):
-        self.buf = StringIO()
+    """
+    git blob sha, computed as the data arrives.
+    The blob header holds the size, so it has to be known up front.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.read_size = 0
+        self.h = sha1()
+        self.h.update("blob %u\0" % size)
 
     def update(self, data):
-        self.buf.write(data)
+        self.read_size += len(data)
+        self.h.update(data)
 
     def hexdigest(self):
-        data = self.buf.getvalue()
-        h = sha1()
-        h.update("blob %u\0" % len(data))
-        h.update(data)
-
-        return h.hexdigest()
+        if self.read_size != self.size:
+            raise ValueError('githash: got %d bytes, expected %d' % (self.read_size, self.size))
+        return self.h.hexdigest()
 
 
 def githash_data(data):
-    h = githash()
+    h = githash(len(data))
     h.update(data)
     return h.hexdigest()
 
 
 def githash_fileobj(fileobj):
-    return githash_data(fileobj.read())
+    return hash_fileobj(fileobj)[0]
+
+
+def hash_fileobj(fileobj):
+    """
+    Streams a file through both the git blob hash and a plain sha1.
+    :param fileobj: file opened at position 0
+    :return: tuple (git blob sha, plain sha1)
+    """
+    try:
+        size = os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        # not a file on disk, e.g. a StringIO
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+
+    git_sha = githash(size)
+    plain_sha = sha1()
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        git_sha.update(chunk)
+        plain_sha.update(chunk)
+
+    try:
+        return git_sha.hexdigest(), plain_sha.hexdigest()
+    except ValueError:
+        raise IOError("'%s' changed while it was being read" % getattr(fileobj, 'name', fileobj))
+
+
+def hash_file(file_path):
+    with open(file_path, 'r') as fileobj:
+        return hash_fileobj(fileobj)
 
 
 if __name__ == '__main__':
@@ -13,6 +13,7 @@ from collections import OrderedDict
 
 from BaseTestCloud import *
 from DKCloudAPI import DKCloudAPI
+from DKReturnCode import DKReturnCode
 from DKCloudCommandRunner import DKCloudCommandRunner
 
 
@@ -789,6 +790,41 @@ class TestCloudAPI(BaseTestCloud):
         self.assertIsNotNone(found_serving)
         self._delete_kitchen(new_kitchen)
 
+    def test_filter_servings(self):
+        servings = [{'serving_chronos_id': 'order1', 'serving_mesos_id': 'run1'},
+                    {'serving_chronos_id': 'order1', 'serving_mesos_id': 'run2'},
+                    {'serving_chronos_id': 'order2', 'serving_mesos_id': 'run3'}]
+        self.assertEqual(DKCloudAPI._filter_servings(servings, {'serving_mesos_id': 'run2'}), [servings[1]])
+        self.assertEqual(DKCloudAPI._filter_servings(servings, {'serving_chronos_id': 'order1'}), servings[0:2])
+        self.assertEqual(DKCloudAPI._filter_servings(servings, {'summary': True}), servings)
+        # a server that already filtered sends just the one serving
+        self.assertEqual(DKCloudAPI._filter_servings([servings[2]], {'serving_mesos_id': 'run3'}), [servings[2]])
+
+    def test_iter_orders(self):
+        class PagedOrdersAPI(DKCloudAPI):
+            # 7 orders, served by list_order a page at a time
+            def list_order(self, kitchen, order_count=5, order_run_count=3, start=0, recipe=None, save_to_file=None):
+                self.pages_requested.append((start, order_count))
+                orders = [{'serving_chronos_id': 'order%d' % i} for i in range(start, min(start + order_count, 7))]
+                servings = dict([(order['serving_chronos_id'], {'servings': [{'id': 1}]}) for order in orders[0:1]])
+                rc = DKReturnCode()
+                rc.set(rc.DK_SUCCESS, None, {'orders': orders, 'servings': servings})
+                return rc
+
+        api = PagedOrdersAPI(self._cr_config)
+        api.pages_requested = list()
+        orders = list(api.iter_orders('kitchen', page_size=3))
+        self.assertEqual([order['serving_chronos_id'] for order, servings in orders],
+                         ['order%d' % i for i in range(7)])
+        self.assertEqual(orders[3][1], [{'id': 1}])
+        self.assertEqual(orders[4][1], [])
+        self.assertEqual(api.pages_requested, [(0, 3), (3, 3), (6, 3)])
+
+        api.pages_requested = list()
+        first_page = api.iter_orders('kitchen', page_size=3, start=2)
+        self.assertEqual(next(first_page)[0]['serving_chronos_id'], 'order2')
+        first_page.close()
+
     def test_orderrun_delete(self):
         parent_kitchen = 'master'
         new_kitchen = 'test_orderrun_delete'
@@ -3,6 +3,8 @@ import unittest
 import datetime, time
 import tempfile
 import pickle
+import json
+from StringIO import StringIO
 from sys import path, stdout
 import os
 import shutil
@@ -292,6 +294,52 @@ class TestCloudCommandRunner(BaseTestCloud):
         self._delete_and_clean_kitchen(test_kitchen)
         shutil.rmtree(temp_dir, ignore_errors=True)
 
+    def test_update_multiple_files(self):
+        # setup
+        parent_kitchen = 'CLI-Top'
+        test_kitchen = self._add_my_guid('CLI-test_update_multiple_files')
+        recipe_name = 'simple'
+        message = 'test update CLI-test_update_multiple_files'
+        update_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        new_file_name = 'new-file.txt'
+
+        self._delete_and_clean_kitchen(test_kitchen)
+        rs = DKCloudCommandRunner.create_kitchen(self._api, parent_kitchen, test_kitchen)
+        self.assertTrue(rs.ok())
+
+        temp_dir, test_kitchen_dir = self._make_kitchen_dir(test_kitchen, change_dir=True)
+        rs = DKCloudCommandRunner.get_recipe(self._api, test_kitchen, recipe_name)
+        self.assertTrue(rs.ok())
+
+        working_dir = os.path.join(test_kitchen_dir, recipe_name)
+        os.chdir(working_dir)
+        files_to_update = ['description.json', 'variables.json']
+        new_contents = dict()
+        for file_name in files_to_update:
+            with open(file_name, 'r') as rfile:
+                file_dict = self._get_the_dict(rfile.read())
+            file_dict[test_kitchen] = update_str
+            new_contents[file_name] = self._get_the_json_str(file_dict)
+            with open(file_name, 'w') as rfile:
+                rfile.write(new_contents[file_name])
+        with open(new_file_name, 'w') as rfile:
+            rfile.write(update_str)
+        new_contents[new_file_name] = update_str
+        files_to_update.append(new_file_name)
+
+        # test
+        rc = DKCloudCommandRunner.update_file(self._api, test_kitchen, recipe_name, working_dir, message,
+                                              files_to_update)
+        self.assertTrue(rc.ok())
+        for file_name in files_to_update:
+            self.assertIn('DKCloudCommand.update_file for %s succeeded' % file_name, rc.get_message())
+            remote_file = self._get_recipe_file(test_kitchen, recipe_name, recipe_name, file_name)
+            self.assertEqual(new_contents[file_name], remote_file)
+
+        # cleanup
+        self._delete_and_clean_kitchen(test_kitchen)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
     def test_util_funcs(self):
 
         paths_to_check = ['description.json', 'graph.json', 'simple-file.txt', 'node2_hide', 'node2_hide/my_file.txt', 'node1hide/subdir/hide-me.txt''variables.json', 'variations.json', 'node2/data_sinks', 'node1/data_sinks', 'node2', 'node1', 'node1/data_sources', 'resources', 'node2/data_sources']
@@ -826,6 +874,34 @@ class TestCloudCommandRunner(BaseTestCloud):
         rs = DKCloudCommandRunner.delete_orderrun(mock_api, 'bad')
         self.assertFalse(rs.ok())
 
+    def test_orderrun_detail_events(self):
+        mock_api = DKCloudAPIMock(self._cr_config)
+        out = StringIO()
+        rc = DKCloudCommandRunner.orderrun_detail_events(mock_api, 'kitchen1', {'status': True, 'logs': True}, out)
+        self.assertTrue(rc.ok())
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([event['event'] for event in events], ['orderrun', 'node', 'node', 'log', 'log'])
+        self.assertEqual(events[0]['status'], 'COMPLETED_SERVING')
+        self.assertEqual(events[0]['variation'], 'variation1')
+        self.assertEqual(events[0]['recipe'], 'simple')
+        self.assertEqual(events[0]['run_duration'], 61000)
+        self.assertEqual(events[1]['node'], 'node1')
+        self.assertEqual(events[4]['line'], 'second log line')
+        for event in events:
+            self.assertEqual(event['serving_id'], 'ct:1500000000000:DKRecipe#dk#simple#variation1#kitchen1#1')
+
+        # without --summary or --nodestatus the summary is not asked for
+        out = StringIO()
+        rc = DKCloudCommandRunner.orderrun_detail_events(mock_api, 'kitchen1', {'logs': True}, out)
+        self.assertTrue(rc.ok())
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([event['event'] for event in events], ['orderrun', 'log', 'log'])
+        self.assertEqual(events[0]['status'], 'COMPLETED_SERVING')
+        self.assertFalse('recipe' in events[0] or 'start_time' in events[0] or 'run_duration' in events[0])
+
+        rc = DKCloudCommandRunner.orderrun_detail_events(mock_api, 'kitchen1', {'serving_mesos_id': 'other'}, out)
+        self.assertFalse(rc.ok())
+
     def test_kitchen_config(self):
         parent_kitchen = 'CLI-Top'
         child_kitchen = self._add_my_guid('modify_kitchen_settings_runner')
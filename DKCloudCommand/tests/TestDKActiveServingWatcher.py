@@ -0,0 +1,175 @@
+import unittest
+import sys, time, json
+from StringIO import StringIO
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKActiveServingWatcher import DKActiveServingWatcher, DKActiveServingCache, DKActiveServingWatcherSingleton, \
+    DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME, DK_OUTPUT_JSON
+from DKReturnCode import DKReturnCode
+
+__author__ = 'DataKitchen, Inc.'
+
+
+def make_serving(serving_id, update_time, node_status, status='ACTIVE_SERVING'):
+    return {'serving_mesos_id': serving_id,
+            'status': status,
+            'summary': {'name': 'recipe1', 'hid': 'abcdef123', 'last-update-time': update_time,
+                        'node1': {'status': node_status,
+                                  'data_sources': {'source.json': {'status': node_status}}}}}
+
+
+class _OrderRunApi(object):
+    # Returns the queued payloads from orderrun_detail, one per call.
+    def __init__(self, payloads):
+        self.payloads = list(payloads)
+        self.requests_seen = list()
+        self.kitchens_seen = list()
+
+    def orderrun_detail(self, kitchen, pd):
+        self.requests_seen.append(dict(pd))
+        self.kitchens_seen.append(kitchen)
+        rc = DKReturnCode()
+        rc.set(rc.DK_SUCCESS, None, self.payloads.pop(0) if len(self.payloads) > 0 else [])
+        return rc
+
+
+class TestDKActiveServingWatcher(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        DKActiveServingCache().get_cache().clear()
+        self._stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self._stdout
+
+    def test_flatten_and_diff(self):
+        pre = DKActiveServingWatcher._flatten_summary(make_serving('s1', 1, 'RUNNING')['summary'])
+        self.assertEqual(pre[('node1', 'data_sources', 'source.json', 'status')], 'RUNNING')
+        cur = DKActiveServingWatcher._flatten_summary(make_serving('s1', 2, 'DONE')['summary'])
+        self.assertEqual(DKActiveServingWatcher._diff_summary(cur, pre),
+                         [(('last-update-time',), 1, 2),
+                          (('node1', 'data_sources', 'source.json', 'status'), 'RUNNING', 'DONE'),
+                          (('node1', 'status'), 'RUNNING', 'DONE')])
+        self.assertEqual(DKActiveServingWatcher._diff_summary(cur, cur), [])
+
+    def test_watch_skips_unchanged_servings(self):
+        api = _OrderRunApi([[make_serving('s1', 1, 'RUNNING')],
+                            [make_serving('s1', 1, 'RUNNING')],
+                            [make_serving('s1', 2, 'DONE', 'COMPLETED_SERVING')]])
+        watcher = DKActiveServingWatcher(api, 'kitchen')
+        self.assertFalse(watcher.watch())
+        self.assertFalse(watcher.watch())
+        self.assertTrue(watcher.watch())
+        self.assertEqual(api.requests_seen, [{'summary': True},
+                                             {'summary': True, 'last-update-time': 1},
+                                             {'summary': True, 'last-update-time': 1}])
+        self.assertTrue('recipe1(abcde..) node1: status:  DONE' in sys.stdout.getvalue())
+
+    def test_adaptive_sleep_time(self):
+        api = _OrderRunApi([[make_serving('s1', 1, 'RUNNING')],
+                            [make_serving('s1', 2, 'DONE', 'COMPLETED_SERVING')],
+                            [], [], [], [], [], []])
+        watcher = DKActiveServingWatcher(api, 'kitchen')
+        watcher.watch()
+        self.assertEqual(watcher.get_next_sleep_time(5), 5)
+        watcher.watch()
+        self.assertEqual(watcher.get_next_sleep_time(5), 5)
+        sleep_times = list()
+        for i in range(6):
+            watcher.watch()
+            sleep_times.append(watcher.get_next_sleep_time(5))
+        self.assertEqual(sleep_times, [10, 20, 40] + [DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME] * 3)
+
+    def test_idle_kitchen_backs_off_while_another_runs(self):
+        busy_api = _OrderRunApi([[make_serving('s%d' % i, i, 'RUNNING')] for i in range(6)])
+        idle_api = _OrderRunApi([[make_serving('done', 1, 'DONE', 'COMPLETED_SERVING')]])
+        busy_watcher = DKActiveServingWatcher(busy_api, 'kitchen1')
+        idle_watcher = DKActiveServingWatcher(idle_api, 'kitchen2')
+        busy_sleep_times = list()
+        idle_sleep_times = list()
+        for i in range(6):
+            busy_watcher.watch()
+            idle_watcher.watch()
+            busy_sleep_times.append(busy_watcher.get_next_sleep_time(5))
+            idle_sleep_times.append(idle_watcher.get_next_sleep_time(5))
+        self.assertTrue(DKActiveServingCache().has_running_servings())
+        self.assertTrue(DKActiveServingCache().has_running_servings('kitchen1'))
+        self.assertFalse(DKActiveServingCache().has_running_servings('kitchen2'))
+        self.assertEqual(busy_sleep_times, [5] * 6)
+        self.assertEqual(idle_sleep_times, [10, 20, 40] + [DK_ACTIVE_SERVING_WATCHER_MAX_SLEEP_TIME] * 3)
+
+    def test_concurrent_servings_are_diffed_separately(self):
+        api = _OrderRunApi([[make_serving('s1', 1, 'RUNNING'), make_serving('s2', 1, 'DONE')],
+                            [make_serving('s1', 2, 'RUNNING'), make_serving('s2', 2, 'DONE')]])
+        watcher = DKActiveServingWatcher(api, 'kitchen')
+        watcher.watch()
+        sys.stdout = StringIO()
+        watcher.watch()
+        # only last-update-time changed, nothing flips between the two runs
+        self.assertFalse('status' in sys.stdout.getvalue())
+        self.assertEqual(sorted(DKActiveServingCache().get_cache().keys()), ['s1', 's2'])
+
+    def test_cache_evicts_finished_servings_first(self):
+        cache = DKActiveServingCache()
+        max_size = cache.get_max_size()
+        try:
+            cache.set_max_size(3)
+            cache.set_serving('running1', {}, 1, True)
+            cache.set_serving('finished1', {}, 1, False)
+            cache.set_serving('finished2', {}, 1, False)
+            cache.set_serving('running2', {}, 1, True)
+            self.assertEqual(cache.get_cache().keys(), ['running1', 'finished2', 'running2'])
+            cache.set_serving('running3', {}, 1, True)
+            self.assertEqual(cache.get_cache().keys(), ['running1', 'running2', 'running3'])
+            cache.set_serving('running4', {}, 1, True)
+            self.assertEqual(cache.get_cache().keys(), ['running2', 'running3', 'running4'])
+            self.assertTrue(cache.has_running_servings())
+        finally:
+            cache.set_max_size(max_size)
+
+    def test_kitchen_prefixed_lines(self):
+        api = _OrderRunApi([[make_serving('s1', 1, 'RUNNING')], [make_serving('s1', 2, 'DONE')]])
+        watcher = DKActiveServingWatcher(api, 'kitchen1')
+        watcher.set_show_kitchen(True)
+        watcher.watch()
+        watcher.watch()
+        self.assertTrue('[kitchen1] recipe1(abcde..) node1: status:  DONE' in sys.stdout.getvalue())
+
+    def test_json_change_events(self):
+        api = _OrderRunApi([[make_serving('s1', 1, 'RUNNING')], [make_serving('s1', 2, 'DONE')]])
+        watcher = DKActiveServingWatcher(api, 'kitchen1')
+        watcher.set_output_format(DK_OUTPUT_JSON)
+        watcher.watch()
+        self.assertEqual(sys.stdout.getvalue(), '')
+        watcher.watch()
+        events = [json.loads(line) for line in sys.stdout.getvalue().splitlines()]
+        self.assertEqual([event['path'] for event in events],
+                         [['last-update-time'], ['node1', 'data_sources', 'source.json', 'status'], ['node1', 'status']])
+        self.assertEqual(events[2]['old'], 'RUNNING')
+        self.assertEqual(events[2]['new'], 'DONE')
+        self.assertEqual(events[2]['serving_id'], 's1')
+        self.assertEqual(events[2]['kitchen'], 'kitchen1')
+        self.assertTrue('timestamp' in events[2])
+
+    def test_shared_poller_staggers_kitchens(self):
+        api = _OrderRunApi([])
+        singleton = DKActiveServingWatcherSingleton()
+        sleep_time = singleton.get_sleep_time()
+        try:
+            singleton.set_sleep_time(0.4)
+            singleton.set_api(api)
+            singleton.set_kitchens(['kitchen1', 'kitchen2'])
+            self.assertTrue(singleton.start_watcher())
+            time.sleep(0.3)
+            singleton.stop_watcher()
+            singleton.get_watcher().get_run_thread().join()
+        finally:
+            singleton.set_sleep_time(sleep_time)
+            singleton.set_kitchen(None)
+        # kitchen2 is polled half an interval after kitchen1, by the same thread and api
+        self.assertEqual(api.kitchens_seen, ['kitchen1', 'kitchen2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
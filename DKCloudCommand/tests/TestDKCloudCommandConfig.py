@@ -35,6 +35,63 @@ class TestDKCloudCommandConfig(unittest.TestCase):
         os.remove(target_path)
         pass
 
+    def test_http_session_settings(self):
+        cfg = DKCloudCommandConfig()
+        cfg.init_from_file("files/UnitTestConfig.json")
+        self.assertEquals(cfg.get_pool_size(), DKCloudCommandConfig.DEFAULT_POOL_SIZE)
+        self.assertTrue(cfg.get_keep_alive())
+        self.assertEquals(cfg.get_connect_timeout(), DKCloudCommandConfig.DEFAULT_CONNECT_TIMEOUT)
+        self.assertEquals(cfg.get_read_timeout(), DKCloudCommandConfig.DEFAULT_READ_TIMEOUT)
+        self.assertEquals(cfg.get_max_retries(), DKCloudCommandConfig.DEFAULT_MAX_RETRIES)
+        self.assertEquals(cfg.get_retry_backoff(), DKCloudCommandConfig.DEFAULT_RETRY_BACKOFF)
+        self.assertEquals(cfg.get_token_safety_margin(), DKCloudCommandConfig.DEFAULT_TOKEN_SAFETY_MARGIN)
+        self.assertTrue(cfg.get_version_check())
+        self.assertEquals(cfg.get_version_check_ttl(), DKCloudCommandConfig.DEFAULT_VERSION_CHECK_TTL)
+        self.assertEquals(cfg.get_order_cache_max_age(), DKCloudCommandConfig.DEFAULT_ORDER_CACHE_MAX_AGE)
+        self.assertEquals(cfg.get_order_cache_max_runs(), DKCloudCommandConfig.DEFAULT_ORDER_CACHE_MAX_RUNS)
+
+        cfg2 = DKCloudCommandConfig()
+        cfg2.init_from_dict({DKCloudCommandConfig.DK_CLOUD_POOL_SIZE: '4',
+                             DKCloudCommandConfig.DK_CLOUD_KEEP_ALIVE: False,
+                             DKCloudCommandConfig.DK_CLOUD_CONNECT_TIMEOUT: 2,
+                             DKCloudCommandConfig.DK_CLOUD_READ_TIMEOUT: '30',
+                             DKCloudCommandConfig.DK_CLOUD_MAX_RETRIES: 0,
+                             DKCloudCommandConfig.DK_CLOUD_RETRY_BACKOFF: 1,
+                             DKCloudCommandConfig.DK_CLOUD_TOKEN_SAFETY_MARGIN: '90',
+                             DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK: False,
+                             DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK_TTL: 3600,
+                             DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_AGE: '30',
+                             DKCloudCommandConfig.DK_CLOUD_ORDER_CACHE_MAX_RUNS: '500'})
+        self.assertEquals(cfg2.get_pool_size(), 4)
+        self.assertFalse(cfg2.get_keep_alive())
+        self.assertEquals(cfg2.get_connect_timeout(), 2.0)
+        self.assertEquals(cfg2.get_read_timeout(), 30.0)
+        self.assertEquals(cfg2.get_max_retries(), 0)
+        self.assertEquals(cfg2.get_retry_backoff(), 1.0)
+        self.assertEquals(cfg2.get_token_safety_margin(), 90.0)
+        self.assertFalse(cfg2.get_version_check())
+        self.assertEquals(cfg2.get_version_check_ttl(), 3600.0)
+        self.assertEquals(cfg2.get_order_cache_max_age(), 30.0)
+        self.assertEquals(cfg2.get_order_cache_max_runs(), 500)
+        self.assertEquals(cfg2.get_order_cache_file(), None)
+
+    def test_boolean_settings_written_as_strings(self):
+        cfg = DKCloudCommandConfig()
+        cfg.init_from_dict({DKCloudCommandConfig.DK_CLOUD_KEEP_ALIVE: 'false',
+                            DKCloudCommandConfig.DK_CLOUD_STREAM_UPLOADS: 'True',
+                            DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK: ' no '})
+        self.assertFalse(cfg.get_keep_alive())
+        self.assertTrue(cfg.get_stream_uploads())
+        self.assertFalse(cfg.get_version_check())
+
+        cfg.init_from_dict({DKCloudCommandConfig.DK_CLOUD_KEEP_ALIVE: '1',
+                            DKCloudCommandConfig.DK_CLOUD_STREAM_UPLOADS: 0,
+                            DKCloudCommandConfig.DK_CLOUD_VERSION_CHECK: 'maybe'})
+        self.assertTrue(cfg.get_keep_alive())
+        self.assertFalse(cfg.get_stream_uploads())
+        # not a boolean, the default applies
+        self.assertTrue(cfg.get_version_check())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import os, tempfile, shutil
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKFileShaStore import DKFileShaStore, FILE_SHA, FILE_SHA_DB
+from DKRecipeDisk import DKRecipeDisk
+from DKKitchenDisk import DKKitchenDisk
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class TestDKFileShaStore(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKFileShaStore._TEMPFILE_LOCATION)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_migrates_text_file(self):
+        with open(os.path.join(self._temp_dir, FILE_SHA), 'w') as f:
+            f.write('recipe1/description.json:aaa\nrecipe1/node1/at 10:30.sql:bbb\n')
+        store = DKFileShaStore(self._temp_dir)
+        self.assertEqual(store.load(), {'recipe1/description.json': 'aaa', 'recipe1/node1/at 10:30.sql': 'bbb'})
+        store.close()
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir, FILE_SHA)))
+        self.assertTrue(os.path.isfile(os.path.join(self._temp_dir, FILE_SHA_DB)))
+        self.assertEqual(DKRecipeDisk.load_saved_shas(self._temp_dir)['recipe1/node1/at 10:30.sql'], 'bbb')
+
+    def test_replace_and_update(self):
+        store = DKFileShaStore(self._temp_dir)
+        self.assertEqual(store.load(), None)
+        store.replace({'recipe1/a.json': 'aaa', 'recipe1/b.json': 'bbb', 'recipe1/\xc3\xa9.sql': 'ccc'})
+        store.update({'recipe1/a.json': 'AAA', 'recipe1/d.json': 'ddd'}, ['recipe1/b.json', 'recipe1/missing.json'])
+        self.assertEqual(store.load(), {'recipe1/a.json': 'AAA', 'recipe1/d.json': 'ddd', 'recipe1/\xc3\xa9.sql': 'ccc'})
+        self.assertEqual(store.get('recipe1/d.json'), 'ddd')
+        self.assertEqual(store.get('recipe1/b.json'), None)
+        store.replace({'recipe1/e.json': 'eee'})
+        self.assertEqual(store.load(), {'recipe1/e.json': 'eee'})
+        store.close()
+
+    def test_update_recipe_state(self):
+        DKKitchenDisk.write_kitchen('kitchen1', self._temp_dir)
+        kitchen_dir = os.path.join(self._temp_dir, 'kitchen1')
+        recipe = {'recipe1': [{'filename': 'a.txt', 'text': 'a'}, {'filename': 'b.txt', 'text': 'b'}]}
+        self.assertTrue(DKRecipeDisk('sha1', recipe, kitchen_dir).save_recipe_to_disk())
+        recipe_dir = os.path.join(kitchen_dir, 'recipe1')
+        with open(os.path.join(recipe_dir, 'a.txt'), 'w') as f:
+            f.write('changed')
+        with open(os.path.join(recipe_dir, 'c.txt'), 'w') as f:
+            f.write('new')
+        os.remove(os.path.join(recipe_dir, 'b.txt'))
+        DKRecipeDisk.update_recipe_state(recipe_dir, updated_paths=['a.txt', 'c.txt'], deleted_paths=['b.txt'])
+        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir('recipe1', kitchen_dir)
+        self.assertEqual(DKRecipeDisk.load_saved_shas(recipe_meta_dir), DKRecipeDisk.fetch_shas(recipe_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
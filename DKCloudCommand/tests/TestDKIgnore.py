@@ -15,6 +15,13 @@ class TestDKIgnore(unittest.TestCase):
         test = 'base/path/directory/.DS_Store'
         self.assertTrue(ignore.ignore(test))
 
+    def test_add_ignore(self):
+        ignore = DKIgnore()
+        self.assertFalse(ignore.ignore('recipe/node1/data.tmp'))
+        ignore.add_ignore('.tmp')
+        self.assertTrue(ignore.ignore('recipe/node1/data.tmp'))
+        self.assertFalse(ignore.ignore('recipe/node1/data_tmp'))
+
 
 if __name__ == '__main__':
     unittest.main()
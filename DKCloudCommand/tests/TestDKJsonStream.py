@@ -0,0 +1,131 @@
+import unittest
+import os, tempfile, shutil, json, threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKJsonStream import DKJsonStream
+from DKCloudAPI import DKCloudAPI
+from DKCloudCommandConfig import DKCloudCommandConfig
+from DKCloudCommandRunner import DKCloudCommandRunner
+from DKRecipeDisk import DKRecipeDisk
+
+__author__ = 'DataKitchen, Inc.'
+
+RECIPE = {'recipe1': [{'filename': 'description.json', 'json': {'description': 'recipe 1'}}],
+          'recipe1/node1': [{'filename': 'query.sql', 'text': u'select "\xe9t\xe9" \\ \U0001F600\n' * 2000},
+                            {'filename': 'notebook.json', 'text': '[]'}],
+          'recipe1/node1/empty': []}
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def expand_recipe(path):
+    return len(path) < 4
+
+
+class _RecipeGetHandler(BaseHTTPRequestHandler):
+    # Stand-in for /v2/recipe/get/<kitchen>/<recipe>, sends a JSON-encoded string in small chunks.
+    def do_POST(self):
+        if self.path != '/v2/recipe/get/kitchen/recipe1':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(json.dumps({'status': 'success', 'recipes': {'recipe1': RECIPE}, 'ORIG_HEAD': 'abc123'}))
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in split(body, 1000):
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write('0\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDKJsonStream(DKCommonUnitTestSettings):
+
+    def _read(self, chunks, expand=expand_recipe):
+        return list(DKJsonStream(chunks).iter_values(expand))
+
+    def test_iter_values(self):
+        doc = {'status': 'success', 'recipes': {'recipe1': RECIPE}, 'ORIG_HEAD': 'abc123', 'count': 12345}
+        expected = None
+        for body in [json.dumps(doc), json.dumps(json.dumps(doc)),
+                     ' \n' + json.dumps(json.dumps(doc), ensure_ascii=False).encode('utf-8') + '\n']:
+            for size in [1, 3, 7, 100, 100000]:
+                values = self._read(split(body, size))
+                if expected is None:
+                    expected = values
+                self.assertEqual(values, expected)
+        values = dict(expected)
+        self.assertEqual(values[('ORIG_HEAD',)], 'abc123')
+        self.assertEqual(values[('count',)], 12345)
+        self.assertEqual(values[('recipes', 'recipe1', 'recipe1/node1', 0)], RECIPE['recipe1/node1'][0])
+        self.assertFalse(('recipes', 'recipe1', 'recipe1/node1/empty') in values)
+
+    def test_not_expanded_values_are_whole(self):
+        self.assertEqual(self._read(['{"a": {"b"', ': [1, 2]}, "c": 1', '0}'], lambda path: len(path) == 0),
+                         [(('a',), {'b': [1, 2]}), (('c',), 10)])
+        self.assertEqual(self._read(['[]']), [])
+
+    def test_errors(self):
+        for chunks in [['{"a": 1'], ['{"a": 1} x'], ['"{\\"a\\": 1}'], ['{"a" 1}'], ['']]:
+            self.assertRaises(ValueError, self._read, chunks)
+
+
+class TestRecipeStreamedGet(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._server = HTTPServer(('127.0.0.1', 0), _RecipeGetHandler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: self._server.server_address[1],
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh'})
+        self._api = DKCloudAPI(config)
+        self._api._auth_token = 'a-token'  # the stand-in server has no login endpoint
+
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestRecipeStreamedGet._TEMPFILE_LOCATION)
+        self._kitchen_dir = os.path.join(self._temp_dir, 'kitchen')
+        os.makedirs(os.path.join(self._kitchen_dir, '.dk', 'recipes'))
+        with open(os.path.join(self._kitchen_dir, '.dk', 'KITCHEN_META'), 'w') as f:
+            f.write('kitchen')
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._api.close()
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_recipe_streamed(self):
+        saved = list()
+        rc = self._api.get_recipe_streamed('kitchen', 'recipe1', lambda key, f: saved.append((key, f['filename'])))
+        self.assertTrue(rc.ok())
+        self.assertEqual(sorted(saved), sorted((key, f['filename']) for key, files in RECIPE.items() for f in files))
+        self.assertEqual(rc.get_payload()['ORIG_HEAD'], 'abc123')
+        self.assertEqual(rc.get_payload()['recipes']['recipe1']['recipe1/node1'], ['query.sql', 'notebook.json'])
+        self.assertEqual(rc.get_payload()['recipes']['recipe1']['recipe1/node1/empty'], [])
+
+        rc = self._api.get_recipe_streamed('kitchen', 'recipe2', lambda key, f: None)
+        self.assertFalse(rc.ok())
+
+    def test_files_are_written_as_they_arrive(self):
+        rc = DKCloudCommandRunner._get_recipe_new(self._api, 'kitchen', 'recipe1', self._kitchen_dir)
+        self.assertTrue(rc.ok(), rc.get_message())
+        recipe_dir = os.path.join(self._kitchen_dir, 'recipe1')
+        with open(os.path.join(recipe_dir, 'node1', 'query.sql')) as f:
+            self.assertEqual(f.read().decode('utf-8'), RECIPE['recipe1/node1'][0]['text'])
+        with open(os.path.join(recipe_dir, 'description.json')) as f:
+            self.assertEqual(json.load(f), {'description': 'recipe 1'})
+        self.assertTrue(os.path.isdir(os.path.join(recipe_dir, 'node1', 'empty')))
+        self.assertEqual(DKRecipeDisk.get_orig_head(recipe_dir), 'abc123')
+
+
+if __name__ == '__main__':
+    unittest.main()
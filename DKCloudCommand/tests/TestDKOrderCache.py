@@ -0,0 +1,184 @@
+import unittest
+import os, tempfile, shutil, time
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKOrderCache import DKOrderCache
+from DKCloudCommandConfig import DKCloudCommandConfig
+from DKCloudCommandRunner import DKCloudCommandRunner
+from DKReturnCode import DKReturnCode
+
+__author__ = 'DataKitchen, Inc.'
+
+
+def make_order(recipe, number, status='Active'):
+    return {'serving_chronos_id': 'DKRecipe#dk#%s#variation1#kitchen1#%d' % (recipe, number),
+            'chronos-status': status}
+
+
+def make_serving(order, number, status, start_time, duration=1000):
+    return {'serving_mesos_id': 'ct:%d:%s' % (number, order['serving_chronos_id']),
+            'status': status,
+            'timings': {'start-time': start_time, 'end-time': start_time + duration, 'duration': duration}}
+
+
+class _OrderListApi(object):
+    # Serves a fixed order list, newest first, and records how many orders each refresh read.
+    def __init__(self, orders, config=None):
+        self.orders = orders
+        self.orders_read = 0
+        self.config = config
+        self.details_requested = 0
+
+    def get_config(self):
+        return self.config
+
+    def orderrun_detail(self, kitchen, pd):
+        self.details_requested += 1
+        rc = DKReturnCode()
+        servings = [dict(serving, logs={'lines': ['a log line']}) for order, servings in self.orders
+                    for serving in servings if serving['serving_mesos_id'] == pd.get('serving_mesos_id')]
+        rc.set(rc.DK_SUCCESS, None, servings)
+        return rc
+
+    def iter_orders(self, kitchen, page_size=None, order_run_count=3, start=0, recipe=None):
+        for order, servings in self.orders[start:]:
+            if recipe is None or '#%s#' % recipe in order['serving_chronos_id']:
+                self.orders_read += 1
+                yield order, servings
+
+
+class TestDKOrderCache(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKOrderCache._TEMPFILE_LOCATION)
+        self._cache = DKOrderCache(os.path.join(self._temp_dir, 'order_cache.db'))
+        self._now = int(time.time() * 1000)
+
+    def tearDown(self):
+        self._cache.close()
+        shutil.rmtree(self._temp_dir)
+
+    def _make_orders(self, count):
+        orders = list()
+        for i in range(count):
+            order = make_order('recipe%d' % (i % 2), i)
+            status = 'SERVING_ERROR' if i % 4 == 0 else 'COMPLETED_SERVING'
+            orders.append((order, [make_serving(order, i, status, self._now - i * 60000, 1000 * (i + 1))]))
+        return orders
+
+    def test_refresh_is_incremental(self):
+        api = _OrderListApi(self._make_orders(20))
+        self.assertEqual(self._cache.refresh(api, 'kitchen1', page_size=5), 20)
+        self.assertEqual(api.orders_read, 20)
+        self.assertEqual(self._cache.get_newest_start_time('kitchen1'), self._now)
+
+        # one new order run at the top of the list, the rest is already known
+        order = make_order('recipe0', 20)
+        api.orders = [(order, [make_serving(order, 20, 'ACTIVE_SERVING', self._now + 1000)])] + api.orders
+        api.orders_read = 0
+        self.assertEqual(self._cache.refresh(api, 'kitchen1', page_size=5), 1)
+        self.assertEqual(api.orders_read, 6)
+
+        orders = self._cache.get_orders('kitchen1', count=2)
+        self.assertEqual([o['serving_chronos_id'] for o, servings in orders],
+                         [make_order('recipe0', 20)['serving_chronos_id'], make_order('recipe0', 0)['serving_chronos_id']])
+        self.assertEqual(orders[0][1][0]['status'], 'ACTIVE_SERVING')
+        self.assertEqual(len(self._cache.get_orders('kitchen1', recipe='recipe1')), 10)
+
+    def test_run_stats(self):
+        self._cache.refresh(_OrderListApi(self._make_orders(8)), 'kitchen1', page_size=5)
+        stats = self._cache.get_run_stats('kitchen1')
+        self.assertEqual([(s['recipe'], s['runs'], s['failed']) for s in stats],
+                         [('recipe0', 4, 2), ('recipe1', 4, 0)])
+        self.assertEqual(stats[0]['max_duration'], 7000)
+        self.assertEqual(stats[1]['avg_duration'], 5000)
+        recent = self._cache.get_run_stats('kitchen1', recipe='recipe0', since=self._now - 150000)
+        self.assertEqual([(s['runs'], s['failed']) for s in recent], [(2, 1)])
+        self.assertEqual(self._cache.get_run_stats('kitchen2'), [])
+
+    def test_evict(self):
+        self._cache.refresh(_OrderListApi(self._make_orders(10)), 'kitchen1', page_size=5)
+        self._cache.evict(max_order_runs=6)
+        self.assertEqual(sum(s['runs'] for s in self._cache.get_run_stats('kitchen1')), 6)
+        # order runs 0 to 2 minutes old survive
+        self._cache.evict(max_age_days=2.5 / (24 * 60))
+        self.assertEqual(sum(s['runs'] for s in self._cache.get_run_stats('kitchen1')), 3)
+
+    def test_order_run_details(self):
+        order = make_order('recipe0', 1)
+        finished = make_serving(order, 1, 'COMPLETED_SERVING', self._now)
+        running = make_serving(order, 2, 'ACTIVE_SERVING', self._now)
+        self.assertTrue(self._cache.save_order_run_detail('kitchen1', finished['serving_mesos_id'],
+                                                          {'summary': True, 'logs': True, 'runstatus': True},
+                                                          finished))
+        self.assertFalse(self._cache.save_order_run_detail('kitchen1', running['serving_mesos_id'],
+                                                           {'summary': True}, running))
+        self.assertEqual(self._cache.get_order_run_detail('kitchen1', finished['serving_mesos_id'],
+                                                          {'summary': True}), finished)
+        self.assertEqual(self._cache.get_order_run_detail('kitchen1', finished['serving_mesos_id'],
+                                                          {'summary': True, 'testresults': True}), None)
+        self.assertEqual(self._cache.get_order_run_detail('kitchen1', running['serving_mesos_id'],
+                                                          {'summary': True}), None)
+        self.assertEqual(self._cache.get_order_run_detail('kitchen2', finished['serving_mesos_id'],
+                                                          {'summary': True}), None)
+        # a failed order run can be resumed, an unknown state may change too
+        for status in ['SERVING_ERROR', 'SOME_NEW_STATE']:
+            serving = make_serving(order, 3, status, self._now)
+            self.assertFalse(self._cache.save_order_run_detail('kitchen1', serving['serving_mesos_id'],
+                                                               {'summary': True}, serving))
+        self._cache.forget_order_run_detail(finished['serving_mesos_id'])
+        self.assertEqual(self._cache.get_order_run_detail('kitchen1', finished['serving_mesos_id'],
+                                                          {'summary': True}), None)
+
+    def _make_config(self):
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: 1,
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh'})
+        config.set_dk_temp_folder(self._temp_dir)
+        return config
+
+    def test_orderrun_info_is_fetched_once(self):
+        api = _OrderListApi(self._make_orders(4), self._make_config())
+        order_run_id = api.orders[1][1][0]['serving_mesos_id']
+        for i in range(3):
+            pd = {'summary': True, 'logs': True, 'serving_mesos_id': order_run_id}
+            rc = DKCloudCommandRunner._get_orderrun_detail(api, 'kitchen1', pd)
+            self.assertTrue(rc.ok())
+            self.assertEqual(rc.get_payload()[0]['logs'], {'lines': ['a log line']})
+        self.assertEqual(api.details_requested, 1)
+        # without an order run id the newest run is wanted, that always comes from the server
+        DKCloudCommandRunner._get_orderrun_detail(api, 'kitchen1', {'summary': True})
+        self.assertEqual(api.details_requested, 2)
+
+    def test_orderrun_info_after_resume(self):
+        api = _OrderListApi(self._make_orders(4), self._make_config())
+        serving = api.orders[1][1][0]
+        pd = {'summary': True, 'serving_mesos_id': serving['serving_mesos_id']}
+        DKCloudCommandRunner._get_orderrun_detail(api, 'kitchen1', dict(pd))
+        DKCloudCommandRunner._get_orderrun_detail(api, 'kitchen1', dict(pd))
+        self.assertEqual(api.details_requested, 1)
+        # orderrun-resume starts the same order run again
+        DKCloudCommandRunner._forget_orderrun_detail(api, serving['serving_mesos_id'])
+        serving['status'] = 'ACTIVE_SERVING'
+        rc = DKCloudCommandRunner._get_orderrun_detail(api, 'kitchen1', dict(pd))
+        self.assertEqual(rc.get_payload()[0]['status'], 'ACTIVE_SERVING')
+        self.assertEqual(api.details_requested, 2)
+
+    def test_cached_order_list(self):
+        api = _OrderListApi(self._make_orders(12), self._make_config())
+        rc = DKCloudCommandRunner._list_cached_order(api, 'kitchen1', 5, 1, 2, None, True)
+        self.assertTrue(rc.ok(), rc.get_message())
+        self.assertEqual([order['serving_chronos_id'] for order, servings in rc.get_payload()],
+                         [order['serving_chronos_id'] for order, servings in api.orders[2:7]])
+        self.assertTrue(api.orders[2][0]['serving_chronos_id'] in rc.get_message())
+        api.orders_read = 0
+        rc = DKCloudCommandRunner._list_cached_order(api, 'kitchen1', 5, 1, 0, 'recipe1', False)
+        self.assertTrue(rc.ok(), rc.get_message())
+        self.assertEqual(len(rc.get_payload()), 5)
+        self.assertEqual(api.orders_read, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
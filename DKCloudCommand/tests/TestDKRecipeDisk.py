@@ -1,7 +1,7 @@
 import unittest
 import sys
 import pickle
-import os, tempfile, shutil
+import os, tempfile, shutil, json
 from DKCommonUnitTestSettings import DKCommonUnitTestSettings
 
 from DKRecipeDisk import *
@@ -165,6 +165,186 @@ class TestDKRecipeDisk(DKCommonUnitTestSettings):
         self.assertEqual(root[0]['filename'], 'file_01_01.txt')
         self.assertEqual(root[0]['sha'], 'c9536cbfeddf3b47bce62052c516550d742e6840')
 
+    def test_scan_recipe_dir(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        recipe_dir = os.path.join(temp_dir, 'recipe01')
+        shutil.copytree(os.path.join(os.getcwd(), 'files', 'recipe01'), recipe_dir)
+        os.makedirs(os.path.join(recipe_dir, 'compiled-recipe'))
+        with open(os.path.join(recipe_dir, 'compiled-recipe', 'compiled.json'), 'w') as f:
+            f.write('{}')
+        with open(os.path.join(recipe_dir, 'sub01', '.DS_Store'), 'w') as f:
+            f.write('')
+
+        directory_sha, file_shas = scan_recipe_dir(recipe_dir)
+        self.assertEqual(directory_sha, get_directory_sha(os.path.join(os.getcwd(), 'files', 'recipe01')))
+        self.assertEqual(sorted(file_shas.keys()), ['recipe01/file_01_01.txt',
+                                                    'recipe01/sub01/file_01_01_01.txt',
+                                                    'recipe01/sub01/sub02/file_01_01_02_02.txt'])
+        self.assertEqual(file_shas['recipe01/file_01_01.txt'],
+                         DKRecipeDisk.get_sha(os.path.join(recipe_dir, 'file_01_01.txt')))
+        self.assertEqual(file_shas, DKRecipeDisk.fetch_shas(recipe_dir))
+        shutil.rmtree(temp_dir)
+
+    def test_scan_recipe_dir_does_not_follow_folder_links(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        recipe_dir = os.path.join(temp_dir, 'recipe01')
+        shutil.copytree(os.path.join(os.getcwd(), 'files', 'recipe01'), recipe_dir)
+        # a link back up the tree would make the scan recurse forever
+        os.symlink(recipe_dir, os.path.join(recipe_dir, 'sub01', 'loop'))
+        os.symlink(os.path.join(recipe_dir, 'file_01_01.txt'), os.path.join(recipe_dir, 'sub01', 'link.txt'))
+
+        directory_sha, file_shas = scan_recipe_dir(recipe_dir)
+        self.assertEqual(directory_sha['recipe01/sub01/loop'], [])
+        self.assertFalse('recipe01/sub01/loop/sub01' in directory_sha)
+        self.assertEqual(sorted(file_shas.keys()), ['recipe01/file_01_01.txt',
+                                                    'recipe01/sub01/file_01_01_01.txt',
+                                                    'recipe01/sub01/link.txt',
+                                                    'recipe01/sub01/sub02/file_01_01_02_02.txt'])
+        self.assertEqual(file_shas['recipe01/sub01/link.txt'], file_shas['recipe01/file_01_01.txt'])
+        shutil.rmtree(temp_dir)
+
+    def test_materializer(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        DKKitchenDisk.write_kitchen('kitchen1', temp_dir)
+        kitchen_dir = os.path.join(temp_dir, 'kitchen1')
+        recipe = {'recipe1': [{'filename': 'description.json', 'json': {'description': 'one'}}],
+                  'recipe1/node1': [{'filename': 'query.sql', 'text': u'select 1 -- \xe9'},
+                                    {'filename': 'notes.txt', 'text': 'notes'}],
+                  'recipe1/node1/empty': []}
+        self.assertTrue(DKRecipeDisk('sha1', recipe, kitchen_dir).save_recipe_to_disk(max_workers=4))
+        recipe_dir = os.path.join(kitchen_dir, 'recipe1')
+        self.assertEqual(DKRecipeDisk.get_orig_head(recipe_dir), 'sha1')
+        self.assertTrue(os.path.isdir(os.path.join(recipe_dir, 'node1', 'empty')))
+        with open(os.path.join(recipe_dir, 'node1', 'query.sql')) as f:
+            self.assertEqual(f.read(), u'select 1 -- \xe9'.encode('utf8'))
+        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir('recipe1', kitchen_dir)
+        self.assertEqual(DKRecipeDisk.load_saved_shas(recipe_meta_dir), DKRecipeDisk.fetch_shas(recipe_dir))
+        with open(os.path.join(recipe_meta_dir, DK_CONFLICTS_META), 'w') as f:
+            f.write('{}')
+        self.assertTrue(DKRecipeDisk.save_remote_tree(recipe_dir, 'kitchen1', 'recipe1', '"tree-1"', {}))
+        # make the files old enough for the sha cache
+        for name in ['query.sql', 'notes.txt']:
+            os.utime(os.path.join(recipe_dir, 'node1', name), (1500000000, 1500000000))
+        DKRecipeDisk.fetch_shas(recipe_dir)
+        unchanged_inode = os.stat(os.path.join(recipe_dir, 'node1', 'query.sql')).st_ino
+
+        # an interrupted get leaves the recipe as it was
+        materializer = DKRecipeMaterializer(kitchen_dir, 'recipe1', 2)
+        materializer.add_file('recipe1/node1', {'filename': 'query.sql', 'text': 'select 2'})
+        materializer.abort()
+        with open(os.path.join(recipe_dir, 'node1', 'query.sql')) as f:
+            self.assertEqual(f.read(), u'select 1 -- \xe9'.encode('utf8'))
+        self.assertEqual(sorted(os.listdir(os.path.join(kitchen_dir, DK_DIR))), ['KITCHEN_META', 'recipes'])
+
+        materializer = DKRecipeMaterializer(kitchen_dir, 'recipe1', 2)
+        materializer.add_file('recipe1/node1', recipe['recipe1/node1'][0])
+        materializer.add_file('recipe1/node1', {'filename': 'notes.txt', 'text': 'new notes'})
+        materializer.commit('sha2')
+        self.assertEqual(materializer.get_linked_files(), 1)
+        self.assertEqual(os.stat(os.path.join(recipe_dir, 'node1', 'query.sql')).st_ino, unchanged_inode)
+        self.assertEqual(sorted(os.listdir(recipe_dir)), ['node1'])
+        self.assertEqual(DKRecipeDisk.get_orig_head(recipe_dir), 'sha2')
+        self.assertEqual(DKRecipeDisk.load_saved_shas(recipe_meta_dir), DKRecipeDisk.fetch_shas(recipe_dir))
+        self.assertTrue(os.path.isfile(os.path.join(recipe_meta_dir, DK_CONFLICTS_META)))
+        # the remote tree belongs to the old ORIG_HEAD
+        self.assertFalse(os.path.exists(os.path.join(recipe_meta_dir, REMOTE_TREE)))
+        self.assertEqual(sorted(os.listdir(os.path.join(kitchen_dir, DK_DIR))), ['KITCHEN_META', 'recipes'])
+        shutil.rmtree(temp_dir)
+
+    def test_materializer_keeps_old_recipe_when_undo_fails(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        DKKitchenDisk.write_kitchen('kitchen1', temp_dir)
+        kitchen_dir = os.path.join(temp_dir, 'kitchen1')
+        recipe = {'recipe1': [{'filename': 'description.json', 'text': 'old'}]}
+        self.assertTrue(DKRecipeDisk('sha1', recipe, kitchen_dir).save_recipe_to_disk())
+        recipe_dir = os.path.join(kitchen_dir, 'recipe1')
+
+        materializer = DKRecipeMaterializer(kitchen_dir, 'recipe1', 2)
+        materializer.add_file('recipe1', {'filename': 'description.json', 'text': 'new'})
+        rename = os.rename
+        renames = list()
+
+        def failing_rename(source, target):
+            # the old recipe moves out, then every other rename fails
+            renames.append((source, target))
+            if len(renames) > 1:
+                raise OSError(13, 'Permission denied')
+            rename(source, target)
+
+        os.rename = failing_rename
+        try:
+            with self.assertRaises(OSError) as cm:
+                materializer.commit('sha2')
+        finally:
+            os.rename = rename
+        materializer.abort()
+        stage_dir = os.path.dirname(renames[0][1])
+        self.assertTrue(stage_dir in str(cm.exception), str(cm.exception))
+        self.assertFalse(os.path.exists(recipe_dir))
+        with open(os.path.join(stage_dir, 'old-recipe', 'description.json')) as f:
+            self.assertEqual(f.read(), 'old')
+        # a new get keeps it too
+        DKRecipeMaterializer(kitchen_dir, 'recipe1', 1).abort()
+        self.assertTrue(os.path.isdir(os.path.join(stage_dir, 'old-recipe')))
+        shutil.rmtree(temp_dir)
+
+    def test_materializer_prunes_old_stage_dirs(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        DKKitchenDisk.write_kitchen('kitchen1', temp_dir)
+        kitchen_dir = os.path.join(temp_dir, 'kitchen1')
+        kitchen_meta_dir = os.path.join(kitchen_dir, DK_DIR)
+        for name in ['stage-old', 'stage-recent']:
+            os.makedirs(os.path.join(kitchen_meta_dir, name, 'recipe'))
+        os.utime(os.path.join(kitchen_meta_dir, 'stage-old'), (1500000000, 1500000000))
+        DKRecipeMaterializer(kitchen_dir, 'recipe1', 1).abort()
+        self.assertEqual(sorted(os.listdir(kitchen_meta_dir)), ['KITCHEN_META', 'recipes', 'stage-recent'])
+        shutil.rmtree(temp_dir)
+
+    def test_conflicts_store(self):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKRecipeDisk._TEMPFILE_LOCATION)
+        DKKitchenDisk.write_kitchen('kitchen1', temp_dir)
+        kitchen_dir = os.path.join(temp_dir, 'kitchen1')
+        recipe_dir = os.path.join(kitchen_dir, 'recipe1')
+        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir('recipe1', kitchen_dir)
+        os.makedirs(recipe_meta_dir)
+        conflicts_file = os.path.join(recipe_meta_dir, DK_CONFLICTS_META)
+
+        conflicts_store = DKConflictsStore(recipe_meta_dir)
+        for i in range(200):
+            conflicts_store.add({'from_kitchen': 'child', 'to_kitchen': 'parent', 'filename': 'file%d.sql' % i,
+                                 'sha': 'none', 'conflict_tags': 'tags'}, 'recipe1/node1', 'recipe1')
+        conflicts_store.add({'from_kitchen': 'other', 'to_kitchen': 'parent', 'filename': 'description.json',
+                             'sha': 'none', 'conflict_tags': 'tags'}, 'recipe1', 'recipe1')
+        # nothing is written until the store is flushed
+        self.assertEqual(DKRecipeDisk.get_conflicts_meta(recipe_meta_dir), {})
+        self.assertTrue(conflicts_store.flush())
+        with open(conflicts_file) as f:
+            conflicts = json.load(f)
+        self.assertEqual(len(conflicts['recipe1/node1']), 200)
+        conflict_info = conflicts['recipe1/node1']['child|parent|recipe1|recipe1/node1|file7.sql']
+        self.assertEqual(conflict_info['status'], 'unresolved')
+        self.assertEqual(conflict_info['folder_in_recipe'], 'recipe1/node1')
+
+        unresolved = DKRecipeDisk.get_unresolved_conflicts_meta(recipe_meta_dir, 'child', 'parent')
+        self.assertEqual(unresolved.keys(), ['recipe1/node1'])
+        self.assertEqual(len(unresolved['recipe1/node1']), 200)
+        self.assertEqual(len(DKRecipeDisk.get_unresolved_conflicts_meta(recipe_meta_dir)), 2)
+
+        self.assertTrue(DKRecipeDisk.resolve_conflict(recipe_meta_dir, recipe_dir,
+                                                      os.path.join(recipe_dir, 'node1', 'file7.sql')))
+        self.assertTrue(DKRecipeDisk.resolve_conflict(recipe_meta_dir, recipe_dir,
+                                                      os.path.join(recipe_dir, 'description.json')))
+        self.assertFalse(DKRecipeDisk.resolve_conflict(recipe_meta_dir, recipe_dir,
+                                                       os.path.join(recipe_dir, 'node1', 'file7.sql')))
+        self.assertFalse(DKRecipeDisk.resolve_conflict(recipe_meta_dir, recipe_dir,
+                                                       os.path.join(recipe_dir, 'node1', 'missing.sql')))
+        resolved = DKRecipeDisk.get_resolved_conflicts_meta(recipe_meta_dir, 'child', 'parent')
+        self.assertEqual(resolved['recipe1/node1'].keys(), ['child|parent|recipe1|recipe1/node1|file7.sql'])
+        self.assertEqual(len(DKRecipeDisk.get_unresolved_conflicts_meta(recipe_meta_dir, 'child', 'parent')
+                             ['recipe1/node1']), 199)
+        self.assertEqual(DKRecipeDisk.get_unresolved_conflicts_meta(recipe_meta_dir, 'other', 'parent'), {})
+        shutil.rmtree(temp_dir)
+
     # <kitchen_name>
     #   .dk
     #       KITCHEN_META
@@ -0,0 +1,75 @@
+import unittest
+import os, sys, json
+from StringIO import StringIO
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKResponseDecoder import DKResponseDecoder, SHAPE_EMPTY, SHAPE_JSON, SHAPE_ENCODED, DEBUG_ENV
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class _Response(object):
+    def __init__(self, content, url='http://localhost/v2/kitchen/list'):
+        self.content = content
+        self.text = content.decode('utf-8')
+        self.url = url
+
+
+class _BrokenBackend(object):
+    # stands in for a fast parser that refuses a document
+    __name__ = 'broken'
+
+    @staticmethod
+    def loads(s):
+        raise ValueError('not supported')
+
+
+class TestDKResponseDecoder(DKCommonUnitTestSettings):
+
+    def tearDown(self):
+        DKResponseDecoder.set_backend(None)
+
+    def test_shape(self):
+        self.assertEqual(DKResponseDecoder.get_shape(''), SHAPE_EMPTY)
+        self.assertEqual(DKResponseDecoder.get_shape(' \r\n'), SHAPE_EMPTY)
+        self.assertEqual(DKResponseDecoder.get_shape('\n {"a": 1}'), SHAPE_JSON)
+        self.assertEqual(DKResponseDecoder.get_shape('\xef\xbb\xbf[1]'), SHAPE_JSON)
+        self.assertEqual(DKResponseDecoder.get_shape(u' "{\\"a\\": 1}"'), SHAPE_ENCODED)
+
+    def test_decode(self):
+        doc = {'kitchens': [{'name': 'master', 'description': 'a "quoted"\nline \xc3\xa9'.decode('utf-8')}]}
+        self.assertEqual(DKResponseDecoder.decode(json.dumps(doc)), doc)
+        self.assertEqual(DKResponseDecoder.decode(json.dumps(json.dumps(doc))), doc)
+        self.assertEqual(DKResponseDecoder.decode('"a-token"'), 'a-token')
+        self.assertEqual(DKResponseDecoder.decode('true'), True)
+        self.assertEqual(DKResponseDecoder.decode(''), None)
+        self.assertEqual(DKResponseDecoder.decode('<html>Bad Gateway</html>'), None)
+
+    def test_embedded_json_strings(self):
+        body = json.dumps({'servings': [{'summary': json.dumps({'a': [1, 2]})}, {'summary': '{not json}'}],
+                           'file': {'filename': 'description.json', 'json': '{"one": "line"}'}})
+        self.assertEqual(DKResponseDecoder.decode(body), {'servings': [{'summary': {'a': [1, 2]}},
+                                                                       {'summary': '{not json}'}],
+                                                          'file': {'filename': 'description.json',
+                                                                   'json': '{"one": "line"}'}})
+
+    def test_fast_backend_falls_back(self):
+        DKResponseDecoder.set_backend(_BrokenBackend)
+        self.assertEqual(DKResponseDecoder.decode(json.dumps(json.dumps({'a': 1}))), {'a': 1})
+
+    def test_debug_timing(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        os.environ[DEBUG_ENV] = '1'
+        try:
+            self.assertEqual(DKResponseDecoder.decode_response(_Response('{"a": 1}')), {'a': 1})
+            output = sys.stderr.getvalue()
+        finally:
+            del os.environ[DEBUG_ENV]
+            sys.stderr = stderr
+        self.assertTrue(output.startswith('DKResponseDecoder: http://localhost/v2/kitchen/list 8 bytes (json, '))
+        self.assertTrue(output.endswith(' ms\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import os, tempfile, shutil, json, time
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKShaCache import DKShaCache, SHA_CACHE
+from DKRecipeDisk import DKRecipeDisk
+from githash import githash_data
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class TestDKShaCache(DKCommonUnitTestSettings):
+
+    def _make_recipe_dir(self, kitchen_name, recipe_name):
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKShaCache._TEMPFILE_LOCATION)
+        kitchen_dir = os.path.join(temp_dir, kitchen_name)
+        recipe_meta_dir = os.path.join(kitchen_dir, '.dk', 'recipes', recipe_name)
+        os.makedirs(recipe_meta_dir)
+        with open(os.path.join(kitchen_dir, '.dk', 'KITCHEN_META'), 'w') as kitchen_file:
+            kitchen_file.write(kitchen_name)
+        with open(os.path.join(recipe_meta_dir, 'RECIPE_META'), 'w') as recipe_meta_file:
+            recipe_meta_file.write(recipe_name)
+        recipe_dir = os.path.join(kitchen_dir, recipe_name)
+        os.makedirs(os.path.join(recipe_dir, 'node1'))
+        return temp_dir, recipe_dir, recipe_meta_dir
+
+    def _write_old_file(self, file_path, contents):
+        with open(file_path, 'w') as f:
+            f.write(contents)
+        an_hour_ago = time.time() - 3600
+        os.utime(file_path, (an_hour_ago, an_hour_ago))
+
+    def test_cache_hit_and_invalidation(self):
+        temp_dir, recipe_dir, recipe_meta_dir = self._make_recipe_dir('kitchen', 'recipe1')
+        file_path = os.path.join(recipe_dir, 'node1', 'description.json')
+        self._write_old_file(file_path, 'first version')
+
+        cache = DKShaCache(recipe_dir)
+        the_githash, the_sha = cache.get_shas(file_path)
+        self.assertEqual(the_githash, githash_data('first version'))
+        self.assertEqual(the_sha, DKRecipeDisk.get_sha(file_path))
+        self.assertTrue(cache.save())
+
+        cache_file = os.path.join(recipe_meta_dir, SHA_CACHE)
+        self.assertTrue(os.path.isfile(cache_file))
+
+        # Tamper with the cached value; a cache hit must not read the file again.
+        with open(cache_file, 'r') as f:
+            entries = json.load(f)
+        entries['node1/description.json'][4] = 'cached'
+        with open(cache_file, 'w') as f:
+            json.dump(entries, f)
+        self.assertEqual(DKShaCache(recipe_dir).get_sha(file_path), 'cached')
+
+        # A change in size/mtime invalidates the entry.
+        self._write_old_file(file_path, 'second, longer version')
+        self.assertEqual(DKShaCache(recipe_dir).get_sha(file_path), DKRecipeDisk.get_sha(file_path))
+        shutil.rmtree(temp_dir)
+
+    def test_recently_modified_files_are_not_cached(self):
+        temp_dir, recipe_dir, recipe_meta_dir = self._make_recipe_dir('kitchen', 'recipe1')
+        file_path = os.path.join(recipe_dir, 'node1', 'description.json')
+        with open(file_path, 'w') as f:
+            f.write('just written')
+
+        cache = DKShaCache(recipe_dir)
+        self.assertEqual(cache.get_githash(file_path), githash_data('just written'))
+        cache.save()
+        self.assertFalse(os.path.isfile(os.path.join(recipe_meta_dir, SHA_CACHE)))
+        shutil.rmtree(temp_dir)
+
+    def test_fetch_shas_uses_cache(self):
+        temp_dir, recipe_dir, recipe_meta_dir = self._make_recipe_dir('kitchen', 'recipe1')
+        self._write_old_file(os.path.join(recipe_dir, 'node1', 'a.sql'), 'select 1')
+        self._write_old_file(os.path.join(recipe_dir, 'b.json'), '{}')
+
+        first = DKRecipeDisk.fetch_shas(recipe_dir)
+        self.assertEqual(sorted(first.keys()), ['recipe1/b.json', 'recipe1/node1/a.sql'])
+        self.assertTrue(os.path.isfile(os.path.join(recipe_meta_dir, SHA_CACHE)))
+        self.assertEqual(DKRecipeDisk.fetch_shas(recipe_dir), first)
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+import os, tempfile, shutil, json, zlib
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKUploadBody import DKUploadBody
+from DKCloudAPI import DKCloudAPI
+from DKCloudCommandConfig import DKCloudCommandConfig
+from DKCloudCommandRunner import DKCloudCommandRunner
+from DKRecipeDisk import DKRecipeDisk
+from DKKitchenDisk import DKKitchenDisk
+from DKReturnCode import DKReturnCode
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class TestDKUploadBody(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestDKUploadBody._TEMPFILE_LOCATION)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write_file(self, name, contents):
+        full_path = os.path.join(self._temp_dir, name)
+        with open(full_path, 'w') as f:
+            f.write(contents)
+        return full_path
+
+    def test_iter_json(self):
+        # multi-byte characters and escapes split across chunk boundaries
+        big_contents = ('select "\xc3\xa9t\xc3\xa9"\n\t\\ from table;\n' * 5000)
+        big_file = self._write_file('big.sql', big_contents)
+        changes = {
+            'resources/big.sql': {'file': big_file, 'isNew': True},
+            'description.json': {'contents': '{"a": 1}', 'isNew': False},
+            'old.txt': {}
+        }
+        body = ''.join(DKUploadBody.iter_json('a "message"', changes, chunk_size=7))
+        rd = json.loads(body)
+        self.assertEqual(rd['message'], 'a "message"')
+        self.assertEqual(rd['files']['resources/big.sql'], {'contents': big_contents.decode('utf-8'), 'isNew': True})
+        self.assertEqual(rd['files']['description.json'], {'contents': '{"a": 1}', 'isNew': False})
+        self.assertEqual(rd['files']['old.txt'], {})
+
+    def test_gzip(self):
+        changes = {'description.json': {'contents': 'x' * 100000, 'isNew': False}}
+        expected = ''.join(DKUploadBody.iter_json('message', changes))
+        compressed = ''.join(DKUploadBody.gzip(DKUploadBody.iter_json('message', changes)))
+        self.assertTrue(len(compressed) < len(expected))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), expected)
+
+    def test_split_changes(self):
+        changes = {
+            'a.txt': {'contents': 'a' * 40, 'isNew': True},
+            'b.txt': {'file': self._write_file('b.txt', 'b' * 40), 'isNew': False},
+            'c.txt': {'contents': 'c' * 150, 'isNew': True},
+            'd.txt': {}
+        }
+        batches = DKUploadBody.split_changes(changes, 100)
+        self.assertEqual([sorted(batch.keys()) for batch in batches], [['a.txt', 'b.txt'], ['c.txt', 'd.txt']])
+        self.assertEqual(DKUploadBody.split_changes(changes, None), [changes])
+
+    def test_update_files_fails_on_invalid_utf8(self):
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: 1,
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh'})
+        api = DKCloudAPI(config)
+        api._auth_token = 'a-token'  # nothing is sent, the body can't be built
+        changes = {'latin1.sql': {'file': self._write_file('latin1.sql', 'select "\xe9t\xe9"'), 'isNew': False}}
+        rc = api.update_files('kitchen', 'recipe', 'message', changes)
+        self.assertFalse(rc.ok())
+        self.assertTrue('update_file: exception' in rc.get_message(), rc.get_message())
+
+    def test_update_files_keeps_committed_parts(self):
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: 1,
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh',
+                               DKCloudCommandConfig.DK_CLOUD_MAX_UPLOAD_SIZE: 10})
+        api = DKCloudAPI(config)
+        requests = list()
+
+        def update_files_request(kitchen, recipe, message, changes):
+            # the server takes the first part and fails the second one
+            requests.append(message)
+            rc = DKReturnCode()
+            if len(requests) > 1:
+                rc.set(rc.DK_FAIL, 'server error')
+            else:
+                rc.set(rc.DK_SUCCESS, None, dict((path, True) for path in changes))
+            return rc
+
+        api._update_files_request = update_files_request
+        changes = {'a.txt': {'contents': '0123456789', 'isNew': False},
+                   'b.txt': {'contents': '0123456789', 'isNew': False}}
+        rc = api.update_files('kitchen', 'recipe', 'message', changes)
+        self.assertFalse(rc.ok())
+        self.assertEqual(requests, ['message (part 1 of 2)', 'message (part 2 of 2)'])
+        self.assertEqual(rc.get_payload(), {'a.txt': True, 'issues': []})
+
+    def test_update_files_batch_saves_committed_files(self):
+        class _PartlyFailingApi(object):
+            def update_files(self, kitchen, recipe, message, changes):
+                rc = DKReturnCode()
+                rc.set(rc.DK_FAIL, 'server error', {'a.txt': True, 'issues': []})
+                return rc
+
+        DKKitchenDisk.write_kitchen('kitchen1', self._temp_dir)
+        kitchen_dir = os.path.join(self._temp_dir, 'kitchen1')
+        recipe = {'recipe1': [{'filename': 'a.txt', 'text': 'a'}, {'filename': 'b.txt', 'text': 'b'}]}
+        self.assertTrue(DKRecipeDisk('sha1', recipe, kitchen_dir).save_recipe_to_disk())
+        recipe_path = os.path.join(kitchen_dir, 'recipe1')
+        recipe_meta_dir = DKKitchenDisk.get_recipe_meta_dir('recipe1', kitchen_dir)
+        saved_shas = DKRecipeDisk.load_saved_shas(recipe_meta_dir)
+        for name in ['a.txt', 'b.txt']:
+            self._write_file(os.path.join('kitchen1', 'recipe1', name), 'changed')
+        current_path = os.getcwd()
+        os.chdir(recipe_path)
+        try:
+            rc = DKCloudCommandRunner._update_files_batch(_PartlyFailingApi(), 'kitchen1', 'recipe1', recipe_path,
+                                                          recipe_path, 'message', ['a.txt', 'b.txt'],
+                                                          {'only_local': {}})
+        finally:
+            os.chdir(current_path)
+        self.assertFalse(rc.ok())
+        shas = DKRecipeDisk.load_saved_shas(recipe_meta_dir)
+        self.assertEqual(shas['recipe1/a.txt'], DKRecipeDisk.fetch_shas(recipe_path)['recipe1/a.txt'])
+        self.assertEqual(shas['recipe1/b.txt'], saved_shas['recipe1/b.txt'])
+
+    def test_update_files_batch_checks_every_file(self):
+        class _NoCallApi(object):
+            def update_files(self, *args):
+                raise AssertionError('nothing should be sent')
+
+        recipe_path = os.path.join(self._temp_dir, 'recipe1')
+        os.mkdir(recipe_path)
+        self._write_file('outside.txt', 'outside')
+        self._write_file(os.path.join('recipe1', 'a.txt'), 'a')
+        self._write_file(os.path.join('recipe1', 'b.bin'), '\xff\xfe\x00\x01')
+        rl = {'only_local': {}}
+        current_path = os.getcwd()
+        os.chdir(recipe_path)
+        try:
+            rc = DKCloudCommandRunner._update_files_batch(_NoCallApi(), 'kitchen', 'recipe1', recipe_path,
+                                                          recipe_path, 'message', ['a.txt', '../outside.txt'], rl)
+            self.assertFalse(rc.ok())
+            self.assertTrue('is not inside recipe directory' in rc.get_message(), rc.get_message())
+            rc = DKCloudCommandRunner._update_files_batch(_NoCallApi(), 'kitchen', 'recipe1', recipe_path,
+                                                          recipe_path, 'message', ['a.txt', 'b.bin'], rl)
+            self.assertFalse(rc.ok())
+            self.assertTrue('binary file' in rc.get_message(), rc.get_message())
+        finally:
+            os.chdir(current_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import os, tempfile, hashlib
+from cStringIO import StringIO
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from githash import githash, githash_data, githash_fileobj, hash_file, CHUNK_SIZE
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class TestGithash(DKCommonUnitTestSettings):
+
+    def test_hash_file_in_chunks(self):
+        data = ''.join(chr(i % 251) for i in range(3 * CHUNK_SIZE + 17))
+        fd, file_path = tempfile.mkstemp(prefix='unit-tests', dir=TestGithash._TEMPFILE_LOCATION)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+
+        the_githash, the_sha = hash_file(file_path)
+        self.assertEqual(the_githash, githash_data(data))
+        self.assertEqual(the_sha, hashlib.sha1(data).hexdigest())
+        with open(file_path, 'r') as f:
+            self.assertEqual(githash_fileobj(f), githash_data(data))
+        os.remove(file_path)
+
+    def test_known_blob_sha(self):
+        # same value as `git hash-object` on an empty file
+        self.assertEqual(githash_data(''), 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391')
+        self.assertEqual(githash_fileobj(StringIO('')), 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391')
+
+
+    def test_streamed(self):
+        data = 'x' * (2 * CHUNK_SIZE + 5)
+        h = githash(len(data))
+        for i in range(0, len(data), 1000):
+            h.update(data[i:i + 1000])
+        self.assertEqual(h.hexdigest(), githash_data(data))
+        h = githash(len(data) + 1)
+        h.update(data)
+        with self.assertRaises(ValueError):
+            h.hexdigest()
+
+    def test_file_that_changes_while_read(self):
+        class _GrowingFile(object):
+            # fstat says 3 bytes, the read brings 4
+            name = 'growing.txt'
+
+            def __init__(self):
+                self.data = StringIO('abcd')
+
+            def fileno(self):
+                return 0
+
+            def read(self, size):
+                return self.data.read(size)
+
+        fstat = os.fstat
+        os.fstat = lambda fd: os.stat_result((0, 0, 0, 0, 0, 0, 3, 0, 0, 0))
+        try:
+            self.assertRaises(IOError, githash_fileobj, _GrowingFile())
+        finally:
+            os.fstat = fstat
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+import os, tempfile, shutil, json, threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKCloudAPI import DKCloudAPI
+from DKCloudCommandConfig import DKCloudCommandConfig
+from DKRecipeDisk import REMOTE_TREE
+from githash import githash_data
+
+__author__ = 'DataKitchen, Inc.'
+
+TREE_ETAG = '"tree-1"'
+
+
+class _RecipeTreeHandler(BaseHTTPRequestHandler):
+    # Stand-in for /v2/recipe/tree/<kitchen>/<recipe> that supports If-None-Match.
+    requests_seen = list()
+    tree = None
+    # the ETag sent back with a 304, None to leave it out
+    not_modified_etag = None
+
+    def do_GET(self):
+        if_none_match = self.headers.getheader('If-None-Match')
+        _RecipeTreeHandler.requests_seen.append((self.path, if_none_match))
+        if if_none_match == TREE_ETAG:
+            self.send_response(304)
+            if _RecipeTreeHandler.not_modified_etag is not None:
+                self.send_header('ETag', _RecipeTreeHandler.not_modified_etag)
+            self.end_headers()
+            return
+        body = json.dumps({'recipes': {'recipe1': _RecipeTreeHandler.tree}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', TREE_ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRecipeStatusCache(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._server = HTTPServer(('127.0.0.1', 0), _RecipeTreeHandler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: self._server.server_address[1],
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh'})
+        self._api = DKCloudAPI(config)
+        self._api._auth_token = 'a-token'  # the stand-in server has no login endpoint
+
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestRecipeStatusCache._TEMPFILE_LOCATION)
+        kitchen_dir = os.path.join(self._temp_dir, 'kitchen')
+        self._recipe_meta_dir = os.path.join(kitchen_dir, '.dk', 'recipes', 'recipe1')
+        os.makedirs(self._recipe_meta_dir)
+        with open(os.path.join(kitchen_dir, '.dk', 'KITCHEN_META'), 'w') as f:
+            f.write('kitchen')
+        with open(os.path.join(self._recipe_meta_dir, 'RECIPE_META'), 'w') as f:
+            f.write('recipe1')
+        with open(os.path.join(self._recipe_meta_dir, 'ORIG_HEAD'), 'w') as f:
+            f.write('abc123')
+        self._recipe_dir = os.path.join(kitchen_dir, 'recipe1')
+        os.makedirs(os.path.join(self._recipe_dir, 'node1'))
+        with open(os.path.join(self._recipe_dir, 'description.json'), 'w') as f:
+            f.write('{}')
+        with open(os.path.join(self._recipe_dir, 'node1', 'notebook.json'), 'w') as f:
+            f.write('[]')
+
+        _RecipeTreeHandler.requests_seen = list()
+        _RecipeTreeHandler.not_modified_etag = None
+        _RecipeTreeHandler.tree = {'recipe1': [{'filename': 'description.json', 'sha': githash_data('{}')}],
+                                   'recipe1/node1': [{'filename': 'notebook.json', 'sha': 'remote-sha'}]}
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._api.close()
+        shutil.rmtree(self._temp_dir)
+
+    def test_recipe_status_not_modified(self):
+        rc = self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir)
+        self.assertTrue(rc.ok())
+        first = rc.get_payload()
+        self.assertEqual(len(first['same']['recipe1']), 1)
+        self.assertEqual(len(first['different']['recipe1/node1']), 1)
+        self.assertTrue(os.path.isfile(os.path.join(self._recipe_meta_dir, REMOTE_TREE)))
+
+        # Second call sends the etag, gets a 304 and uses the saved tree.
+        with open(os.path.join(self._recipe_dir, 'node1', 'new.json'), 'w') as f:
+            f.write('new')
+        rc = self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir)
+        self.assertTrue(rc.ok())
+        second = rc.get_payload()
+        self.assertEqual(second['same'], first['same'])
+        self.assertEqual(second['different'], first['different'])
+        self.assertEqual(second['only_local']['recipe1/node1'][0]['filename'], 'new.json')
+
+        self.assertEqual(len(_RecipeTreeHandler.requests_seen), 2)
+        self.assertEqual(_RecipeTreeHandler.requests_seen[0][1], None)
+        self.assertEqual(_RecipeTreeHandler.requests_seen[1][1], TREE_ETAG)
+
+    def test_recipe_status_cache_dropped_on_new_orig_head(self):
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        with open(os.path.join(self._recipe_meta_dir, 'ORIG_HEAD'), 'w') as f:
+            f.write('def456')
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        self.assertEqual(_RecipeTreeHandler.requests_seen[1][1], None)
+
+        # a different kitchen never reuses the saved tree
+        self.assertTrue(self._api.recipe_status('other_kitchen', 'recipe1', self._recipe_dir).ok())
+        self.assertEqual(_RecipeTreeHandler.requests_seen[2][1], None)
+
+
+    def test_recipe_status_cache_checks_etag_and_recipe(self):
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        with open(os.path.join(self._recipe_meta_dir, REMOTE_TREE)) as f:
+            saved = json.load(f)
+        self.assertEqual((saved['etag'], saved['orig_head'], saved['recipe']), (TREE_ETAG, 'abc123', 'recipe1'))
+
+        # a 304 that names another etag is not for the saved tree
+        _RecipeTreeHandler.not_modified_etag = '"tree-2"'
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        self.assertEqual([seen[1] for seen in _RecipeTreeHandler.requests_seen], [None, TREE_ETAG, None])
+
+        # a tree saved for another recipe, or without an ORIG_HEAD, is not used
+        saved['recipe'] = 'recipe2'
+        with open(os.path.join(self._recipe_meta_dir, REMOTE_TREE), 'w') as f:
+            json.dump(saved, f)
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        self.assertEqual(_RecipeTreeHandler.requests_seen[3][1], None)
+        os.remove(os.path.join(self._recipe_meta_dir, 'ORIG_HEAD'))
+        self.assertTrue(self._api.recipe_status('kitchen', 'recipe1', self._recipe_dir).ok())
+        self.assertEqual(_RecipeTreeHandler.requests_seen[4][1], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
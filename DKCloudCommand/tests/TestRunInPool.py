@@ -0,0 +1,23 @@
+import unittest
+import time
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKCloudCommandRunner import DKCloudCommandRunner
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class TestRunInPool(DKCommonUnitTestSettings):
+
+    def test_run_in_pool_keeps_order(self):
+        def slow_square(x):
+            time.sleep(0.01 * (10 - x))
+            return x * x
+        items = range(10)
+        self.assertEqual(DKCloudCommandRunner._run_in_pool(slow_square, items, 4), [x * x for x in items])
+        self.assertEqual(DKCloudCommandRunner._run_in_pool(slow_square, items, 1), [x * x for x in items])
+        self.assertEqual(DKCloudCommandRunner._run_in_pool(slow_square, [], 4), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
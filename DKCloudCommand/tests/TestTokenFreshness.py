@@ -0,0 +1,154 @@
+import unittest
+import os, tempfile, shutil, json
+import threading, time
+import jwt
+from click.testing import CliRunner
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+from DKCloudAPI import DKCloudAPI, DKLoginError, _request_errors
+from DKCloudCommandConfig import DKCloudCommandConfig
+from DKCloudCommand.cli.__main__ import dk
+
+__author__ = 'DataKitchen, Inc.'
+
+
+def make_token(seconds_left, role='IT'):
+    return jwt.encode({'exp': int(time.time() + seconds_left), 'role': role}, 'secret')
+
+
+class _AuthHandler(BaseHTTPRequestHandler):
+    # Stand-in for /v2/login, /v2/validatetoken and one call that needs a valid token.
+    requests_seen = list()
+    valid_tokens = set()
+    login_token = None
+    login_ok = True
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _token(self):
+        return (self.headers.getheader('Authorization') or '').replace('Bearer ', '')
+
+    def do_GET(self):
+        _AuthHandler.requests_seen.append(self.path)
+        if self.path == '/v2/validatetoken':
+            self._reply(200, 'true' if self._token() in _AuthHandler.valid_tokens else 'false')
+        elif self._token() in _AuthHandler.valid_tokens:
+            self._reply(200, '{}')
+        else:
+            self._reply(401, 'unauthorized')
+
+    def do_POST(self):
+        _AuthHandler.requests_seen.append(self.path)
+        self.rfile.read(int(self.headers.getheader('Content-Length')))
+        if not _AuthHandler.login_ok:
+            self._reply(401, 'bad credentials')
+            return
+        _AuthHandler.valid_tokens.add(_AuthHandler.login_token)
+        self._reply(200, '"%s"' % _AuthHandler.login_token)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTokenFreshness(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._server = HTTPServer(('127.0.0.1', 0), _AuthHandler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        _AuthHandler.requests_seen = list()
+        _AuthHandler.valid_tokens = set()
+        _AuthHandler.login_token = make_token(3600)
+        _AuthHandler.login_ok = True
+        self._api = None
+
+    def tearDown(self):
+        if self._api is not None:
+            self._api.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_api(self, stored_token):
+        config = DKCloudCommandConfig()
+        config.init_from_dict({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                               DKCloudCommandConfig.DK_CLOUD_PORT: self._server.server_address[1],
+                               DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                               DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh',
+                               DKCloudCommandConfig.DK_CLOUD_JWT: stored_token,
+                               DKCloudCommandConfig.DK_CLOUD_TOKEN_SAFETY_MARGIN: 60})
+        self._api = DKCloudAPI(config)
+        return self._api
+
+    def test_fresh_token_is_trusted_locally(self):
+        token = make_token(3600)
+        _AuthHandler.valid_tokens.add(token)
+        api = self._make_api(token)
+        self.assertEqual(api.login(), token)
+        self.assertTrue(api.is_user_role('IT'))
+        self.assertEqual(_AuthHandler.requests_seen, [])
+
+    def test_token_near_expiry_is_validated_by_server(self):
+        token = make_token(30)
+        _AuthHandler.valid_tokens.add(token)
+        api = self._make_api(token)
+        self.assertEqual(api.login(), token)
+        self.assertEqual(_AuthHandler.requests_seen, ['/v2/validatetoken'])
+
+        _AuthHandler.requests_seen = list()
+        _AuthHandler.valid_tokens = set()
+        self.assertEqual(api.login(), _AuthHandler.login_token)
+        self.assertEqual(_AuthHandler.requests_seen, ['/v2/validatetoken', '/v2/login'])
+
+    def test_unauthorized_response_logs_in_again(self):
+        # a locally fresh token the server has revoked
+        api = self._make_api(make_token(3600))
+        url = '%s/v2/kitchen/list' % api.get_url_for_direct_rest_call()
+        response = api._get(url, headers=api._get_common_headers())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(_AuthHandler.requests_seen, ['/v2/kitchen/list', '/v2/login', '/v2/kitchen/list'])
+        self.assertEqual(api.login(force_login=False), _AuthHandler.login_token)
+
+    def test_refresh_is_scheduled_before_expiry(self):
+        api = self._make_api(make_token(3600))
+        api.login()
+        self.assertTrue(api._refresh_timer is not None)
+        self.assertTrue(api._refresh_timer.daemon)
+        self.assertTrue(3500 < api._refresh_timer.interval <= 3540)
+
+    def test_failed_login_raises_login_error(self):
+        _AuthHandler.login_ok = False
+        api = self._make_api(None)
+        self.assertRaises(DKLoginError, api._get_common_headers)
+        self.assertEqual(_AuthHandler.requests_seen, ['/v2/login'])
+
+    def test_request_errors(self):
+        # the same classes whether or not a request was made yet, and never a bare IOError
+        import requests
+        self.assertEqual(_request_errors(ValueError, TypeError), (requests.RequestException, ValueError, TypeError))
+
+    def test_failed_login_is_a_cli_error(self):
+        _AuthHandler.login_ok = False
+        temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestTokenFreshness._TEMPFILE_LOCATION)
+        config_file = os.path.join(temp_dir, 'DKCloudCommandConfig.json')
+        with open(config_file, 'w') as f:
+            json.dump({DKCloudCommandConfig.DK_CLOUD_IP: 'http://127.0.0.1',
+                       DKCloudCommandConfig.DK_CLOUD_PORT: self._server.server_address[1],
+                       DKCloudCommandConfig.DK_CLOUD_USERNAME: 'a@b.c',
+                       DKCloudCommandConfig.DK_CLOUD_PASSWORD: 'shhh'}, f)
+        try:
+            result = CliRunner().invoke(dk, ['--config', config_file, 'kitchen-list'],
+                                        env={'DKCLI_SKIP_VERSION_CHECK': '1'})
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(result.exit_code, 1)
+        self.assertTrue('Error: login failed' in result.output, result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import os, tempfile, shutil, json
+import threading, time, socket
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from DKCommonUnitTestSettings import DKCommonUnitTestSettings
+
+import DKCloudCommand.cli.__main__ as dk_main
+from DKCloudCommand.cli.__main__ import Backend
+
+__author__ = 'DataKitchen, Inc.'
+
+
+class _PypiHandler(BaseHTTPRequestHandler):
+    # Stand-in for the pypi JSON API.
+    def do_GET(self):
+        body = json.dumps({'info': {'version': '9.9.9'}})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestVersionCheck(DKCommonUnitTestSettings):
+
+    def setUp(self):
+        self._server = HTTPServer(('127.0.0.1', 0), _PypiHandler)
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        self._version_check_url = dk_main.VERSION_CHECK_URL
+        self._temp_dir = tempfile.mkdtemp(prefix='unit-tests', dir=TestVersionCheck._TEMPFILE_LOCATION)
+        self._latest_version_file = os.path.join(self._temp_dir, '.latest_version')
+        self._last_check_file = os.path.join(self._temp_dir, '.latest_version_checked')
+
+    def tearDown(self):
+        dk_main.VERSION_CHECK_URL = self._version_check_url
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._temp_dir)
+
+    def test_is_version_check_due(self):
+        self.assertTrue(Backend.is_version_check_due(self._last_check_file, 3600))
+        with open(self._last_check_file, 'w') as f:
+            f.write('not a time')
+        self.assertTrue(Backend.is_version_check_due(self._last_check_file, 3600))
+        with open(self._last_check_file, 'w') as f:
+            f.write(str(time.time() - 60))
+        self.assertFalse(Backend.is_version_check_due(self._last_check_file, 3600))
+        self.assertTrue(Backend.is_version_check_due(self._last_check_file, 30))
+        # a clock that went backwards does not stop the checks
+        with open(self._last_check_file, 'w') as f:
+            f.write(str(time.time() + 7200))
+        self.assertTrue(Backend.is_version_check_due(self._last_check_file, 3600))
+
+    def test_start_version_check(self):
+        dk_main.VERSION_CHECK_URL = 'http://127.0.0.1:%d/pypi/DKCloudCommand/json' % self._server.server_address[1]
+        thread = Backend.start_version_check(self._latest_version_file, self._last_check_file)
+        thread.join(10)
+        with open(self._latest_version_file) as f:
+            self.assertEqual(f.read(), '9.9.9')
+        self.assertFalse(Backend.is_version_check_due(self._last_check_file, 3600))
+
+    def test_failed_check_is_rate_limited(self):
+        # a port nothing listens on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        dk_main.VERSION_CHECK_URL = 'http://127.0.0.1:%d/pypi/DKCloudCommand/json' % closed.getsockname()[1]
+        closed.close()
+        thread = Backend.start_version_check(self._latest_version_file, self._last_check_file)
+        thread.join(10)
+        self.assertFalse(os.path.exists(self._latest_version_file))
+        self.assertFalse(Backend.is_version_check_due(self._last_check_file, 3600))
+
+    def test_unfinished_check_is_rate_limited(self):
+        # a command that exits before pypi answers kills the thread, the attempt still counts
+        started = threading.Event()
+        release = threading.Event()
+
+        class _SlowHandler(_PypiHandler):
+            def do_GET(self):
+                started.set()
+                release.wait(10)
+                _PypiHandler.do_GET(self)
+
+        self._server.RequestHandlerClass = _SlowHandler
+        dk_main.VERSION_CHECK_URL = 'http://127.0.0.1:%d/pypi/DKCloudCommand/json' % self._server.server_address[1]
+        thread = Backend.start_version_check(self._latest_version_file, self._last_check_file)
+        self.assertTrue(started.wait(10))
+        self.assertFalse(Backend.is_version_check_due(self._last_check_file, 3600))
+        self.assertFalse(os.path.exists(self._latest_version_file))
+        release.set()
+        thread.join(10)
+        with open(self._latest_version_file) as f:
+            self.assertEqual(f.read(), '9.9.9')
+
+if __name__ == '__main__':
+    unittest.main()
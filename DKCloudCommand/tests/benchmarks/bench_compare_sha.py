@@ -0,0 +1,61 @@
+"""
+Micro-benchmark for DKRecipeDisk.compare_sha on synthetic recipe trees.
+
+Run from the tests directory:
+    PYTHONPATH=../modules python benchmarks/bench_compare_sha.py [file_count ...]
+"""
+import random
+import sys
+import time
+
+from DKRecipeDisk import compare_sha
+
+__author__ = 'DataKitchen, Inc.'
+
+FILES_PER_FOLDER = 200
+
+
+def make_trees(file_count, seed=1):
+    # local and remote trees with ~90% same, 5% different, 2.5% only local / only remote files
+    rnd = random.Random(seed)
+    remote_sha = dict()
+    local_sha = dict()
+    for i in range(file_count):
+        folder = 'recipe/node%d/resources' % (i / FILES_PER_FOLDER)
+        filename = 'file_%06d.sql' % i
+        the_sha = '%040x' % rnd.getrandbits(160)
+        remote_sha.setdefault(folder, list())
+        local_sha.setdefault(folder, list())
+        roll = rnd.random()
+        if roll < 0.025:
+            remote_sha[folder].append({'filename': filename, 'sha': the_sha})
+        elif roll < 0.05:
+            local_sha[folder].append({'filename': filename, 'sha': the_sha})
+        elif roll < 0.10:
+            remote_sha[folder].append({'filename': filename, 'sha': the_sha})
+            local_sha[folder].append({'filename': filename, 'sha': '%040x' % rnd.getrandbits(160)})
+        else:
+            remote_sha[folder].append({'filename': filename, 'sha': the_sha})
+            local_sha[folder].append({'filename': filename, 'sha': the_sha})
+    return remote_sha, local_sha
+
+
+def run(file_count, repeat=3):
+    remote_sha, local_sha = make_trees(file_count)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        compare_sha(remote_sha, local_sha)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print '%8d files  %8.3f s' % (file_count, best)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        counts = [int(arg) for arg in sys.argv[1:]]
+    else:
+        counts = [10000, 50000, 100000]
+    for count in counts:
+        run(count)
@@ -0,0 +1,66 @@
+"""
+Startup benchmark for the dk command line.
+
+Measures the wall time of 'dk --help' and 'dk kitchen-which', neither of which needs the server.
+Both run against a throw-away config file and kitchen folder, and outgoing HTTP is pointed at a
+closed local port so the numbers don't depend on the network.
+
+Run from the repository root (the folder that contains DKCloudCommand):
+    python DKCloudCommand/tests/benchmarks/bench_startup.py [runs]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'DataKitchen, Inc.'
+
+COMMANDS = [['--help'], ['kitchen-which']]
+
+
+def make_environment(temp_dir):
+    config_file = os.path.join(temp_dir, 'DKCloudCommandConfig.json')
+    with open(config_file, 'w') as f:
+        json.dump({'dk-cloud-ip': 'http://127.0.0.1', 'dk-cloud-port': '9',
+                   'dk-cloud-username': 'bench@datakitchen.io', 'dk-cloud-password': 'bench',
+                   'dk-cloud-merge-tool': '', 'dk-cloud-diff-tool': ''}, f)
+    kitchen_dir = os.path.join(temp_dir, 'bench_kitchen')
+    os.makedirs(os.path.join(kitchen_dir, '.dk'))
+    with open(os.path.join(kitchen_dir, '.dk', 'KITCHEN_META'), 'w') as f:
+        f.write('bench_kitchen')
+
+    env = dict(os.environ)
+    env['DKCLI_CONFIG_LOCATION'] = config_file
+    env['http_proxy'] = env['https_proxy'] = 'http://127.0.0.1:9'
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + [p for p in [env.get('PYTHONPATH')] if p])
+    return kitchen_dir, env
+
+
+def time_command(args, cwd, env, runs):
+    timings = list()
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable, '-m', 'DKCloudCommand.cli'] + args,
+                            cwd=cwd, env=env, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return timings
+
+
+def main(runs):
+    temp_dir = tempfile.mkdtemp(prefix='dk-startup-bench')
+    try:
+        kitchen_dir, env = make_environment(temp_dir)
+        for args in COMMANDS:
+            timings = sorted(time_command(args, kitchen_dir, env, runs))
+            print '%-20s runs: %3d  min: %7.1f ms  median: %7.1f ms' % \
+                  ('dk ' + ' '.join(args), runs, timings[0] * 1000, timings[len(timings) / 2] * 1000)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)